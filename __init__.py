@@ -5,6 +5,7 @@ from product import (
     ProductAttributeSet, ProductAttributeSelectionOption, ProductAttribute,
     ProductAttributeAttributeSet, Template, ProductProductAttribute, Product
 )
+from ir import Translation
 
 
 def register():
@@ -16,5 +17,6 @@ def register():
         Template,
         ProductProductAttribute,
         Product,
+        Translation,
         module='product_attribute_strict', type_='model'
     )
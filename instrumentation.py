@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Optional instrumentation of the attribute models.
+
+The public methods and the methods of the Function fields of the models
+are wrapped to record the number of SQL queries, the rows fetched and the
+wall time of each call, over the whole iteration for generator methods
+like the exports. A call is recorded when the context has the
+attribute_instrumentation flag (clients can set it as it does not start
+with an underscore) or when the logger of this module is enabled for
+DEBUG, in which case each call is also logged.
+
+The records are aggregated by method in the process and returned by
+get_report, which is exposed by the instrumentation_report RPC method of
+product.attribute.
+"""
+import inspect
+import logging
+import threading
+import time
+import types
+from functools import wraps
+
+from trytond.model import fields
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_FLAG = 'attribute_instrumentation'
+
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+
+
+class CountingCursor(object):
+    """
+    Cursor proxy counting the queries it executes and the rows fetched
+    """
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.counter.rows += 1
+            yield row
+
+    def execute(self, *args, **kwargs):
+        self.counter.count += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.counter.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        self.counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.counter.rows += len(rows)
+        return rows
+
+
+class QueryCounter(object):
+    """
+    Connection proxy counting the queries executed by its cursors and the
+    rows fetched from them
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+        self.rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self.connection.cursor(*args, **kwargs), self)
+
+
+def is_enabled():
+    context = getattr(Transaction(), 'context', None) or {}
+    return bool(context.get(CONTEXT_FLAG)) or logger.isEnabledFor(
+        logging.DEBUG
+    )
+
+
+def record(name, queries, rows, duration):
+    with _lock:
+        stats = _stats.setdefault(name, {
+            'calls': 0,
+            'queries': 0,
+            'rows': 0,
+            'time': 0.,
+        })
+        stats['calls'] += 1
+        stats['queries'] += queries
+        stats['rows'] += rows
+        stats['time'] += duration
+    logger.debug(
+        '%s: %d queries, %d rows in %.6fs', name, queries, rows, duration
+    )
+
+
+def get_report(reset=False):
+    """
+    Returns the list of the aggregated records of the methods sorted by
+    decreasing total time, as dictionaries with the name of the method and
+    its number of calls, queries, rows and total time.
+    """
+    with _lock:
+        report = [dict(stats, name=name) for name, stats in _stats.items()]
+        if reset:
+            _stats.clear()
+    return sorted(report, key=lambda r: (-r['time'], r['name']))
+
+
+def instrument_generator(name, func):
+    """
+    Returns the generator function wrapped to record its calls under name
+    with the queries, rows and time of the whole iteration, which are not
+    done by the call itself.
+
+    Only the steps of the generator are measured, not the time spent by
+    the caller between them.
+    """
+    def call(*args, **kwargs):
+        active = _local.__dict__.setdefault('active', set())
+        if name in active or not is_enabled():
+            for item in func(*args, **kwargs):
+                yield item
+            return
+        generator = func(*args, **kwargs)
+        counter = QueryCounter(Transaction().connection)
+        duration = 0.
+        try:
+            while True:
+                start = time.time()
+                item = _next_counted(name, generator, counter)
+                duration += time.time() - start
+                if item is _exhausted:
+                    return
+                yield item
+        finally:
+            generator.close()
+            record(name, counter.count, counter.rows, duration)
+
+    wrapper = wraps(func)(call)
+    wrapper.instrumented = True
+    return wrapper
+
+
+_exhausted = object()
+
+
+def _next_counted(name, generator, counter):
+    """
+    Returns the next item of the generator, or _exhausted, with the
+    queries counted by counter
+    """
+    active = _local.__dict__.setdefault('active', set())
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = counter
+    active.add(name)
+    try:
+        return next(generator, _exhausted)
+    finally:
+        active.discard(name)
+        transaction.connection = connection
+
+
+def instrument_function(name, func):
+    """
+    Returns the function wrapped to record its calls under name.
+
+    Calls nested in a call of the same name are not recorded again.
+    """
+    def call(*args, **kwargs):
+        active = _local.__dict__.setdefault('active', set())
+        if name in active or not is_enabled():
+            return func(*args, **kwargs)
+        transaction = Transaction()
+        connection = transaction.connection
+        transaction.connection = counter = QueryCounter(connection)
+        active.add(name)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.time() - start
+            active.discard(name)
+            transaction.connection = connection
+            record(name, counter.count, counter.rows, duration)
+
+    # Function fields give the list of the field names to the getters
+    # having a names argument
+    if 'names' in inspect.getargspec(func)[0]:
+        def wrapper(self, records, names):
+            return call(self, records, names)
+    else:
+        wrapper = call
+    wrapper = wraps(func)(wrapper)
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_method(name, func):
+    """
+    Returns the method wrapped by instrument_generator if it is a
+    generator function or by instrument_function otherwise
+    """
+    if inspect.isgeneratorfunction(func):
+        return instrument_generator(name, func)
+    return instrument_function(name, func)
+
+
+def _instrument_attribute(cls, name):
+    """
+    Wrap the method name of cls as resolved by its MRO
+    """
+    attribute = next(
+        (k.__dict__[name] for k in cls.__mro__ if name in k.__dict__), None
+    )
+    key = '%s.%s' % (cls.__name__, name)
+    if isinstance(attribute, (classmethod, staticmethod)):
+        func = attribute.__func__
+        if not getattr(func, 'instrumented', False):
+            setattr(
+                cls, name, type(attribute)(instrument_method(key, func))
+            )
+    elif isinstance(attribute, types.FunctionType):
+        if not getattr(attribute, 'instrumented', False):
+            setattr(cls, name, instrument_method(key, attribute))
+
+
+def _get_instrumented_names(cls, base):
+    """
+    Returns the names of the public methods defined by the classes of the
+    MRO of cls which directly inherit from base and of the methods of its
+    Function fields
+    """
+    names = set()
+    for klass in cls.__mro__:
+        if base in klass.__bases__:
+            names.update(n for n in klass.__dict__ if not n.startswith('_'))
+    for field in getattr(cls, '_fields', {}).itervalues():
+        if isinstance(field, fields.Function):
+            names.update([field.getter, field.setter, field.searcher])
+    names.discard(None)
+    return names
+
+
+def instrument(cls, base):
+    """
+    Wrap the methods of cls returned by _get_instrumented_names
+    """
+    for name in _get_instrumented_names(cls, base):
+        _instrument_attribute(cls, name)
+
+
+class Instrumented(object):
+    """
+    Mixin instrumenting the methods of the model it is defined on
+    """
+
+    @classmethod
+    def __post_setup__(cls):
+        super(Instrumented, cls).__post_setup__()
+        instrument(cls, Instrumented)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from trytond.pool import PoolMeta, Pool
+
+__metaclass__ = PoolMeta
+__all__ = ['Translation']
+
+# Models whose translated names are in the attribute metadata cache
+METADATA_MODELS = ('product.attribute', 'product.attribute.selection_option')
+
+
+class Translation:
+    "Translation"
+    __metaclass__ = PoolMeta
+    __name__ = 'ir.translation'
+
+    @classmethod
+    def create(cls, vlist):
+        cls._clear_attribute_metadata([v.get('name') for v in vlist])
+        return super(Translation, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        names = []
+        for translations, values in zip(actions, actions):
+            names.extend(t.name for t in translations)
+            names.append(values.get('name'))
+        cls._clear_attribute_metadata(names)
+        return super(Translation, cls).write(*args)
+
+    @classmethod
+    def delete(cls, translations):
+        cls._clear_attribute_metadata([t.name for t in translations])
+        return super(Translation, cls).delete(translations)
+
+    @staticmethod
+    def _clear_attribute_metadata(names):
+        """
+        Clear the metadata cache of the attributes if one of the names is
+        the name of a field of the attributes or of their options
+        """
+        if any(name and name.split(',')[0] in METADATA_MODELS
+                for name in names):
+            Pool().get('product.attribute')._metadata_cache.clear()
@@ -1,18 +1,41 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import time
+from decimal import Decimal, InvalidOperation
+from itertools import groupby, islice, product as cartesian_product
+from uuid import uuid4
 
-from trytond.model import ModelSQL, ModelView, fields
+from sql import Column, Literal, Null, Table, Union
+from sql.aggregate import Count
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp
+from sql.operators import ILike, Like
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.model.modelsql import convert_from
 from trytond.pool import PoolMeta, Pool
-from trytond.pyson import Eval
+from trytond.pyson import Eval, If
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
+from instrumentation import Instrumented, get_report
+
 __metaclass__ = PoolMeta
 __all__ = [
     'ProductAttributeSet', 'ProductAttributeSelectionOption',
     'ProductAttribute', 'ProductAttributeAttributeSet',
     'Template', 'ProductProductAttribute', 'Product',
 ]
+logger = logging.getLogger(__name__)
 
 ATTRIBUTE_TYPES = [
     ('boolean', 'Boolean'),
@@ -26,7 +49,50 @@ ATTRIBUTE_TYPES = [
 ]
 
 
-class ProductAttributeSet(ModelSQL, ModelView):
+def _parse_boolean(value):
+    if value.lower() in ('true', '1', 'yes', 'y'):
+        return True
+    if value.lower() in ('false', '0', 'no', 'n'):
+        return False
+    raise ValueError('Invalid boolean value: %r' % value)
+
+
+def _parse_numeric(value):
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise ValueError('Invalid numeric value: %r' % value)
+
+
+VALUE_PARSERS = {
+    'boolean': _parse_boolean,
+    'integer': int,
+    'float': float,
+    'numeric': _parse_numeric,
+    'date': lambda v: datetime.strptime(v, "%Y-%m-%d").date(),
+    'datetime': lambda v: datetime.strptime(v, "%Y-%m-%d %H:%M:%S"),
+}
+
+# Canonical text of the SQL values of each type in attribute signatures
+SIGNATURE_FORMATS = {
+    'boolean': lambda v: unicode(bool(v)),
+    'integer': lambda v: unicode(int(v)),
+    'char': unicode,
+    'float': lambda v: repr(float(v)),
+    'numeric': lambda v: unicode(Decimal(unicode(v)).normalize()),
+    'date': lambda v: v.isoformat(),
+    'datetime': lambda v: v.isoformat(),
+    'selection': lambda v: unicode(int(v)),
+}
+
+# The attribute set domains are checked in batch by validate using the
+# cached attributes of the sets, so they only apply to the client
+ATTRIBUTE_SET_CHECKED = Eval('context', {}).get('_attribute_set_checked', False)
+# Same for the attribute of the selection options of the values
+OPTION_CHECKED = Eval('context', {}).get('_selection_option_checked', False)
+
+
+class ProductAttributeSet(Instrumented, ModelSQL, ModelView):
     "Product Attribute Set"
     __name__ = 'product.attribute.set'
 
@@ -36,8 +102,71 @@ class ProductAttributeSet(ModelSQL, ModelView):
         'attribute_set', 'attribute', 'Attributes'
     )
 
+    _attributes_cache = Cache(
+        'product.attribute.set.attributes', context=False
+    )
+
+    @classmethod
+    def get_attribute_ids(cls, set_ids):
+        """
+        Returns a dictionary mapping the attribute set ids to the frozenset
+        of the ids of their attributes.
+
+        The sets are kept in a per-database LRU cache which is cleared when
+        attributes are added to or removed from a set, so only the sets
+        missing from the cache are read.
+        """
+        AttributeAttributeSet = Pool().get(
+            'product.attribute-product.attribute-set'
+        )
+        cursor = Transaction().connection.cursor()
+        table = AttributeAttributeSet.__table__()
+
+        res = {}
+        missing = []
+        for set_id in set(set_ids):
+            attribute_ids = cls._attributes_cache.get(set_id)
+            if attribute_ids is None:
+                missing.append(set_id)
+            else:
+                res[set_id] = attribute_ids
+
+        attributes = dict((set_id, []) for set_id in missing)
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*table.select(
+                table.attribute_set, table.attribute,
+                where=reduce_ids(table.attribute_set, sub_ids)
+            ))
+            for set_id, attribute_id in cursor.fetchall():
+                attributes[set_id].append(attribute_id)
+        res.update(
+            (set_id, cls._attributes_cache.set(set_id, frozenset(ids)))
+            for set_id, ids in attributes.iteritems()
+        )
+        return res
+
+    @classmethod
+    def get_attribute_ids_without_set(cls, attribute_ids):
+        """
+        Returns the frozenset of the given attribute ids which are in no
+        attribute set, with one query per slice of ids
+        """
+        AttributeAttributeSet = Pool().get(
+            'product.attribute-product.attribute-set'
+        )
+        cursor = Transaction().connection.cursor()
+        table = AttributeAttributeSet.__table__()
+
+        in_set = set()
+        for sub_ids in grouped_slice(list(set(attribute_ids))):
+            cursor.execute(*table.select(
+                table.attribute, where=reduce_ids(table.attribute, sub_ids)
+            ))
+            in_set.update(id_ for id_, in cursor.fetchall())
+        return frozenset(attribute_ids) - in_set
+
 
-class ProductAttributeSelectionOption(ModelSQL, ModelView):
+class ProductAttributeSelectionOption(Instrumented, ModelSQL, ModelView):
     "Attribute Selection Option"
 
     __name__ = 'product.attribute.selection_option'
@@ -46,9 +175,70 @@ class ProductAttributeSelectionOption(ModelSQL, ModelView):
     attribute = fields.Many2One(
         "product.attribute", "Attribute", required=True, ondelete='CASCADE'
     )
+    usage_count = fields.Integer("Usage Count", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ProductAttributeSelectionOption, cls).__setup__()
+        cls._error_messages.update({
+            'delete_used_option': (
+                'Option "%(option)s" can not be deleted because it is used '
+                'by %(count)s products.'
+            ),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        ProductAttribute = Pool().get('product.product.attribute')
+
+        usage_exists = TableHandler(cls, module_name).column_exist(
+            'usage_count'
+        )
 
+        super(ProductAttributeSelectionOption, cls).__register__(module_name)
 
-class ProductAttribute(ModelSQL, ModelView):
+        # Migration: count the existing attribute values
+        if not usage_exists and TableHandler.table_exist(
+                ProductAttribute._get_value_table_name('selection')):
+            ProductAttribute._set_usage_counts(cls, 'value_selection')
+
+    @staticmethod
+    def default_usage_count():
+        return 0
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('product.attribute')._metadata_cache.clear()
+        return super(ProductAttributeSelectionOption, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('product.attribute')._metadata_cache.clear()
+        super(ProductAttributeSelectionOption, cls).write(*args)
+
+    @classmethod
+    def delete(cls, options):
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        AttributeValue = pool.get('product.product.attribute')
+
+        if AttributeValue._usage_counts_deferred():
+            Attribute.recompute_usage_counts(
+                list(set(o.attribute for o in options))
+            )
+            options = cls.browse(options)
+        for option in options:
+            if option.usage_count:
+                cls.raise_user_error('delete_used_option', {
+                    'option': option.name,
+                    'count': option.usage_count,
+                })
+        Pool().get('product.attribute')._metadata_cache.clear()
+        super(ProductAttributeSelectionOption, cls).delete(options)
+
+
+class ProductAttribute(Instrumented, ModelSQL, ModelView):
     "Product Attribute"
     __name__ = 'product.attribute'
 
@@ -69,16 +259,167 @@ class ProductAttribute(ModelSQL, ModelView):
             'invisible': ~(Eval('type_') == 'selection'),
         }
     )
+    usage_count = fields.Integer("Usage Count", readonly=True)
+
+    _metadata_cache = Cache('product.attribute.metadata', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(ProductAttribute, cls).__setup__()
+        cls.__rpc__.update({
+            'instrumentation_report': RPC(),
+        })
+        cls._error_messages.update({
+            'delete_used_attribute': (
+                'Attribute "%(attribute)s" can not be deleted because it is '
+                'used by %(count)s products.'
+            ),
+        })
 
-    def get_rec_name(self, name):
-        return self.display_name or self.name
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        AttributeValue = Pool().get('product.product.attribute')
+
+        usage_exists = TableHandler(cls, module_name).column_exist(
+            'usage_count'
+        )
+
+        super(ProductAttribute, cls).__register__(module_name)
+
+        # Migration: count the existing attribute values
+        if not usage_exists and TableHandler.table_exist(
+                AttributeValue._table):
+            AttributeValue._set_usage_counts(cls, 'attribute')
+
+    @classmethod
+    def instrumentation_report(cls):
+        """
+        Returns the aggregated instrumentation records of the attribute
+        models in this process (see the instrumentation module)
+        """
+        return get_report()
+
+    @classmethod
+    def get_rec_name(cls, attributes, name):
+        return dict(
+            (id_, metadata['display_name'] or metadata['name'])
+            for id_, metadata in cls.get_metadata(map(int, attributes)).items()
+        )
 
     @staticmethod
     def default_type_():
         return 'char'
 
+    @staticmethod
+    def default_usage_count():
+        return 0
+
+    @classmethod
+    def create(cls, vlist):
+        cls._metadata_cache.clear()
+        return super(ProductAttribute, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._metadata_cache.clear()
+        super(ProductAttribute, cls).write(*args)
+
+    @classmethod
+    def delete(cls, attributes):
+        AttributeValue = Pool().get('product.product.attribute')
+
+        if AttributeValue._usage_counts_deferred():
+            cls.recompute_usage_counts(attributes)
+            attributes = cls.browse(attributes)
+        for attribute in attributes:
+            if attribute.usage_count:
+                cls.raise_user_error('delete_used_attribute', {
+                    'attribute': attribute.rec_name,
+                    'count': attribute.usage_count,
+                })
+        cls._metadata_cache.clear()
+        super(ProductAttribute, cls).delete(attributes)
+
+    @classmethod
+    def recompute_usage_counts(cls, attributes=None):
+        """
+        Recompute from the attribute values the usage counters of the
+        attributes, all of them by default, and of their options.
+
+        The counters are maintained by the writes of the attribute values,
+        this repairs the drift left by writes bypassing the models.
+        """
+        pool = Pool()
+        Option = pool.get('product.attribute.selection_option')
+        AttributeValue = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        if attributes is None:
+            AttributeValue._set_usage_counts(cls, 'attribute')
+            AttributeValue._set_usage_counts(Option, 'value_selection')
+            return
+        attribute_ids = map(int, attributes)
+        option = Option.__table__()
+        cursor.execute(*option.select(
+            option.id, where=reduce_ids(option.attribute, attribute_ids)
+        ))
+        AttributeValue._set_usage_counts(cls, 'attribute', attribute_ids)
+        AttributeValue._set_usage_counts(
+            Option, 'value_selection', [id_ for id_, in cursor.fetchall()]
+        )
+
+    @classmethod
+    def get_metadata(cls, ids):
+        """
+        Returns a dictionary mapping the attribute ids to a dictionary with
+        the name, display_name, type_ and options (option names by id) of
+        the attribute in the context language.
+
+        The metadata is kept in a per-database LRU cache which is cleared
+        when attributes, options or the translations of their names are
+        created, written or deleted, so only the attributes missing from
+        the cache are read. The returned dictionaries are shared and must
+        not be modified.
+        """
+        language = Transaction().language
+        res = {}
+        missing = []
+        for id_ in set(ids):
+            metadata = cls._metadata_cache.get((id_, language))
+            if metadata is None:
+                missing.append(id_)
+            else:
+                res[id_] = metadata
+        if missing:
+            for id_, metadata in cls._read_metadata(missing).iteritems():
+                res[id_] = cls._metadata_cache.set((id_, language), metadata)
+        return res
+
+    @classmethod
+    def _read_metadata(cls, ids):
+        """
+        Read the metadata of the attributes as root, as the cache is shared
+        by all the users
+        """
+        Option = Pool().get('product.attribute.selection_option')
+        transaction = Transaction()
+
+        res = {}
+        with transaction.set_user(0), \
+                transaction.set_context(language=transaction.language):
+            for attribute in cls.read(ids, ['name', 'display_name', 'type_']):
+                attribute['options'] = {}
+                res[attribute.pop('id')] = attribute
+            for option in Option.search_read(
+                    [('attribute', 'in', ids)],
+                    fields_names=['attribute', 'name']):
+                res[option['attribute']]['options'][option['id']] = \
+                    option['name']
+        return res
 
-class ProductAttributeAttributeSet(ModelSQL, ModelView):
+
+class ProductAttributeAttributeSet(Instrumented, ModelSQL, ModelView):
     "Product Attribute - Set"
     __name__ = 'product.attribute-product.attribute-set'
 
@@ -91,17 +432,205 @@ class ProductAttributeAttributeSet(ModelSQL, ModelView):
         ondelete='CASCADE', select=True, required=True
     )
 
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('product.attribute.set')._attributes_cache.clear()
+        return super(ProductAttributeAttributeSet, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('product.attribute.set')._attributes_cache.clear()
+        super(ProductAttributeAttributeSet, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        Pool().get('product.attribute.set')._attributes_cache.clear()
+        super(ProductAttributeAttributeSet, cls).delete(records)
+
 
-class Template:
+class Template(Instrumented):
     "Template"
+    __metaclass__ = PoolMeta
     __name__ = 'product.template'
 
     attribute_set = fields.Many2One(
         'product.attribute.set', 'Set', ondelete='RESTRICT'
     )
 
+    @classmethod
+    def __setup__(cls):
+        super(Template, cls).__setup__()
+        cls.__rpc__.update({
+            'generate_variants': RPC(
+                readonly=False, instantiate=0,
+                result=lambda r: map(int, r)
+            ),
+        })
+        cls._error_messages.update({
+            'variant_attribute_not_in_set': (
+                'Attribute "%(attribute)s" is not in the attribute set of '
+                'template "%(template)s".'
+            ),
+            'variant_attribute_not_selection': (
+                'Variants can only be generated from selection attributes '
+                'but "%(attribute)s" is not.'
+            ),
+            'variant_unknown_option': (
+                'Option %(option)s is not an option of attribute '
+                '"%(attribute)s".'
+            ),
+        })
+
+    @classmethod
+    def get_attribute_sets(cls, template_ids):
+        """
+        Returns a dictionary mapping the template ids to the id of their
+        attribute set, without instantiating the templates.
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        res = dict.fromkeys(template_ids)
+        for sub_ids in grouped_slice(template_ids):
+            cursor.execute(*table.select(
+                table.id, table.attribute_set,
+                where=reduce_ids(table.id, sub_ids)
+            ))
+            res.update(cursor.fetchall())
+        return res
+
+    @classmethod
+    def generate_variants(cls, template, options, batch_size=1000):
+        """
+        Create the variants of the template for the combinations of options
+        which are not used by any of its variants yet and return them.
+
+        options maps selection attributes of the attribute set of the
+        template (or their ids) to the list of options (or their ids) to
+        combine. A variant uses a combination when it has its options,
+        whatever the values of its other attributes.
+
+        The combinations of the existing variants are read once with a
+        single query. The variants are then created by batches of
+        batch_size combinations with their attribute values inserted with
+        one query per batch.
+        """
+        options = cls._get_variant_options(template, options)
+        if not options:
+            return []
+        existing = cls._get_variant_combinations(template, options)
+        combinations = cartesian_product(*[
+            [(attribute_id, option_id) for option_id in option_ids]
+            for attribute_id, option_ids in options
+        ])
+
+        variants = []
+        while True:
+            batch = list(islice(combinations, batch_size))
+            if not batch:
+                break
+            variants.extend(cls._create_variants(template, batch, existing))
+        return variants
+
+    @classmethod
+    def _get_variant_options(cls, template, options):
+        """
+        Check the options to generate the variants of the template from and
+        return them as a sorted list of attribute id and sorted option ids
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        AttributeSet = pool.get('product.attribute.set')
+
+        options = dict(
+            (int(attribute), set(map(int, option_ids)))
+            for attribute, option_ids in options.iteritems()
+        )
+        set_id = template.attribute_set and template.attribute_set.id
+        set_attributes = AttributeSet.get_attribute_ids(
+            [set_id] if set_id else []
+        ).get(set_id, frozenset())
+        metadata = Attribute.get_metadata(list(options))
+        for attribute_id, option_ids in options.iteritems():
+            attribute = metadata[attribute_id]
+            args = {
+                'template': template.rec_name,
+                'attribute': attribute['display_name'] or attribute['name'],
+            }
+            if attribute_id not in set_attributes:
+                cls.raise_user_error('variant_attribute_not_in_set', args)
+            if attribute['type_'] != 'selection':
+                cls.raise_user_error('variant_attribute_not_selection', args)
+            for option_id in option_ids - set(attribute['options']):
+                args['option'] = option_id
+                cls.raise_user_error('variant_unknown_option', args)
+        return sorted(
+            (attribute_id, sorted(option_ids))
+            for attribute_id, option_ids in options.iteritems()
+        )
+
+    @classmethod
+    def _get_variant_combinations(cls, template, options):
+        """
+        Returns the set of the combinations of attribute and option ids,
+        sorted by attribute, of the options of the variants of the template
+        among the options given like _get_variant_options returns them
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+        product = Product.__table__()
+        value = ProductAttribute._get_value_table('selection')
+
+        cursor.execute(*value.join(
+            product, condition=product.id == value.product
+        ).select(
+            value.product, value.attribute, value.value_selection,
+            where=(product.template == template.id)
+            & value.attribute.in_([a for a, _ in options])
+            & value.value_selection.in_(
+                [o for _, option_ids in options for o in option_ids]
+            ),
+            order_by=[value.product, value.attribute]
+        ))
+        return set(
+            tuple((a, o) for _, a, o in rows)
+            for _, rows in groupby(cursor.fetchall(), key=lambda r: r[0])
+        )
+
+    @classmethod
+    def _create_variants(cls, template, combinations, existing):
+        """
+        Create a variant of the template for each combination of attribute
+        and option ids which is not in the existing combinations and add
+        the combinations of the new variants to them
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        combinations = [c for c in combinations if tuple(c) not in existing]
+        if not combinations:
+            return []
+        existing.update(tuple(c) for c in combinations)
+
+        variants = Product.create([
+            {'template': template.id} for _ in combinations
+        ])
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+        ProductAttribute._insert_values([
+            [variant.id, attribute_id] + [
+                option_id if t == 'selection' else None for t in types
+            ]
+            for variant, combination in zip(variants, combinations)
+            for attribute_id, option_id in combination
+        ])
+        Product.update_attribute_signatures([v.id for v in variants])
+        return variants
 
-class ProductProductAttribute(ModelSQL, ModelView):
+
+class ProductProductAttribute(Instrumented, ModelSQL, ModelView):
     "Product's Product Attribute"
     __name__ = 'product.product.attribute'
 
@@ -112,23 +641,29 @@ class ProductProductAttribute(ModelSQL, ModelView):
 
     attribute = fields.Many2One(
         "product.attribute", "Attribute", required=True, select=True,
-        domain=[('sets', '=', Eval('attribute_set'))],
-        depends=['attribute_set'], ondelete='RESTRICT'
+        domain=[If(
+            ATTRIBUTE_SET_CHECKED, (), ('sets', '=', Eval('attribute_set'))
+        )], depends=['attribute_set'], ondelete='RESTRICT'
     )
 
     attribute_type = fields.Function(
         fields.Selection(ATTRIBUTE_TYPES, "Attribute Type"),
-        'get_attribute_type'
+        'get_attribute_info'
     )
 
     attribute_set = fields.Function(
         fields.Many2One("product.attribute.set", "Attribute Set"),
-        'get_attribute_set'
+        'get_attribute_info'
     )
 
     value = fields.Function(
         fields.Char('Attribute Value'),
-        getter='get_value'
+        getter='get_value', searcher='search_value'
+    )
+
+    value_text = fields.Function(
+        fields.Char('Attribute Value Text'),
+        getter='get_value', searcher='search_value_text'
     )
 
     value_char = fields.Char(
@@ -152,12 +687,12 @@ class ProductProductAttribute(ModelSQL, ModelView):
 
     value_selection = fields.Many2One(
         "product.attribute.selection_option", "Value Selection",
-        domain=[('attribute', '=', Eval('attribute'))],
+        domain=[If(OPTION_CHECKED, (), ('attribute', '=', Eval('attribute')))],
         states={
             'required': Eval('attribute_type') == 'selection',
             'invisible': ~(Eval('attribute_type') == 'selection'),
         }, depends=['attribute', 'attribute_type'],
-        ondelete='RESTRICT'
+        ondelete='RESTRICT', select=True
     )
 
     value_boolean = fields.Boolean(
@@ -185,84 +720,2424 @@ class ProductProductAttribute(ModelSQL, ModelView):
         }, depends=['attribute_type']
     )
 
-    @fields.depends('attribute')
-    def on_change_attribute(self):
-        self.attribute_type = self.attribute and self.attribute.type_ or None
+    @classmethod
+    def __setup__(cls):
+        super(ProductProductAttribute, cls).__setup__()
+        table = cls.__table__()
+        unique_error = 'A product can have only one value per attribute.'
+        cls._sql_constraints += [
+            ('product_attribute_uniq',
+                Unique(table, table.product, table.attribute), unique_error),
+        ]
+        # SQLite reports the columns of the unique index instead of its name
+        cls._sql_error_messages.update({
+            '%s.product, %s.attribute' % (cls._table, cls._table): (
+                unique_error
+            ),
+        })
+        cls._value_storage = config.get(
+            'product_attribute_strict', 'value_storage', default='wide'
+        )
+        for type_, _ in ATTRIBUTE_TYPES:
+            name = 'value_' + type_
+            field = getattr(cls, name)
+            field = getattr(field, '_field', field)
+            if cls._value_storage == 'typed':
+                # The values are stored in a table per type behind the same
+                # fields (see _create_value_tables)
+                field = fields.Function(
+                    field, 'get_stored_values', setter='set_stored_value',
+                    searcher='search_stored_value'
+                )
+            setattr(cls, name, field)
+        cls._error_messages.update({
+            'unknown_product': 'There is no product with code "%(product)s".',
+            'unknown_product_ids': (
+                'There are no products with the ids: %(products)s.'
+            ),
+            'unknown_attribute': (
+                'There is no attribute named "%(attribute)s".'
+            ),
+            'attribute_not_in_set': (
+                'Attribute "%(attribute)s" is not in the attribute set of '
+                'product "%(product)s".'
+            ),
+            'unknown_option': (
+                '"%(value)s" is not an option of attribute "%(attribute)s".'
+            ),
+            'duplicate_value': (
+                'Product "%(product)s" already has a value of attribute '
+                '"%(attribute)s".'
+            ),
+            'invalid_value': (
+                '"%(value)s" is not a valid %(type)s value for attribute '
+                '"%(attribute)s".'
+            ),
+            'invalid_attribute_sets': (
+                'The following attributes are not in the attribute set of '
+                'their product:\n%(values)s'
+            ),
+            'invalid_selection_options': (
+                'The following values are not options of their attribute:'
+                '\n%(values)s'
+            ),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(ProductProductAttribute, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        if cls._value_storage == 'typed':
+            cls._create_value_tables()
+            # Migration: move the values of the wide storage
+            cls._drop_text_table(cls._table)
+            cls._migrate_to_value_tables(table)
+        else:
+            # Migration: move back the values of the typed storage
+            cls._migrate_from_value_tables()
+            cls._drop_value_tables()
+            cls._create_value_indexes(table)
+
+        if backend.name() == 'postgresql':  # pragma: no cover
+            cls._create_trigram_index()
+        elif backend.name() == 'sqlite':
+            cls._create_unique_index()
+            cls._create_text_table()
+
+    @classmethod
+    def _create_value_indexes(cls, table):
+        partial = cls._partial_index_supported()
+        for type_, _ in ATTRIBUTE_TYPES:
+            column = 'value_' + type_
+            # Migration: the value indexes cover the product
+            table.index_action(['attribute', column], 'remove')
+            if partial:
+                cls._create_partial_value_index(table, column)
+            else:
+                table.index_action(['attribute', column, 'product'], 'add')
+
+    @staticmethod
+    def _get_sqlite_version():
+        cursor = Transaction().connection.cursor()
+        cursor.execute('SELECT sqlite_version()')
+        version, = cursor.fetchone()
+        return tuple(map(int, version.split('.')[:2]))
 
-    def get_attribute_type(self, name=None):
+    @classmethod
+    def _partial_index_supported(cls):
         """
-        Returns type of attribute
+        Returns True if the backend supports indexes with a WHERE clause
         """
-        return self.attribute.type_
+        if backend.name() == 'postgresql':  # pragma: no cover
+            return True
+        if backend.name() == 'sqlite':
+            return cls._get_sqlite_version() >= (3, 8)
+        return False  # pragma: no cover
 
-    def get_value(self, name=None):
+    @classmethod
+    def _get_unique_index_name(cls):
         """
-        Consolidated method to return attribute value
+        Returns the name of the unique index of product and attribute,
+        which is the one of the index of the constraint on PostgreSQL
         """
-        if self.attribute_type == 'selection':
-            return self.value_selection.name
-        if self.attribute_type == 'datetime':
-            # XXX: Localize to the timezone in context
-            return self.value_datetime.strftime("%Y-%m-%d %H:%M:%S")
-        if self.attribute_type == 'date':
-            return datetime.combine(self.value_date, time()). \
-                strftime("%Y-%m-%d")
-        else:
-            return unicode(getattr(self, 'value_' + self.attribute_type))
+        return '%s_product_attribute_uniq' % cls._table
+
+    @classmethod
+    def _create_unique_index(cls):
+        """
+        Create the unique index of product and attribute on SQLite where the
+        table handler can not add the constraint.
 
-    def get_attribute_set(self, name=None):
+        The index is not created while some products have several values of
+        the same attribute, like the constraint on PostgreSQL.
         """
-        Returns attribute set for corresponding product's template
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().connection.cursor()
+
+        index_name = cls._get_unique_index_name()
+        try:
+            cursor.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS "%s" ON "%s" '
+                '("product", "attribute")' % (index_name, cls._table)
+            )
+        except DatabaseIntegrityError:
+            logger.warning(
+                'Unable to add the unique index %s on table %s while some '
+                'products have several values of the same attribute',
+                index_name, cls._table
+            )
+
+    @classmethod
+    def _create_partial_value_index(cls, table, column):
         """
-        if self.product and self.product.template and \
-                self.product.template.attribute_set:
-            return self.product.template.attribute_set.id
+        Create an index on attribute, the value column and product
+        restricted to the rows having a value in this column, which are the
+        rows of the attributes of the matching type. As it covers the
+        product, the products having a value of an attribute are selected
+        with an index-only scan.
 
-    @fields.depends('product')
-    def on_change_product(self):
-        if self.product and self.product.template.attribute_set:
-            self.attribute_set = self.product.template.attribute_set.id
+        It is named like the composite index created by the table handler
+        so backends without partial indexes get an equivalent one.
+        """
+        index_name = '%s_attribute_%s_product_index' % (cls._table, column)
+        # PostgreSQL truncates the names to 63 characters
+        if set([index_name, index_name[:63]]) & set(table._indexes):
+            return
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            'CREATE INDEX "%s" ON "%s" ("attribute", "%s", "product") '
+            'WHERE "%s" IS NOT NULL' % (
+                index_name, cls._table, column, column
+            )
+        )
 
+    @classmethod
+    def _get_typed_table_name(cls, type_):
+        return '%s_%s' % (cls._table, type_)
 
-class Product:
-    "Product"
-    __name__ = 'product.product'
+    @classmethod
+    def _get_value_table_name(cls, type_):
+        """
+        Returns the name of the table storing the values of the type, which
+        is the table of the model unless the values are stored by type
+        """
+        if cls._value_storage == 'typed':
+            return cls._get_typed_table_name(type_)
+        return cls._table
 
-    attributes = fields.One2Many(
-        "product.product.attribute", "product", "Attributes",
-        domain=[(
-            'attribute.sets', '=',
-            Eval('_parent_template', {}).get('attribute_set',
-                Eval('attribute_set', -1)
+    @classmethod
+    def _get_value_table(cls, type_):
+        """
+        Returns the table storing the values of the type which has the id,
+        product, attribute and value column of the attribute values
+        """
+        return Table(cls._get_value_table_name(type_))
+
+    @classmethod
+    def _get_value_field(cls, type_):
+        """
+        Returns the field of the value column of the type
+        """
+        field = cls._fields['value_' + type_]
+        return getattr(field, '_field', field)
+
+    @classmethod
+    def _create_value_tables(cls):
+        """
+        Create the tables storing the values by type, keyed by the id of
+        their attribute value and repeating its product and attribute so
+        the values of an attribute are searched and counted without
+        joining the table of the model.
+        """
+        TableHandler = backend.get('TableHandler')
+        Option = Pool().get('product.attribute.selection_option')
+        cursor = Transaction().connection.cursor()
+
+        for type_, _ in ATTRIBUTE_TYPES:
+            table_name = cls._get_value_table_name(type_)
+            if TableHandler.table_exist(table_name):
+                continue
+            column = 'value_' + type_
+            references = ''
+            if type_ == 'selection':
+                references = ' REFERENCES "%s" ON DELETE RESTRICT' % (
+                    Option._table
+                )
+            cursor.execute(
+                'CREATE TABLE "%s" ("id" INTEGER PRIMARY KEY REFERENCES '
+                '"%s" ON DELETE CASCADE, "product" INTEGER NOT NULL, '
+                '"attribute" INTEGER NOT NULL, "%s" %s NOT NULL%s)' % (
+                    table_name, cls._table, column,
+                    cls._get_value_field(type_).sql_type().type, references
+                )
+            )
+            cursor.execute(
+                'CREATE INDEX "%s_value_index" ON "%s" '
+                '("attribute", "%s", "product")' % (
+                    table_name, table_name, column
+                )
+            )
+            cursor.execute(
+                'CREATE INDEX "%s_product_index" ON "%s" ("product")' % (
+                    table_name, table_name
+                )
             )
-        )], states={
-            'readonly': (
-                ~Eval('attribute_set')
-                & ~Eval('_parent_template', {}).get('attribute_set')
-            ),
-        }, depends=['attribute_set'], context={
-            'attribute_set': Eval('attribute_set')
-        }
-    )
 
-    attribute_set = fields.Function(
-        fields.Many2One('product.attribute.set', 'Set'),
-        'get_attribute_set',
-    )
+    @classmethod
+    def _migrate_to_value_tables(cls, table_handler):
+        """
+        Move the values of the value columns of the table of the model to
+        the tables storing them by type and drop the columns
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        types = [
+            t for t, _ in ATTRIBUTE_TYPES
+            if table_handler.column_exist('value_' + t)
+        ]
+        for type_ in types:
+            column_name = 'value_' + type_
+            value_table = cls._get_value_table(type_)
+            column = Column(table, column_name)
+            cursor.execute(*value_table.insert(
+                [value_table.id, value_table.product, value_table.attribute,
+                    Column(value_table, column_name)],
+                table.select(
+                    table.id, table.product, table.attribute, column,
+                    where=column != Null
+                )
+            ))
+            table_handler.drop_column(column_name)
+            if table_handler.column_exist(column_name):
+                # SQLite can not drop columns
+                cursor.execute(*table.update(
+                    [column], [Null], where=column != Null
+                ))
 
     @classmethod
-    def get_attribute_set(cls, products, name):
-        res = {}
-        attribute_set = Transaction().context.get('attribute_set')
-        for product in products:
-            if product.template and \
-                    getattr(product.template, "attribute_set", None):
-                attribute_set = product.template.attribute_set.id
-            res[product.id] = attribute_set
-        return res
+    def _migrate_from_value_tables(cls):
+        """
+        Move back the values of the tables storing them by type to the
+        value columns of the table of the model
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
 
-    @fields.depends('template')
-    def on_change_with_attribute_set(self, name=None):
-        Product = Pool().get("product.product")
+        for type_, _ in ATTRIBUTE_TYPES:
+            table_name = cls._get_typed_table_name(type_)
+            if not TableHandler.table_exist(table_name):
+                continue
+            value_table = Table(table_name)
+            column_name = 'value_' + type_
+            cursor.execute(*table.update(
+                [Column(table, column_name)],
+                value_table.select(
+                    Column(value_table, column_name),
+                    where=value_table.id == table.id
+                ),
+                where=table.id.in_(value_table.select(value_table.id))
+            ))
+
+    @classmethod
+    def _drop_value_tables(cls):
+        """
+        Drop the tables storing the values by type and the text table of
+        the char values
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+
+        for type_, _ in ATTRIBUTE_TYPES:
+            table_name = cls._get_typed_table_name(type_)
+            if not TableHandler.table_exist(table_name):
+                continue
+            if type_ == 'char':
+                cls._drop_text_table(table_name)
+            cursor.execute('DROP TABLE "%s"' % table_name)
+
+    @classmethod
+    def _create_trigram_index(cls):
+        """
+        Create a trigram index on the char values to search text in them
+        when the pg_trgm extension is installed in the database.
+        """
+        cursor = Transaction().connection.cursor()
+
+        table_name = cls._get_value_table_name('char')
+        index_name = '%s_value_char_trgm_index' % table_name
+        cursor.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )
+        if not cursor.fetchone():
+            return
+        cursor.execute(
+            'SELECT 1 FROM pg_indexes WHERE indexname = %s', (index_name,)
+        )
+        if cursor.fetchone():
+            return
+        cursor.execute(
+            'CREATE INDEX "%s" ON "%s" USING gin ("value_char" '
+            'gin_trgm_ops)' % (index_name, table_name)
+        )
+
+    @classmethod
+    def _get_text_table_name(cls):
+        return '%s_text' % cls._get_value_table_name('char')
+
+    @classmethod
+    def _text_table_exists(cls):
+        """
+        Returns True if the FTS5 table indexing the char values exists
+        """
+        if backend.name() != 'sqlite':  # pragma: no cover
+            return False
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (cls._get_text_table_name(),)
+        )
+        return bool(cursor.fetchone())
+
+    @classmethod
+    def _create_text_table(cls):
+        """
+        Create a FTS5 table with the trigram tokenizer indexing the char
+        values, kept up to date by triggers so the values inserted with raw
+        queries are indexed too.
+
+        Nothing is created if SQLite is built without FTS5 or is older
+        than 3.34 which added the trigram tokenizer.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        cursor = Transaction().connection.cursor()
+
+        if cls._text_table_exists():
+            return
+        text_table = cls._get_text_table_name()
+        content_table = cls._get_value_table_name('char')
+        try:
+            cursor.execute(
+                'CREATE VIRTUAL TABLE "%s" USING fts5("value_char", '
+                'content="%s", content_rowid="id", tokenize="trigram")' % (
+                    text_table, content_table
+                )
+            )
+        except DatabaseOperationalError:
+            return
+        insert = (
+            'INSERT INTO "%s" (rowid, "value_char") '
+            'VALUES (new."id", new."value_char");' % text_table
+        )
+        delete = (
+            'INSERT INTO "%s" ("%s", rowid, "value_char") '
+            'VALUES (\'delete\', old."id", old."value_char");' % (
+                text_table, text_table
+            )
+        )
+        for name, event, statements in [
+                ('insert', 'INSERT', insert),
+                ('delete', 'DELETE', delete),
+                ('update', 'UPDATE OF "value_char"', delete + insert),
+                ]:
+            cursor.execute(
+                'CREATE TRIGGER "%s_%s" AFTER %s ON "%s" BEGIN %s END' % (
+                    text_table, name, event, content_table, statements
+                )
+            )
+        cursor.execute(
+            'INSERT INTO "%s" ("%s") VALUES (\'rebuild\')' % (
+                text_table, text_table
+            )
+        )
+
+    @staticmethod
+    def _drop_text_table(content_table):
+        """
+        Drop the FTS5 table indexing the char values of the content table
+        and its triggers
+        """
+        if backend.name() != 'sqlite':  # pragma: no cover
+            return
+        cursor = Transaction().connection.cursor()
+        text_table = '%s_text' % content_table
+        for name in ['insert', 'delete', 'update']:
+            cursor.execute(
+                'DROP TRIGGER IF EXISTS "%s_%s"' % (text_table, name)
+            )
+        cursor.execute('DROP TABLE IF EXISTS "%s"' % text_table)
+
+    @classmethod
+    def create(cls, vlist):
+        Product = Pool().get('product.product')
+
+        with cls._buffer_stored_values():
+            attribute_values = super(ProductProductAttribute, cls).create(
+                vlist
+            )
+        usages = cls._get_value_usages(attribute_values)
+        Product.update_attribute_signatures(set(u[0] for u in usages))
+        cls._update_usage_counts(added=[u[1:] for u in usages])
+        return attribute_values
+
+    @classmethod
+    def write(cls, *args):
+        Product = Pool().get('product.product')
+
+        attribute_values = sum(args[0:None:2], [])
+        removed = cls._get_value_usages(attribute_values)
+        with cls._buffer_stored_values():
+            super(ProductProductAttribute, cls).write(*args)
+        cls._update_value_keys(sum([
+            records for records, values in zip(args[0::2], args[1::2])
+            if set(values) & set(['product', 'attribute'])
+        ], []))
+        added = cls._get_value_usages(attribute_values)
+        Product.update_attribute_signatures(
+            set(u[0] for u in removed + added)
+        )
+        cls._update_usage_counts(
+            added=[u[1:] for u in added], removed=[u[1:] for u in removed]
+        )
+
+    @classmethod
+    def delete(cls, attribute_values):
+        Product = Pool().get('product.product')
+
+        usages = cls._get_value_usages(attribute_values)
+        super(ProductProductAttribute, cls).delete(attribute_values)
+        Product.update_attribute_signatures(set(u[0] for u in usages))
+        cls._update_usage_counts(removed=[u[1:] for u in usages])
+
+    @classmethod
+    def copy(cls, attribute_values, default=None):
+        if cls._value_storage != 'typed':
+            return super(ProductProductAttribute, cls).copy(
+                attribute_values, default=default
+            )
+        # The values stored by type are Function fields which are not
+        # copied
+        names = ['product', 'attribute'] + [
+            'value_' + t for t, _ in ATTRIBUTE_TYPES
+        ]
+        ids = map(int, attribute_values)
+        datas = dict((d.pop('id'), d) for d in cls.read(ids, names))
+        for data in datas.itervalues():
+            data.update(default or {})
+        return cls.create([datas[id_] for id_ in ids])
+
+    @classmethod
+    def get_stored_values(cls, attribute_values, names):
+        """
+        Returns the values of the value fields stored by type with one
+        query per slice of attribute values
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        from_, columns = cls._get_value_from(
+            table, [n[len('value_'):] for n in names]
+        )
+        result = dict((n, {}) for n in names)
+        for sub_ids in grouped_slice(map(int, attribute_values)):
+            cursor.execute(*from_.select(
+                table.id, *columns, where=reduce_ids(table.id, sub_ids)
+            ))
+            for row in cursor.fetchall():
+                for name, value in zip(names, row[1:]):
+                    result[name][row[0]] = value
+        if 'value_boolean' in result:
+            # SQLite returns booleans as integers
+            result['value_boolean'] = dict(
+                (i, v if v is None else bool(v))
+                for i, v in result['value_boolean'].iteritems()
+            )
+        return result
+
+    @classmethod
+    def set_stored_value(cls, attribute_values, name, value):
+        type_ = name[len('value_'):]
+        values = dict.fromkeys(
+            map(int, attribute_values),
+            cls._get_value_field(type_).sql_format(value)
+        )
+        buffer = Transaction().context.get('_stored_values')
+        if buffer is None:
+            cls._set_stored_values(type_, values)
+        else:
+            buffer[type_].update(values)
+
+    @classmethod
+    @contextmanager
+    def _buffer_stored_values(cls):
+        """
+        Buffer the values stored by type that the ORM sets with one call of
+        set_stored_value per distinct value while in the context and write
+        them with one call of _set_stored_values per type before the
+        validation or at the end of the context
+        """
+        context = Transaction().context
+        if (cls._value_storage != 'typed'
+                or context.get('_stored_values') is not None):
+            yield
+            return
+        with Transaction().set_context(_stored_values=defaultdict(dict)):
+            yield
+            cls._flush_stored_values()
+
+    @classmethod
+    def _flush_stored_values(cls):
+        """
+        Write the values buffered by _buffer_stored_values
+        """
+        buffer = Transaction().context.get('_stored_values') or {}
+        for type_ in sorted(buffer):
+            cls._set_stored_values(type_, buffer.pop(type_))
+
+    @classmethod
+    def search_stored_value(cls, name, clause):
+        table = cls.__table__()
+
+        # The name of the clause includes the path of Many2One searches
+        type_ = name.split('.', 1)[0][len('value_'):]
+        value_table = cls._get_value_table(type_)
+        tables = {None: (value_table, value_table.id == table.id)}
+        where = cls._get_value_field(type_).convert_domain(clause, tables, cls)
+        return [('id', 'in', convert_from(table, tables).select(
+            table.id, where=where
+        ))]
+
+    @classmethod
+    def _set_stored_values(cls, type_, values):
+        """
+        Set the values of the type of the attribute values from the
+        dictionary mapping their id to the SQL value, removing the None
+        values, with two queries per slice
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        value_table = cls._get_value_table(type_)
+
+        for sub_ids in grouped_slice(sorted(values)):
+            sub_ids = list(sub_ids)
+            cursor.execute(*value_table.delete(
+                where=reduce_ids(value_table.id, sub_ids)
+            ))
+            sub_ids = [i for i in sub_ids if values[i] is not None]
+            if not sub_ids:
+                continue
+            cursor.execute(*value_table.insert(
+                [value_table.id, value_table.product, value_table.attribute,
+                    Column(value_table, 'value_' + type_)],
+                table.select(
+                    table.id, table.product, table.attribute,
+                    Case(*[(table.id == i, values[i]) for i in sub_ids]),
+                    where=reduce_ids(table.id, sub_ids)
+                )
+            ))
+
+    @classmethod
+    def _insert_stored_values(cls, values):
+        """
+        Insert in the tables storing the values by type the values of the
+        attribute values inserted without them, given like to _insert_values
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        values = dict(((v[0], v[1]), v[2:]) for v in values)
+        attribute_ids = sorted(set(a for _, a in values))
+        rows = []
+        for sub_ids in grouped_slice(sorted(set(p for p, _ in values))):
+            cursor.execute(*table.select(
+                table.id, table.product, table.attribute,
+                where=reduce_ids(table.product, sub_ids)
+                & reduce_ids(table.attribute, attribute_ids)
+            ))
+            rows.extend(r for r in cursor.fetchall() if r[1:] in values)
+        for i, (type_, _) in enumerate(ATTRIBUTE_TYPES):
+            value_table = cls._get_value_table(type_)
+            inserts = [
+                list(r) + [values[r[1:]][i]] for r in rows
+                if values[r[1:]][i] is not None
+            ]
+            if inserts:
+                cursor.execute(*value_table.insert(
+                    [value_table.id, value_table.product,
+                        value_table.attribute,
+                        Column(value_table, 'value_' + type_)],
+                    inserts
+                ))
+
+    @classmethod
+    def _update_value_keys(cls, ids):
+        """
+        Copy the product and the attribute of the attribute values to the
+        tables storing their values by type
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        if cls._value_storage != 'typed':
+            return
+        for type_, _ in ATTRIBUTE_TYPES:
+            value_table = cls._get_value_table(type_)
+            for sub_ids in grouped_slice(map(int, ids)):
+                cursor.execute(*value_table.update(
+                    [value_table.product, value_table.attribute], [
+                        table.select(
+                            table.product, where=table.id == value_table.id
+                        ),
+                        table.select(
+                            table.attribute, where=table.id == value_table.id
+                        ),
+                    ], where=reduce_ids(value_table.id, sub_ids)
+                ))
+
+    @classmethod
+    def _join_value_table(cls, from_, table, type_):
+        """
+        Returns from_ joined to the table storing the values of the type of
+        the attribute values of table, and this table which is table when
+        the values are stored in it
+        """
+        if cls._value_storage != 'typed':
+            return from_, table
+        value_table = cls._get_value_table(type_)
+        return from_.join(
+            value_table, 'LEFT', condition=value_table.id == table.id
+        ), value_table
+
+    @classmethod
+    def _get_value_usages(cls, ids):
+        """
+        Returns the list of the product id, the attribute id and the option
+        id of the attribute values
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        from_, value_table = cls._join_value_table(table, table, 'selection')
+
+        usages = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*from_.select(
+                table.product, table.attribute, value_table.value_selection,
+                where=reduce_ids(table.id, sub_ids)
+            ))
+            usages.extend(cursor.fetchall())
+        return usages
+
+    @classmethod
+    def _update_usage_counts(cls, added=(), removed=()):
+        """
+        Update the usage counters of the attributes and the options from
+        the (attribute id, option id) of the attribute values added and
+        removed.
+
+        The counters are left to recompute_usage_counts of the attributes
+        when they are deferred (see _usage_counts_deferred).
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        Option = pool.get('product.attribute.selection_option')
+
+        if cls._usage_counts_deferred():
+            return
+        attributes, options = Counter(), Counter()
+        for sign, usages in [(1, added), (-1, removed)]:
+            for attribute_id, option_id in usages:
+                attributes[attribute_id] += sign
+                options[option_id] += sign
+        options.pop(None, None)
+        cls._add_usage_counts(Attribute, attributes)
+        cls._add_usage_counts(Option, options)
+
+    @staticmethod
+    def _usage_counts_deferred():
+        """
+        Return True when the writes of the attribute values leave the usage
+        counters to recompute_usage_counts of the attributes, when the
+        context has _defer_usage_counts or the usage_counts option of the
+        configuration is deferred.
+
+        Every write of an attribute value updates the shared row of its
+        attribute, so concurrent transactions writing values of the same
+        attribute wait on each other and fail to serialize under repeatable
+        read.
+        """
+        return bool(
+            Transaction().context.get('_defer_usage_counts')
+            or config.get(
+                'product_attribute_strict', 'usage_counts',
+                default='immediate'
+            ) == 'deferred'
+        )
+
+    @classmethod
+    def _add_usage_counts(cls, Model, deltas):
+        """
+        Add the deltas by id to the usage counters of the records of Model
+        with one query per slice
+        """
+        cursor = Transaction().connection.cursor()
+        table = Model.__table__()
+
+        ids = sorted(id_ for id_, delta in deltas.iteritems() if delta)
+        cls._invalidate_records(Model, ids, 'usage_count')
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.update(
+                [table.usage_count],
+                [table.usage_count + Case(*[
+                    (table.id == id_, deltas[id_]) for id_ in sub_ids
+                ])],
+                where=reduce_ids(table.id, sub_ids)
+            ))
+
+    @classmethod
+    def _set_usage_counts(cls, Model, column, ids=None):
+        """
+        Set the usage counters of the records of Model, all of them by
+        default, to the number of attribute values referencing them by
+        column
+        """
+        cursor = Transaction().connection.cursor()
+        table = Model.__table__()
+        if column.startswith('value_'):
+            value = cls._get_value_table(column[len('value_'):])
+        else:
+            value = cls.__table__()
+
+        count = value.select(
+            Count(Literal(1)), where=getattr(value, column) == table.id
+        )
+        if ids is None:
+            cursor.execute(*table.update([table.usage_count], [count]))
+            cls._invalidate_records(Model, None, 'usage_count')
+            return
+        cls._invalidate_records(Model, ids, 'usage_count')
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.update(
+                [table.usage_count], [count],
+                where=reduce_ids(table.id, sub_ids)
+            ))
+
+    @classmethod
+    def import_values(cls, rows, batch_size=1000):
+        """
+        Import attribute values from an iterable of (product code,
+        attribute name, raw value) tuples.
+
+        Attributes and their options are loaded once. The products are
+        resolved and the values inserted with one query each per batch of
+        rows, bypassing the validation of create, and the attributes are
+        checked against the cached attributes of the product sets. Raw
+        values are parsed by the type of the attribute and selection values
+        are option names. The attribute and option names are in the context
+        language. A row for an attribute the product already has a value
+        of, stored or imported by a previous row, is rejected.
+
+        Returns the list of (row number, error message) of the rejected
+        rows.
+        """
+        attributes = cls._get_import_attributes()
+        errors = []
+        batch = []
+        for number, row in enumerate(rows, 1):
+            batch.append((number, row))
+            if len(batch) >= batch_size:
+                errors.extend(cls._import_batch(batch, attributes))
+                batch = []
+        errors.extend(cls._import_batch(batch, attributes))
+        return errors
+
+    @classmethod
+    def _get_import_attributes(cls):
+        """
+        Returns a dictionary mapping attribute names to a dictionary with
+        the id, type and option ids by name of the attribute.
+
+        The names are in the context language, like the attribute metadata
+        they come from, so the dictionaries of the attributes_dict field of
+        products and the exports can be written back.
+        """
+        Attribute = Pool().get('product.attribute')
+        cursor = Transaction().connection.cursor()
+        attribute = Attribute.__table__()
+
+        cursor.execute(*attribute.select(attribute.id))
+        return dict(
+            (metadata['name'], {
+                'id': id_,
+                'type': metadata['type_'],
+                'options': dict(
+                    (name, option_id)
+                    for option_id, name in metadata['options'].iteritems()
+                ),
+            }) for id_, metadata in Attribute.get_metadata(
+                [id_ for id_, in cursor.fetchall()]
+            ).iteritems()
+        )
+
+    @classmethod
+    def _import_batch(cls, batch, attributes):
+        """
+        Insert the valid rows of the batch and return the errors of the
+        others
+        """
+        pool = Pool()
+        AttributeSet = pool.get('product.attribute.set')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        cursor = Transaction().connection.cursor()
+
+        product = Product.__table__()
+        template = Template.__table__()
+
+        if not batch:
+            return []
+        cursor.execute(*product.join(
+            template, condition=template.id == product.template
+        ).select(
+            product.code, product.id, template.attribute_set,
+            where=product.code.in_(list(set(r[0] for _, r in batch)))
+        ))
+        rows = cursor.fetchall()
+        set_attributes = AttributeSet.get_attribute_ids(
+            [set_id for _, _, set_id in rows if set_id is not None]
+        )
+        products = dict(
+            (code, (id_, set_attributes.get(set_id, frozenset())))
+            for code, id_, set_id in rows
+        )
+        existing = set(cls._get_existing_values(
+            [id_ for _, id_, _ in rows],
+            [attributes[r[1]]['id'] for _, r in batch if r[1] in attributes]
+        ))
+
+        values = []
+        errors = []
+        for number, row in batch:
+            value, error = cls._get_import_value(
+                row, products, attributes, existing)
+            if error:
+                errors.append((number, error))
+            else:
+                existing.add(tuple(value[:2]))
+                values.append(value)
+        if values:
+            cls._insert_values(values)
+            Product.update_attribute_signatures([v[0] for v in values])
+        return errors
+
+    @classmethod
+    def _insert_values(cls, values):
+        """
+        Insert with one query the attribute values given as lists of the
+        product id, the attribute id and the value of each typed column and
+        update the usage counters
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+        columns = [
+            table.create_uid, table.create_date, table.product,
+            table.attribute,
+        ]
+        if cls._value_storage == 'typed':
+            cursor.execute(*table.insert(columns, [
+                [transaction.user, CurrentTimestamp()] + value[:2]
+                for value in values
+            ]))
+            cls._insert_stored_values(values)
+        else:
+            columns += [getattr(table, 'value_' + t) for t in types]
+            cursor.execute(*table.insert(columns, [
+                [transaction.user, CurrentTimestamp()] + value
+                for value in values
+            ]))
+        option = 2 + types.index('selection')
+        cls._update_usage_counts(added=[(v[1], v[option]) for v in values])
+
+    @classmethod
+    def _get_import_value(cls, row, products, attributes, existing):
+        """
+        Returns the column values to insert for the row and the error
+        message if it is not valid or if the (product id, attribute id) is
+        in existing
+        """
+        code, name, raw_value = row
+        args = {'product': code, 'attribute': name, 'value': raw_value}
+        if code not in products:
+            return None, cls.raise_user_error(
+                'unknown_product', args, raise_exception=False)
+        if name not in attributes:
+            return None, cls.raise_user_error(
+                'unknown_attribute', args, raise_exception=False)
+        product_id, attribute_ids = products[code]
+        attribute = attributes[name]
+        if attribute['id'] not in attribute_ids:
+            return None, cls.raise_user_error(
+                'attribute_not_in_set', args, raise_exception=False)
+        if (product_id, attribute['id']) in existing:
+            return None, cls.raise_user_error(
+                'duplicate_value', args, raise_exception=False)
+        return cls._convert_import_value(product_id, attribute, args)
+
+    @classmethod
+    def _convert_import_value(cls, product_id, attribute, args):
+        type_ = attribute['type']
+        try:
+            value = cls._parse_import_value(attribute, args['value'])
+        except KeyError:
+            return None, cls.raise_user_error(
+                'unknown_option', args, raise_exception=False)
+        except ValueError:
+            args['type'] = type_
+            return None, cls.raise_user_error(
+                'invalid_value', args, raise_exception=False)
+        return [product_id, attribute['id']] + [
+            value if t == type_ else None for t, _ in ATTRIBUTE_TYPES
+        ], None
+
+    @classmethod
+    def _parse_import_value(cls, attribute, raw_value):
+        """
+        Returns the SQL value of the raw value for the attribute. Raises
+        KeyError for unknown options and ValueError for invalid values.
+        """
+        type_ = attribute['type']
+        if raw_value is None:
+            raise ValueError('Missing value')
+        if type_ == 'selection':
+            return attribute['options'][raw_value]
+        return cls._fields['value_' + type_].sql_format(
+            cls.parse_value(type_, raw_value))
+
+    @classmethod
+    def set_attributes(cls, products, values, batch_size=1000):
+        """
+        Set the values of the attributes on the products, inserting the
+        missing values and updating the existing ones. The other attributes
+        of the products are left unchanged.
+
+        values is a dictionary mapping attributes (or their ids) to the
+        typed value, or to the option (or its id) for selection
+        attributes. String values are parsed like parse_value does.
+
+        The values and the attribute sets of the products are checked
+        before writing anything. Each batch of products is then written
+        with a single INSERT ... ON CONFLICT statement on the unique index
+        of product and attribute where the backend supports it and the
+        values are not stored by type, or with one UPDATE per attribute and
+        one INSERT otherwise.
+        """
+        Product = Pool().get('product.product')
+
+        columns = cls._get_set_attributes_columns(values)
+        product_ids = sorted(set(map(int, products)))
+        option = [t for t, _ in ATTRIBUTE_TYPES].index('selection')
+        # The values stored by type are not in the table of the unique index
+        upsert = cls._value_storage != 'typed' and cls._upsert_supported()
+        for sub_ids in grouped_slice(product_ids, batch_size):
+            sub_ids = list(sub_ids)
+            cls._check_set_attributes(dict.fromkeys(sub_ids, columns.keys()))
+            existing = cls._get_existing_values(sub_ids, columns.keys())
+            cls._invalidate_values([i for i, _ in existing.itervalues()])
+            if upsert:
+                cls._upsert_attributes(sub_ids, columns)
+                written = [(p, a) for p in sub_ids for a in columns]
+            else:
+                # The inserted values are counted by _insert_values
+                cls._update_insert_attributes(sub_ids, columns, existing)
+                written = existing.keys()
+            cls._update_usage_counts(
+                added=[(a, columns[a][option]) for _, a in written],
+                removed=[(a, o) for (_, a), (_, o) in existing.iteritems()]
+            )
+            Product.update_attribute_signatures(sub_ids)
+
+    @classmethod
+    def _get_existing_values(cls, product_ids, attribute_ids):
+        """
+        Returns a dictionary mapping the (product id, attribute id) of the
+        existing values of the attributes on the products to their id and
+        option id
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        from_, value_table = cls._join_value_table(table, table, 'selection')
+
+        if not product_ids or not attribute_ids:
+            return {}
+        cursor.execute(*from_.select(
+            table.product, table.attribute, table.id,
+            value_table.value_selection,
+            where=reduce_ids(table.product, product_ids)
+            & reduce_ids(table.attribute, attribute_ids)
+        ))
+        return dict(((p, a), (i, o)) for p, a, i, o in cursor.fetchall())
+
+    @classmethod
+    def replace_attributes(cls, values, batch_size=1000):
+        """
+        Replace the attribute values of the products by the values of their
+        dictionary, writing only the differences with the stored values.
+
+        values maps the products (or their ids) to a dictionary of values
+        by attribute name, typed like the attributes_dict field of the
+        products or raw like import_values takes them. The attributes
+        missing from the dictionary of a product, or with a None value, are
+        removed from the product.
+
+        For each batch of products, the attributes are checked against the
+        attribute sets, the stored values are read with one query and the
+        changes are written with one DELETE, one INSERT and one UPDATE per
+        attribute type at most.
+        """
+        Product = Pool().get('product.product')
+
+        attributes = cls._get_import_attributes()
+        values = dict((int(p), v) for p, v in values.iteritems())
+        for sub_ids in grouped_slice(sorted(values), batch_size):
+            new_values = dict(
+                (product_id, cls._get_dict_values(
+                    values[product_id], attributes
+                )) for product_id in sub_ids
+            )
+            cls._check_set_attributes(new_values)
+            Product.update_attribute_signatures(
+                cls._replace_values(new_values)
+            )
+
+    @classmethod
+    def _get_dict_values(cls, values, attributes):
+        """
+        Returns a dictionary mapping the attribute ids to the type and the
+        SQL value of the values given by attribute name
+        """
+        return dict(
+            cls._get_dict_value(name, value, attributes)
+            for name, value in values.iteritems() if value is not None
+        )
+
+    @classmethod
+    def _get_dict_value(cls, name, value, attributes):
+        args = {'attribute': name, 'value': value}
+        if name not in attributes:
+            cls.raise_user_error('unknown_attribute', args)
+        attribute = attributes[name]
+        try:
+            sql_value = cls._parse_import_value(attribute, value)
+        except KeyError:
+            cls.raise_user_error('unknown_option', args)
+        except ValueError:
+            args['type'] = attribute['type']
+            cls.raise_user_error('invalid_value', args)
+        return attribute['id'], (attribute['type'], sql_value)
+
+    @classmethod
+    def _replace_values(cls, new_values):
+        """
+        Write the differences between the new values, as returned by
+        _get_dict_values for each product id, and the stored values of the
+        products and returns the ids of the products changed
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+
+        from_, columns = cls._get_typed_value_from(table)
+        cursor.execute(*from_.select(
+            table.id, table.product, *columns,
+            where=reduce_ids(table.product, new_values.keys())
+        ))
+        rows = cursor.fetchall()
+        inserts, deletes, updates, changed = cls._diff_values(
+            rows, new_values
+        )
+
+        cls._invalidate_values(
+            deletes + [id_ for u in updates.values() for id_, _ in u]
+        )
+        cls._delete_values(deletes)
+        for type_, type_updates in updates.iteritems():
+            cls._update_values(type_, type_updates)
+        cls._update_replaced_usage_counts(
+            rows, deletes, updates.get('selection', [])
+        )
+        if inserts:
+            cls._insert_values([
+                list(key) + [v if t == type_ else None for t in types]
+                for key, (type_, v) in inserts.iteritems()
+            ])
+        return changed
+
+    @classmethod
+    def _update_replaced_usage_counts(cls, rows, deletes, updates):
+        """
+        Update the usage counters for the deleted values and the (id,
+        option id) updates of the selection values from the stored rows
+        """
+        option = 3 + [t for t, _ in ATTRIBUTE_TYPES].index('selection')
+        usages = dict((row[0], (row[2], row[option])) for row in rows)
+        cls._update_usage_counts(
+            added=[(usages[id_][0], o) for id_, o in updates],
+            removed=[usages[id_] for id_ in deletes]
+            + [usages[id_] for id_, _ in updates]
+        )
+
+    @staticmethod
+    def _diff_values(rows, new_values):
+        """
+        Returns the values to insert by (product id, attribute id), the ids
+        of the values to delete, the (id, SQL value) to update by type and
+        the ids of the products changed from the stored rows selected with
+        the id, the product and the columns of _get_typed_value_from
+        """
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+        inserts = dict(
+            ((p, a), v) for p, values in new_values.iteritems()
+            for a, v in values.iteritems()
+        )
+        deletes, updates, changed = [], defaultdict(list), set()
+        for row in rows:
+            id_, product_id, attribute_id = row[:3]
+            new = inserts.pop((product_id, attribute_id), None)
+            if new is None:
+                deletes.append(id_)
+                changed.add(product_id)
+                continue
+            type_, value = new
+            old = row[3 + types.index(type_)]
+            format_ = SIGNATURE_FORMATS[type_]
+            if old is None or format_(old) != format_(value):
+                updates[type_].append((id_, value))
+                changed.add(product_id)
+        changed.update(p for p, _ in inserts)
+        return inserts, deletes, updates, changed
+
+    @classmethod
+    def _invalidate_values(cls, ids):
+        """
+        Like write, invalidate the cached records of the attribute values
+        modified with raw queries
+        """
+        cls._invalidate_records(cls, ids)
+
+    @staticmethod
+    def _invalidate_records(Model, ids, name=None):
+        """
+        Invalidate the cached records of Model with the ids, all of them if
+        ids is None, or only their field name if it is given
+        """
+        transaction = Transaction()
+        transaction.counter += 1
+        caches = [
+            c[Model.__name__] for c in transaction.cache.itervalues()
+            if Model.__name__ in c
+        ]
+        for cache in caches:
+            for id_ in (cache.keys() if ids is None else ids):
+                if name is None:
+                    cache.pop(id_, None)
+                else:
+                    cache.get(id_, {}).pop(name, None)
+
+    @classmethod
+    def _delete_values(cls, ids):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.delete(where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def _update_values(cls, type_, updates):
+        """
+        Set the value column of the type of the attribute values from the
+        list of (id, SQL value) with one query per slice
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        if cls._value_storage == 'typed':
+            for sub_updates in grouped_slice(updates):
+                cursor.execute(*table.update(
+                    [table.write_uid, table.write_date],
+                    [transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(table.id, [i for i, _ in sub_updates])
+                ))
+            cls._set_stored_values(type_, dict(updates))
+            return
+        column = getattr(table, 'value_' + type_)
+        for sub_updates in grouped_slice(updates):
+            sub_updates = list(sub_updates)
+            cursor.execute(*table.update(
+                [table.write_uid, table.write_date, column],
+                [transaction.user, CurrentTimestamp(), Case(*[
+                    (table.id == id_, value) for id_, value in sub_updates
+                ])],
+                where=reduce_ids(table.id, [i for i, _ in sub_updates])
+            ))
+
+    @classmethod
+    def _get_set_attributes_columns(cls, values):
+        """
+        Returns a dictionary mapping the attribute ids to the SQL values of
+        the typed value columns
+        """
+        Attribute = Pool().get('product.attribute')
+
+        values = dict((int(a), v) for a, v in values.iteritems())
+        metadata = Attribute.get_metadata(values.keys())
+        return dict(
+            (attribute_id, cls._get_set_attribute_columns(
+                metadata[attribute_id], value
+            )) for attribute_id, value in values.iteritems()
+        )
+
+    @classmethod
+    def _get_set_attribute_columns(cls, attribute, value):
+        type_ = attribute['type_']
+        args = {'attribute': attribute['name'], 'value': value, 'type': type_}
+        try:
+            value = cls._format_set_attribute_value(attribute, value)
+        except KeyError:
+            cls.raise_user_error('unknown_option', args)
+        except ValueError:
+            cls.raise_user_error('invalid_value', args)
+        return [value if t == type_ else None for t, _ in ATTRIBUTE_TYPES]
+
+    @classmethod
+    def _format_set_attribute_value(cls, attribute, value):
+        """
+        Returns the SQL value of the value for the attribute. Raises
+        KeyError for unknown options and ValueError for invalid values.
+        """
+        type_ = attribute['type_']
+        if value is None:
+            raise ValueError('Missing value')
+        if type_ == 'selection':
+            if int(value) not in attribute['options']:
+                raise KeyError(value)
+            return int(value)
+        if isinstance(value, basestring):
+            value = cls.parse_value(type_, value)
+        return cls._fields['value_' + type_].sql_format(value)
+
+    @classmethod
+    def _check_set_attributes(cls, product_attributes):
+        """
+        Check that the products given as a dictionary mapping the product
+        ids to the attribute ids exist and that the attributes are in their
+        attribute set and report all the invalid pairs at once
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        AttributeSet = pool.get('product.attribute.set')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        cursor = Transaction().connection.cursor()
+
+        product = Product.__table__()
+        template = Template.__table__()
+
+        cursor.execute(*product.join(
+            template, condition=template.id == product.template
+        ).select(
+            product.id, template.attribute_set,
+            where=reduce_ids(product.id, product_attributes.keys())
+        ))
+        product_sets = cursor.fetchall()
+        missing = set(product_attributes) - set(p for p, _ in product_sets)
+        if missing:
+            cls.raise_user_error('unknown_product_ids', {
+                'products': ', '.join(map(str, sorted(missing))),
+            })
+        set_attributes = AttributeSet.get_attribute_ids(
+            [set_id for _, set_id in product_sets if set_id is not None]
+        )
+        invalid = [
+            (product_id, attribute_id)
+            for product_id, set_id in product_sets
+            for attribute_id in product_attributes[product_id]
+            if attribute_id not in set_attributes.get(set_id, ())
+        ]
+        if invalid:
+            cls.raise_user_error('invalid_attribute_sets', {
+                'values': '\n'.join(
+                    '%s: %s' % (
+                        Product(product_id).rec_name,
+                        Attribute(attribute_id).rec_name
+                    ) for product_id, attribute_id in invalid
+                ),
+            })
+
+    @classmethod
+    def _upsert_supported(cls):
+        """
+        Returns True if the backend supports INSERT ... ON CONFLICT and the
+        unique index of product and attribute exists, which is not the
+        case when the table had duplicates when the module was updated.
+        """
+        connection = Transaction().connection
+        cursor = connection.cursor()
+
+        index_name = cls._get_unique_index_name()
+        if backend.name() == 'postgresql':  # pragma: no cover
+            if connection.server_version < 90500:
+                return False
+            cursor.execute(
+                'SELECT 1 FROM pg_indexes WHERE tablename = %s '
+                'AND indexname = %s', (cls._table, index_name)
+            )
+        elif backend.name() == 'sqlite':
+            if cls._get_sqlite_version() < (3, 24):  # pragma: no cover
+                return False
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = ? AND name = ?", (cls._table, index_name)
+            )
+        else:  # pragma: no cover
+            return False
+        return bool(cursor.fetchone())
+
+    @classmethod
+    def _upsert_attributes(cls, product_ids, columns):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        value_columns = [
+            getattr(table, 'value_' + t) for t, _ in ATTRIBUTE_TYPES
+        ]
+        query, params = tuple(table.insert(
+            [table.create_uid, table.create_date, table.product,
+                table.attribute] + value_columns,
+            [
+                [transaction.user, CurrentTimestamp(), product_id,
+                    attribute_id] + values
+                for product_id in product_ids
+                for attribute_id, values in columns.iteritems()
+            ]
+        ))
+        updates = [
+            '"write_uid" = EXCLUDED."create_uid"',
+            '"write_date" = EXCLUDED."create_date"',
+        ] + ['"%s" = EXCLUDED."%s"' % (c.name, c.name) for c in value_columns]
+        cursor.execute(
+            query + ' ON CONFLICT ("product", "attribute") DO UPDATE SET '
+            + ', '.join(updates), params
+        )
+
+    @classmethod
+    def _update_insert_attributes(cls, product_ids, columns, existing):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        value_columns = [
+            getattr(table, 'value_' + t) for t, _ in ATTRIBUTE_TYPES
+        ]
+        for attribute_id, values in columns.iteritems():
+            update_ids = [
+                p for p in product_ids if (p, attribute_id) in existing
+            ]
+            if update_ids and cls._value_storage == 'typed':
+                type_, value = next(
+                    (t, v) for (t, _), v in zip(ATTRIBUTE_TYPES, values)
+                    if v is not None
+                )
+                cls._update_values(type_, [
+                    (existing[(p, attribute_id)][0], value)
+                    for p in update_ids
+                ])
+            elif update_ids:
+                cursor.execute(*table.update(
+                    [table.write_uid, table.write_date] + value_columns,
+                    [transaction.user, CurrentTimestamp()] + values,
+                    where=reduce_ids(table.product, update_ids)
+                    & (table.attribute == attribute_id)
+                ))
+
+        inserts = [
+            [product_id, attribute_id] + values
+            for product_id in product_ids
+            for attribute_id, values in columns.iteritems()
+            if (product_id, attribute_id) not in existing
+        ]
+        if inserts:
+            cls._insert_values(inserts)
+
+    @fields.depends('attribute')
+    def on_change_attribute(self):
+        Attribute = Pool().get('product.attribute')
+
+        self.attribute_type = None
+        if self.attribute:
+            self.attribute_type = Attribute.get_metadata(
+                [self.attribute.id]
+            )[self.attribute.id]['type_']
+
+    @classmethod
+    def get_attribute_info(cls, attribute_values, names):
+        """
+        Returns the type of attribute and the attribute set of the
+        product's template.
+
+        Both are fetched for the whole batch with a single query joining
+        the attribute values to their product and template, the types come
+        from the attribute metadata cache.
+        """
+        Attribute = Pool().get('product.attribute')
+
+        rows = cls._get_attribute_sets(attribute_values)
+        metadata = Attribute.get_metadata([r[1] for r in rows])
+        values = {}
+        for id_, attribute_id, attribute_set, _ in rows:
+            values[id_] = {
+                'attribute_type': metadata[attribute_id]['type_'],
+                'attribute_set': attribute_set,
+            }
+
+        return dict(
+            (name, dict(
+                (a.id, values.get(a.id, {}).get(name))
+                for a in attribute_values
+            )) for name in names
+        )
+
+    @classmethod
+    def _get_attribute_sets(cls, ids):
+        """
+        Returns the list of (id, attribute id, attribute set id, product
+        id) of the attribute values with one query per slice of ids
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        cursor = Transaction().connection.cursor()
+
+        table = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+
+        rows = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*table.join(
+                product, condition=product.id == table.product
+            ).join(
+                template, condition=template.id == product.template
+            ).select(
+                table.id, table.attribute, template.attribute_set,
+                table.product, where=reduce_ids(table.id, sub_ids)
+            ))
+            rows.extend(cursor.fetchall())
+        return rows
+
+    @classmethod
+    def _validate(cls, records, field_names=None):
+        cls._flush_stored_values()
+        with Transaction().set_context(
+                _attribute_set_checked=True, _selection_option_checked=True):
+            super(ProductProductAttribute, cls)._validate(
+                records, field_names
+            )
+
+    @classmethod
+    def validate(cls, attribute_values):
+        super(ProductProductAttribute, cls).validate(attribute_values)
+        cls.check_attribute_sets(attribute_values)
+        cls.check_selection_options(attribute_values)
+
+    @classmethod
+    def check_attribute_sets(cls, attribute_values, product_sets=None):
+        """
+        Check that the attributes are in the attribute set of the product
+        of the values and report all the invalid values at once. Like the
+        domain of the attribute field, the attributes of the values of
+        products without attribute set must be in no set.
+
+        product_sets maps the product ids to the attribute set to check
+        their values against instead of the set of their template.
+
+        The sets are read with one query per slice of values and the
+        membership is checked against the cached attributes of the sets.
+        """
+        AttributeSet = Pool().get('product.attribute.set')
+
+        rows = [
+            (id_, attribute_id, (product_sets or {}).get(product_id, set_id))
+            for id_, attribute_id, set_id, product_id
+            in cls._get_attribute_sets(attribute_values)
+        ]
+        set_attributes = AttributeSet.get_attribute_ids(
+            [set_id for _, _, set_id in rows if set_id is not None]
+        )
+        set_attributes[None] = AttributeSet.get_attribute_ids_without_set(
+            [attribute_id for _, attribute_id, set_id in rows if set_id is None]
+        )
+        invalid = [
+            id_ for id_, attribute_id, set_id in rows
+            if attribute_id not in set_attributes[set_id]
+        ]
+        if invalid:
+            cls.raise_user_error('invalid_attribute_sets', {
+                'values': '\n'.join(
+                    '%s: %s' % (v.product.rec_name, v.attribute.rec_name)
+                    for v in cls.browse(invalid)
+                ),
+            })
+
+    @classmethod
+    def check_selection_options(cls, attribute_values):
+        """
+        Check that the selection options of the values belong to their
+        attribute and report all the invalid values at once.
+
+        The mismatching (attribute, option) pairs are found with one query
+        per slice of values.
+        """
+        Option = Pool().get('product.attribute.selection_option')
+        cursor = Transaction().connection.cursor()
+
+        table = cls.__table__()
+        option = Option.__table__()
+        from_, value_table = cls._join_value_table(table, table, 'selection')
+
+        invalid = []
+        for sub_ids in grouped_slice(attribute_values):
+            cursor.execute(*from_.join(
+                option, condition=option.id == value_table.value_selection
+            ).select(
+                table.id,
+                where=reduce_ids(table.id, sub_ids)
+                & (option.attribute != table.attribute)
+            ))
+            invalid.extend(id_ for id_, in cursor.fetchall())
+        if invalid:
+            cls.raise_user_error('invalid_selection_options', {
+                'values': '\n'.join(
+                    '%s: %s = %s' % (
+                        v.product.rec_name, v.attribute.rec_name,
+                        v.value_selection.rec_name
+                    ) for v in cls.browse(invalid)
+                ),
+            })
+
+    @classmethod
+    def get_products_query(cls, attribute_id, type_, operator, operand):
+        """
+        Returns a query selecting the products having a value of the
+        attribute of type type_ matching the operator and operand.
+
+        The operand is parsed like search_value does and selection values
+        are compared to the option names.
+        """
+        Option = Pool().get('product.attribute.selection_option')
+
+        table = cls._get_value_table(type_) if type_ else cls.__table__()
+        where = Literal(False)
+        if type_ == 'selection':
+            where = table.value_selection.in_(Option.search([
+                ('attribute', '=', attribute_id),
+                ('name', operator, operand),
+            ], order=[], query=True))
+        elif type_:
+            clause = cls._get_value_clause(type_, operator, operand)
+            if clause:
+                where = cls._get_value_field(type_).convert_domain(
+                    clause, {None: (table, None)}, cls
+                )
+        return table.select(
+            table.product, where=(table.attribute == attribute_id) & where
+        )
+
+    @classmethod
+    def get_value(cls, attribute_values, name=None):
+        """
+        Consolidated method to return attribute value
+        """
+        return dict(
+            (id_, cls.format_value(type_, value))
+            for id_, (type_, value) in cls.get_typed_values(
+                [a.id for a in attribute_values]
+            ).iteritems()
+        )
+
+    @staticmethod
+    def format_value(type_, value):
+        """
+        Returns the display string of a typed attribute value
+        """
+        if value is None:
+            return None
+        if type_ == 'boolean':
+            return unicode(bool(value))
+        if type_ == 'datetime':
+            # XXX: Localize to the timezone in context
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        if type_ == 'date':
+            return datetime.combine(value, time()).strftime("%Y-%m-%d")
+        return unicode(value)
+
+    @staticmethod
+    def parse_value(type_, value):
+        """
+        Returns the typed value of a string formatted like format_value
+        does. Raises ValueError if the string is not valid for the type.
+        """
+        if value is None or type_ in ('char', 'selection'):
+            return value
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        return VALUE_PARSERS[type_](value.strip())
+
+    @classmethod
+    def search_value(cls, name, clause):
+        """
+        Search on the value column matching the type of the attribute.
+
+        The operand is parsed for each attribute type and the clause is
+        applied to the corresponding typed column, so the search is done
+        in SQL. Types for which the operand is not valid are skipped.
+
+        The like operators only match the char values and the option names
+        of the selection values, not the formatted values of the other
+        types: like never matches them and not like matches all of them.
+        """
+        _, operator, operand = clause
+        domain = ['OR']
+        for type_, _ in ATTRIBUTE_TYPES:
+            value_clause = cls._get_value_clause(type_, operator, operand)
+            if value_clause:
+                domain.append([('attribute.type_', '=', type_), value_clause])
+        return domain
+
+    @classmethod
+    def search_value_text(cls, name, clause):
+        """
+        Search text in the char values and in the names of the selected
+        options with the like operators, using the text index of the char
+        values when the backend has one (see get_text_query).
+
+        The other operators search like the value field.
+        """
+        _, operator, operand = clause
+        if operator not in ('like', 'ilike', 'not like', 'not ilike'):
+            return [('value', operator, operand)]
+        return [(
+            'id', 'not in' if operator.startswith('not ') else 'in',
+            cls.get_text_query(operator.split()[-1], operand)
+        )]
+
+    @classmethod
+    def get_text_query(cls, operator, pattern, column='id'):
+        """
+        Returns a query selecting the column of the attribute values whose
+        char value or (translated) option name matches the pattern with
+        the like or ilike operator.
+
+        On PostgreSQL, the trigram index of the char values is used for
+        the pattern when the pg_trgm extension is installed. On SQLite,
+        the char values are matched in their FTS5 table whose trigram
+        index is used by LIKE.
+        """
+        Option = Pool().get('product.attribute.selection_option')
+
+        table = cls._get_value_table('char')
+        selection_table = cls._get_value_table('selection')
+        if cls._text_table_exists():
+            text_table = Table(cls._get_text_table_name())
+            # LIKE is not case sensitive on SQLite
+            char_where = table.id.in_(text_table.select(
+                text_table.rowid,
+                where=Like(text_table.value_char, pattern)
+            ))
+        else:
+            Operator = Like if operator == 'like' else ILike
+            char_where = Operator(table.value_char, pattern)
+
+        options = Option.search(
+            [('name', operator, pattern)], order=[], query=True
+        )
+        return Union(
+            table.select(getattr(table, column), where=char_where),
+            selection_table.select(
+                getattr(selection_table, column),
+                where=selection_table.value_selection.in_(options)
+            )
+        )
+
+    @classmethod
+    def _get_value_clause(cls, type_, operator, operand):
+        if type_ == 'selection':
+            return ('value_selection.name', operator, operand)
+        if 'like' in operator and type_ != 'char':
+            return cls._get_invalid_value_clause(type_, operator)
+        try:
+            return (
+                'value_' + type_, operator,
+                cls._parse_operand(type_, operator, operand)
+            )
+        except ValueError:
+            return cls._get_invalid_value_clause(type_, operator)
+
+    @staticmethod
+    def _get_invalid_value_clause(type_, operator):
+        # No value of this type can match the operand
+        if operator == '!=' or operator.startswith('not '):
+            return ('value_' + type_, '!=', None)
+
+    @classmethod
+    def _parse_operand(cls, type_, operator, operand):
+        if operator not in ('in', 'not in'):
+            return cls.parse_value(type_, operand)
+        res = []
+        for value in operand:
+            try:
+                res.append(cls.parse_value(type_, value))
+            except ValueError:
+                continue
+        return res
+
+    @classmethod
+    def get_typed_values(cls, ids):
+        """
+        Returns a dictionary mapping the given attribute value ids to a
+        tuple (type, value) where value is read from the column matching
+        the attribute type. Selection values are the translated option
+        names.
+
+        The typed columns are fetched with a single query per slice of ids
+        while types and option names come from the attribute metadata
+        cache.
+        """
+        Attribute = Pool().get('product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        table = cls.__table__()
+        from_, columns = cls._get_typed_value_from(table)
+
+        rows = []
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*from_.select(
+                table.id, *columns, where=reduce_ids(table.id, sub_ids)
+            ))
+            rows.extend(cursor.fetchall())
+
+        metadata = Attribute.get_metadata([r[1] for r in rows])
+        return dict(
+            (row[0], cls._get_typed_value(row[1:], metadata)) for row in rows
+        )
+
+    @classmethod
+    def _get_value_from(cls, table, types):
+        """
+        Returns the attribute values table joined to the tables storing the
+        values of the types and their value columns
+        """
+        from_, columns = table, []
+        for type_ in types:
+            from_, value_table = cls._join_value_table(from_, table, type_)
+            columns.append(Column(value_table, 'value_' + type_))
+        return from_, columns
+
+    @classmethod
+    def _get_typed_value_from(cls, table):
+        """
+        Returns the attribute values table joined to the tables storing the
+        values by type and the columns to select from it for
+        _get_typed_value
+        """
+        from_, columns = cls._get_value_from(
+            table, [t for t, _ in ATTRIBUTE_TYPES]
+        )
+        return from_, [table.attribute] + columns
+
+    @staticmethod
+    def _get_typed_value(row, metadata):
+        """
+        Returns the (type, value) tuple of a row selected with the columns
+        of _get_typed_value_from using the metadata of its attribute
+        """
+        attribute = metadata[row[0]]
+        type_ = attribute['type_']
+        value = row[1 + [t for t, _ in ATTRIBUTE_TYPES].index(type_)]
+        if type_ == 'selection' and value is not None:
+            value = attribute['options'][value]
+        elif type_ == 'boolean' and value is not None:
+            # SQLite returns booleans as integers
+            value = bool(value)
+        return type_, value
+
+    @fields.depends('product')
+    def on_change_product(self):
+        if self.product and self.product.template.attribute_set:
+            self.attribute_set = self.product.template.attribute_set.id
+
+
+class Product(Instrumented):
+    "Product"
+    __metaclass__ = PoolMeta
+    __name__ = 'product.product'
+
+    attributes = fields.One2Many(
+        "product.product.attribute", "product", "Attributes",
+        domain=[If(ATTRIBUTE_SET_CHECKED, (), (
+            'attribute.sets', '=', Eval('_parent_template', {}).get(
+                'attribute_set', Eval('attribute_set', -1)
+            )
+        ))], states={
+            'readonly': (
+                ~Eval('attribute_set')
+                & ~Eval('_parent_template', {}).get('attribute_set')
+            ),
+        }, depends=['attribute_set'], context={
+            'attribute_set': Eval('attribute_set')
+        }
+    )
+
+    attribute_set = fields.Function(
+        fields.Many2One('product.attribute.set', 'Set'),
+        'get_attribute_set',
+    )
+
+    attribute_filter = fields.Function(
+        fields.Char('Attribute Filter'),
+        'get_attribute_filter', searcher='search_attribute_filter'
+    )
+    attribute_text = fields.Function(
+        fields.Char('Attribute Text'),
+        'get_attribute_filter', searcher='search_attribute_text'
+    )
+
+    attribute_signature = fields.Char(
+        'Attribute Signature', readonly=True, select=True
+    )
+
+    attributes_dict = fields.Function(
+        fields.Dict('product.attribute', 'Attributes Dictionary'),
+        'get_attributes_dict', setter='set_attributes_dict'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(Product, cls).__setup__()
+        cls.__rpc__.update({
+            'get_facets': RPC(readonly=True),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        signature_exists = TableHandler(cls, module_name).column_exist(
+            'attribute_signature'
+        )
+
+        super(Product, cls).__register__(module_name)
+
+        # Compute the signatures of the existing products
+        if not signature_exists:
+            cursor.execute(*table.select(table.id))
+            cls.update_attribute_signatures(
+                [id_ for id_, in cursor.fetchall()]
+            )
+
+    @classmethod
+    def update_attribute_signatures(cls, product_ids):
+        """
+        Store the attribute signature of the products computed from their
+        attribute values with one select and one update per slice of
+        products.
+
+        It must be called after the attribute values are modified without
+        the create, write or delete methods.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        # Like write, invalidate the cached records
+        transaction.counter += 1
+        caches = [
+            c[cls.__name__] for c in transaction.cache.itervalues()
+            if cls.__name__ in c
+        ]
+
+        for sub_ids in grouped_slice(sorted(set(product_ids))):
+            sub_ids = list(sub_ids)
+            for cache in caches:
+                for id_ in sub_ids:
+                    cache.pop(id_, None)
+            signatures = [
+                (table.id == id_, signature) for id_, signature
+                in cls._compute_attribute_signatures(sub_ids).iteritems()
+            ]
+            cursor.execute(*table.update(
+                [table.attribute_signature],
+                [Case(*signatures) if signatures else Null],
+                where=reduce_ids(table.id, sub_ids)
+            ))
+
+    @classmethod
+    def _compute_attribute_signatures(cls, product_ids):
+        """
+        Returns a dictionary mapping the ids of the products having
+        attribute values to their signature
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        table = ProductAttribute.__table__()
+        attribute = Attribute.__table__()
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+        from_, columns = ProductAttribute._get_typed_value_from(table)
+
+        cursor.execute(*from_.join(
+            attribute, condition=attribute.id == table.attribute
+        ).select(
+            table.product, attribute.type_, *columns,
+            where=reduce_ids(table.product, product_ids)
+        ))
+        values = defaultdict(list)
+        for row in cursor.fetchall():
+            product_id, type_, attribute_id = row[:3]
+            values[product_id].append(
+                (attribute_id, type_, row[3 + types.index(type_)])
+            )
+        return dict(
+            (product_id, cls._hash_attribute_values(product_values))
+            for product_id, product_values in values.iteritems()
+        )
+
+    @staticmethod
+    def _hash_attribute_values(values):
+        """
+        Returns the hexadecimal SHA-1 of the sorted (attribute id, value)
+        pairs of a list of (attribute id, type, SQL value) or None if
+        there is no value.
+        """
+        pairs = sorted(
+            (attribute_id, SIGNATURE_FORMATS[type_](value))
+            for attribute_id, type_, value in values if value is not None
+        )
+        if not pairs:
+            return None
+        return hashlib.sha1(
+            json.dumps(pairs, separators=(',', ':'))
+        ).hexdigest()
+
+    @classmethod
+    def get_attribute_signature(cls, values):
+        """
+        Returns the signature of the attribute values given as a dictionary
+        like for set_attributes of product.product.attribute
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        columns = ProductAttribute._get_set_attributes_columns(values)
+        metadata = Attribute.get_metadata(columns.keys())
+        types = [t for t, _ in ATTRIBUTE_TYPES]
+        return cls._hash_attribute_values([
+            (attribute_id, metadata[attribute_id]['type_'],
+                sql_values[types.index(metadata[attribute_id]['type_'])])
+            for attribute_id, sql_values in columns.iteritems()
+        ])
+
+    @classmethod
+    def find_by_attributes(cls, template, values):
+        """
+        Returns the variants of the template having exactly the attribute
+        values given as a dictionary like for get_attribute_signature
+        """
+        return cls.search([
+            ('template', '=', int(template)),
+            ('attribute_signature', '=', cls.get_attribute_signature(values)),
+        ])
+
+    @classmethod
+    def find_duplicates(cls, domain=None):
+        """
+        Returns the lists of the products matching the domain (all products
+        by default) which have the same template and attribute values
+        """
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        duplicate = cls.__table__()
+
+        query = None
+        if domain:
+            query = cls.search(domain, order=[], query=True)
+
+        def where(table):
+            where = table.attribute_signature != Null
+            if query:
+                where &= table.id.in_(query)
+            return where
+
+        duplicates = duplicate.select(
+            duplicate.template, duplicate.attribute_signature,
+            where=where(duplicate),
+            group_by=[duplicate.template, duplicate.attribute_signature],
+            having=Count(duplicate.id) > 1
+        )
+        cursor.execute(*table.join(
+            duplicates, condition=(duplicates.template == table.template)
+            & (duplicates.attribute_signature == table.attribute_signature)
+        ).select(
+            table.id, table.template, table.attribute_signature,
+            where=where(table),
+            order_by=[table.template, table.attribute_signature, table.id]
+        ))
+        return [
+            cls.browse([id_ for id_, _, _ in rows])
+            for _, rows in groupby(cursor.fetchall(), key=lambda r: r[1:])
+        ]
+
+    @classmethod
+    def _validate(cls, records, field_names=None):
+        with Transaction().set_context(_attribute_set_checked=True):
+            super(Product, cls)._validate(records, field_names)
+
+    @classmethod
+    def validate(cls, products):
+        ProductAttribute = Pool().get('product.product.attribute')
+
+        super(Product, cls).validate(products)
+        # Like the domain of the attributes field, the set in context
+        # applies to the products whose template has no set
+        ProductAttribute.check_attribute_sets(
+            ProductAttribute.search([('product', 'in', map(int, products))]),
+            cls.get_attribute_set(products, 'attribute_set')
+        )
+
+    @classmethod
+    def get_attribute_filter(cls, products, name):
+        return dict.fromkeys(map(int, products))
+
+    @classmethod
+    def search_attribute_text(cls, name, clause):
+        """
+        Search the products having an attribute value matching the clause
+        on the value_text field of the attribute values.
+        """
+        ProductAttribute = Pool().get('product.product.attribute')
+
+        _, operator, operand = clause
+        if operator not in ('like', 'ilike', 'not like', 'not ilike'):
+            return [('attributes.value', operator, operand)]
+        return [(
+            'id', 'not in' if operator.startswith('not ') else 'in',
+            ProductAttribute.get_text_query(
+                operator.split()[-1], operand, column='product'
+            )
+        )]
+
+    @classmethod
+    def search_attribute_filter(cls, name, clause):
+        """
+        Search the products having attribute values matching all the
+        conditions of the clause with the 'where' or 'not where' operator.
+
+        The operand is a list of (attribute, operator, value) conditions
+        where attribute is the id or the name of an attribute and value is
+        compared like the value field does. Each condition is compiled to
+        a select of the products on the attribute values table, so the
+        operator and value apply to the same value row, and the products
+        must be in the intersection of these selects.
+        """
+        _, operator, conditions = clause
+        if not conditions:
+            return []
+        return [(
+            'id', 'in' if operator == 'where' else 'not in',
+            cls._get_attribute_filter_query(conditions)
+        )]
+
+    @classmethod
+    def _get_attribute_filter_query(cls, conditions):
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        ProductAttribute = pool.get('product.product.attribute')
+
+        attributes = [c[0] for c in conditions]
+        names = [a for a in attributes if isinstance(a, basestring)]
+        attribute_ids = dict(
+            (a, int(a)) for a in attributes if not isinstance(a, basestring)
+        )
+        if names:
+            attribute_ids.update(
+                (a.name, a.id)
+                for a in Attribute.search([('name', 'in', names)])
+            )
+        metadata = Attribute.get_metadata(attribute_ids.values())
+
+        queries = []
+        for attribute, operator, value in conditions:
+            attribute_id = attribute_ids.get(attribute)
+            type_ = metadata.get(attribute_id, {}).get('type_')
+            queries.append(ProductAttribute.get_products_query(
+                attribute_id, type_, operator, value
+            ))
+        return reduce(lambda a, b: a & b, queries)
+
+    @classmethod
+    def get_attributes_dict(cls, products, name):
+        """
+        Returns a dictionary mapping the product ids to the dictionary of
+        their attribute values by attribute name, typed like
+        get_typed_values does.
+
+        The values are fetched with a single query per slice of products
+        while the attribute and option names come from the attribute
+        metadata cache.
+        """
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        table = ProductAttribute.__table__()
+        from_, columns = ProductAttribute._get_typed_value_from(table)
+
+        res = dict((p.id, {}) for p in products)
+        rows = []
+        for sub_ids in grouped_slice(res.keys()):
+            cursor.execute(*from_.select(
+                table.product, *columns,
+                where=reduce_ids(table.product, sub_ids)
+            ))
+            rows.extend(cursor.fetchall())
+
+        metadata = Attribute.get_metadata([r[1] for r in rows])
+        for row in rows:
+            _, value = ProductAttribute._get_typed_value(row[1:], metadata)
+            res[row[0]][metadata[row[1]]['name']] = value
+        return res
+
+    @classmethod
+    def set_attributes_dict(cls, products, name, value):
+        """
+        Replace the attribute values of the products by the dictionary
+        (see replace_attributes of product.product.attribute)
+        """
+        ProductAttribute = Pool().get('product.product.attribute')
+
+        ProductAttribute.replace_attributes(
+            dict((p, value or {}) for p in products)
+        )
+
+    @classmethod
+    def get_attribute_set(cls, products, name):
+        """
+        Returns the attribute set of the products' template or the
+        attribute set in context if the template has none.
+
+        The sets are read with a single query per slice of products
+        joining them to their templates.
+        """
+        Template = Pool().get('product.template')
+        cursor = Transaction().connection.cursor()
+
+        table = cls.__table__()
+        template = Template.__table__()
+
+        res = dict.fromkeys(
+            map(int, products), Transaction().context.get('attribute_set')
+        )
+        for sub_ids in grouped_slice(products):
+            cursor.execute(*table.join(
+                template, condition=template.id == table.template
+            ).select(
+                table.id, template.attribute_set,
+                where=reduce_ids(table.id, sub_ids)
+                & (template.attribute_set != Null)
+            ))
+            res.update(cursor.fetchall())
+        return res
+
+    @fields.depends('template')
+    def on_change_with_attribute_set(self, name=None):
+        Template = Pool().get('product.template')
+
+        attribute_set = None
+        if self.template and self.template.id >= 0:
+            attribute_set = Template.get_attribute_sets(
+                [self.template.id]
+            )[self.template.id]
+        elif self.template and getattr(self.template, 'attribute_set', None):
+            attribute_set = self.template.attribute_set.id
+        return attribute_set or Transaction().context.get('attribute_set')
+
+    @classmethod
+    def get_facets(cls, domain):
+        """
+        Returns the facets of the products matching the domain for layered
+        navigation.
+
+        A facet is a dictionary describing an attribute of the attribute
+        sets of the matching products with the key values listing the
+        selection options (or the distinct values for other types) and
+        the number of matching products having each of them.
+
+        The facets are computed with a bounded number of queries: one for
+        the attributes, one grouped count per attribute type and the
+        reads of the attributes and their options.
+        """
+        Attribute = Pool().get('product.attribute')
+
+        products = cls.search(domain, order=[], query=True)
+        attributes = sorted(
+            Attribute.browse(cls._get_facet_attributes(products)),
+            key=lambda a: a.rec_name
+        )
+        counts = cls._get_facet_counts(products, attributes)
+        return [{
+            'attribute': attribute.id,
+            'name': attribute.name,
+            'display_name': attribute.rec_name,
+            'type': attribute.type_,
+            'values': cls._get_facet_values(
+                attribute, counts.get(attribute.id, {})
+            ),
+        } for attribute in attributes]
+
+    @classmethod
+    def _get_facet_attributes(cls, products):
+        """
+        Returns the ids of the attributes in the attribute sets of the
+        products of the query
+        """
+        pool = Pool()
+        Template = pool.get('product.template')
+        AttributeAttributeSet = pool.get(
+            'product.attribute-product.attribute-set'
+        )
+        cursor = Transaction().connection.cursor()
+
+        table = cls.__table__()
+        template = Template.__table__()
+        attribute_set = AttributeAttributeSet.__table__()
+
+        cursor.execute(*table.join(
+            template, condition=template.id == table.template
+        ).join(
+            attribute_set,
+            condition=attribute_set.attribute_set == template.attribute_set
+        ).select(
+            attribute_set.attribute,
+            where=table.id.in_(products),
+            group_by=[attribute_set.attribute]
+        ))
+        return [attribute_id for attribute_id, in cursor.fetchall()]
+
+    @classmethod
+    def _get_facet_counts(cls, products, attributes):
+        """
+        Returns a dictionary mapping attribute ids to a dictionary of the
+        number of products of the query for each value (or option id).
+        """
+        pool = Pool()
+        ProductAttribute = pool.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        attributes_by_type = {}
+        for attribute in attributes:
+            attributes_by_type.setdefault(attribute.type_, []).append(
+                attribute.id
+            )
+
+        counts = {}
+        for type_, attribute_ids in attributes_by_type.iteritems():
+            table = ProductAttribute._get_value_table(type_)
+            column = getattr(table, 'value_' + type_)
+            cursor.execute(*table.select(
+                table.attribute, column, Count(table.product, distinct=True),
+                where=table.product.in_(products)
+                & reduce_ids(table.attribute, attribute_ids)
+                & (column != Null),
+                group_by=[table.attribute, column]
+            ))
+            for attribute_id, value, count in cursor.fetchall():
+                counts.setdefault(attribute_id, {})[value] = count
+        return counts
+
+    @staticmethod
+    def _get_facet_values(attribute, counts):
+        """
+        Returns the values of a facet sorted by value
+        """
+        ProductAttribute = Pool().get('product.product.attribute')
+
+        if attribute.type_ == 'selection':
+            return [{
+                'value': option.id,
+                'name': option.name,
+                'count': counts.get(option.id, 0),
+            } for option in attribute.selection]
+        return [{
+            'value': value,
+            'name': ProductAttribute.format_value(attribute.type_, value),
+            'count': count,
+        } for value, count in sorted(counts.iteritems())]
+
+    @classmethod
+    def export_attributes(cls, domain=None, chunk_size=1000):
+        """
+        Generate (product id, product code, attribute name, typed value)
+        tuples for the attribute values of the products matching the
+        domain (all products by default), ordered by product.
+
+        Rows are fetched by chunks from a server-side cursor on PostgreSQL
+        so the memory used is bounded by the chunk size. The cursor is
+        closed when the generator is exhausted or closed, so several
+        exports can be iterated at the same time. Selection values are the
+        translated option names.
+        """
+        ProductAttribute = Pool().get('product.product.attribute')
+
+        table = ProductAttribute.__table__()
+        product = cls.__table__()
+        from_, columns = ProductAttribute._get_typed_value_from(table)
+
+        where = None
+        if domain:
+            where = table.product.in_(
+                cls.search(domain, order=[], query=True)
+            )
+        cursor = cls._get_export_cursor()
+        try:
+            cursor.execute(*from_.join(
+                product, condition=product.id == table.product
+            ).select(
+                product.id, product.code, *columns,
+                where=where, order_by=[product.id, table.id]
+            ))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in cls._get_export_rows(rows):
+                    yield row
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _get_export_cursor():
+        connection = Transaction().connection
+        if backend.name() == 'postgresql':  # pragma: no cover
+            # The names of the server-side cursors are unique in the
+            # transaction
+            return connection.cursor(
+                'product_attribute_export_%s' % uuid4().hex
+            )
+        return connection.cursor()
+
+    @staticmethod
+    def _get_export_rows(rows):
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        ProductAttribute = pool.get('product.product.attribute')
 
-        return Product.get_attribute_set([self], name="attribute_set")[self.id]
+        metadata = Attribute.get_metadata([r[2] for r in rows])
+        return [
+            row[:2] + (
+                metadata[row[2]]['name'],
+                ProductAttribute._get_typed_value(row[2:], metadata)[1],
+            ) for row in rows
+        ]
@@ -0,0 +1,283 @@
+#! /usr/bin/env python
+"""
+Benchmark the main operations of the attribute models on a synthetic
+catalog.
+
+The catalog has --sets attribute sets containing --attributes attributes
+of each type, selection attributes having --options options, and
+--products variants spread over one template per set with a value for
+each attribute. It is created in the database given by the DB_NAME
+environment variable and the transaction is rolled back at the end, so
+the database is left untouched.
+
+Each operation is run --repeat times. The results give for each of them
+the best and mean wall time, the number of SQL queries of the first
+(cold caches) and last run and the rows fetched by the last run, as JSON
+to compare between releases.
+
+Usage: DB_NAME=test python benchmark_catalog.py [--products 1000]
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import date, timedelta
+from decimal import Decimal
+
+from trytond.config import config
+config.update_etc()
+
+import trytond
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.product_attribute_strict.product import ATTRIBUTE_TYPES
+from trytond.modules.product_attribute_strict.instrumentation import (
+    QueryCounter
+)
+
+
+def measure(function, repeat):
+    """
+    Returns the timings and query counts of repeat calls to function
+    """
+    transaction = Transaction()
+    connection = transaction.connection
+    timings, counters = [], []
+    for _ in range(repeat):
+        transaction.connection = counter = QueryCounter(connection)
+        try:
+            start = time.time()
+            function()
+            timings.append(time.time() - start)
+        finally:
+            transaction.connection = connection
+        counters.append(counter)
+    return {
+        'time': min(timings),
+        'time_mean': sum(timings) / len(timings),
+        'queries_first': counters[0].count,
+        'queries': counters[-1].count,
+        'rows': counters[-1].rows,
+    }
+
+
+RAW_VALUES = {
+    'boolean': lambda rnd: rnd.choice(['true', 'false']),
+    'integer': lambda rnd: str(rnd.randint(0, 1000)),
+    'char': lambda rnd: 'Value %d' % rnd.randint(0, 1000),
+    'float': lambda rnd: repr(rnd.random() * 1000),
+    'numeric': lambda rnd: '%d.%02d' % (
+        rnd.randint(0, 1000), rnd.randint(0, 99)
+    ),
+    'date': lambda rnd: (
+        date(2000, 1, 1) + timedelta(rnd.randint(0, 10000))
+    ).isoformat(),
+    'datetime': lambda rnd: (
+        date(2000, 1, 1) + timedelta(rnd.randint(0, 10000))
+    ).isoformat() + ' 12:00:00',
+}
+
+
+def create_attributes(args):
+    """
+    Create --attributes attributes of each type and the attribute sets
+    """
+    pool = Pool()
+    Attribute = pool.get('product.attribute')
+    AttributeSet = pool.get('product.attribute.set')
+
+    attributes = Attribute.create([{
+        'name': 'Benchmark %s %d' % (type_, i),
+        'type_': type_,
+        'selection': [('create', [{
+            'name': 'Option %d' % j,
+        } for j in range(args.options if type_ == 'selection' else 0)])],
+    } for type_, _ in ATTRIBUTE_TYPES for i in range(args.attributes)])
+    sets = AttributeSet.create([{
+        'name': 'Benchmark %d' % i,
+        'attributes': [('add', [a.id for a in attributes])],
+    } for i in range(args.sets)])
+    return attributes, sets
+
+
+def create_products(sets, count):
+    """
+    Create count variants spread over one template per attribute set
+    """
+    pool = Pool()
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('symbol', '=', 'u')])
+    templates = Template.create([{
+        'name': 'Benchmark %d' % i,
+        'default_uom': unit.id,
+        'list_price': Decimal(0),
+        'cost_price': Decimal(0),
+        'attribute_set': attribute_set.id,
+    } for i, attribute_set in enumerate(sets)])
+    return Product.create([{
+        'template': templates[i % len(templates)].id,
+        'code': 'BENCH%d' % i,
+    } for i in range(count)])
+
+
+def get_raw_value(attribute, rnd):
+    if attribute.type_ == 'selection':
+        return rnd.choice(attribute.selection).name
+    return RAW_VALUES[attribute.type_](rnd)
+
+
+def get_value_rows(products, attributes, rnd):
+    """
+    Yield the rows to import a random value of every attribute for each
+    product
+    """
+    for product in products:
+        for attribute in attributes:
+            yield product.code, attribute.name, get_raw_value(attribute, rnd)
+
+
+def get_value_vlist(products, attributes, rnd):
+    """
+    Returns the values to create the attribute values of the products
+    """
+    ProductAttribute = Pool().get('product.product.attribute')
+    vlist = []
+    for product in products:
+        for attribute in attributes:
+            value = ProductAttribute.parse_value(
+                attribute.type_, get_raw_value(attribute, rnd)
+            )
+            if attribute.type_ == 'selection':
+                value, = [o.id for o in attribute.selection
+                    if o.name == value]  # noqa
+            vlist.append({
+                'product': product.id,
+                'attribute': attribute.id,
+                'value_' + attribute.type_: value,
+            })
+    return vlist
+
+
+def get_operations(args, attributes, sets, products, rnd):
+    """
+    Returns the list of (name, function) of the operations to measure
+    """
+    pool = Pool()
+    Product = pool.get('product.product')
+    ProductAttribute = pool.get('product.product.attribute')
+
+    sample = rnd.sample(products, min(args.sample, len(products)))
+    value_ids = map(int, ProductAttribute.search([
+        ('product', 'in', map(int, sample)),
+    ]))
+    by_type = dict((a.type_, a) for a in attributes)
+
+    def replace_attributes():
+        # Change one value of each product in the full dictionaries
+        values = Product.get_attributes_dict(sample, 'attributes_dict')
+        for product_values in values.itervalues():
+            product_values[by_type['char'].name] = get_raw_value(
+                by_type['char'], rnd
+            )
+        ProductAttribute.replace_attributes(values)
+
+    def bulk_create():
+        new_products = create_products(sets, args.sample)
+        ProductAttribute.create(
+            get_value_vlist(new_products, attributes, rnd)
+        )
+
+    return [
+        ('read_value', lambda: ProductAttribute.read(value_ids, ['value'])),
+        ('read_attribute_set', lambda: Product.read(
+            map(int, sample), ['attribute_set']
+        )),
+        ('read_attributes_dict', lambda: Product.read(
+            map(int, sample), ['attributes_dict']
+        )),
+        ('search_value', lambda: ProductAttribute.search([
+            ('attribute', '=', by_type['char'].id),
+            ('value', '=', 'Value 1'),
+        ])),
+        ('search_attribute_filter', lambda: Product.search([
+            ('attribute_filter', 'where', [
+                (by_type['integer'].id, '>=', '500'),
+                (by_type['selection'].id, '=', 'Option 0'),
+            ]),
+        ])),
+        ('replace_attributes', replace_attributes),
+        ('bulk_create', bulk_create),
+        ('validate_attributes', lambda: Product._validate(
+            Product.browse(map(int, sample))
+        )),
+    ]
+
+
+def main(args):
+    ProductAttribute = Pool().get('product.product.attribute')
+    rnd = random.Random(args.seed)
+
+    attributes, sets = create_attributes(args)
+    products = create_products(sets, args.products)
+
+    results = {
+        'import_values': measure(lambda: ProductAttribute.import_values(
+            get_value_rows(products, attributes, rnd)
+        ), 1),
+    }
+    for name, function in get_operations(
+            args, attributes, sets, products, rnd):
+        results[name] = measure(function, args.repeat)
+
+    return {
+        'backend': backend.name(),
+        'trytond': trytond.__version__,
+        'parameters': vars(args),
+        'values': len(products) * len(attributes),
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sets', type=int, default=5)
+    parser.add_argument('--attributes', type=int, default=3)
+    parser.add_argument('--options', type=int, default=10)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument(
+        '--sample', type=int, default=100,
+        help='Number of products read, validated or created by operation'
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--output', help='Path of the JSON results (default: stdout)'
+    )
+    args = parser.parse_args()
+
+    try:
+        DB_NAME = os.environ['DB_NAME']
+    except KeyError:
+        raise RuntimeError('DB_NAME not found in environment')
+
+    POOL = Pool(DB_NAME)
+    POOL.init()
+
+    with Transaction().start(DB_NAME, 1, context={}) as txn:
+        try:
+            report = main(args)
+        finally:
+            txn.rollback()
+
+    if args.output:
+        with open(args.output, 'wb') as file_:
+            json.dump(report, file_, indent=4, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write('\n')
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+"""
+Measure the latency of attribute value filters with and without the
+(attribute, value_<type>) indexes.
+
+A synthetic catalog of attribute values is inserted in the database given
+by the DB_NAME environment variable and the transaction is rolled back at
+the end, so the database is left untouched.
+
+Usage: DB_NAME=test python benchmark_value_indexes.py [--rows 1000000]
+"""
+import os
+import json
+import random
+import time
+import argparse
+from decimal import Decimal
+
+from sql import Literal
+from sql.aggregate import Count
+
+from trytond.config import config
+config.update_etc()
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def create_catalog(rows, products, attributes):
+    """
+    Create numeric attributes and insert `rows` attribute values spread
+    over `products` variants with raw SQL inserts.
+    """
+    pool = Pool()
+    Attribute = pool.get('product.attribute')
+    AttributeSet = pool.get('product.attribute.set')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    ProductAttribute = pool.get('product.product.attribute')
+    Uom = pool.get('product.uom')
+
+    attributes = Attribute.create([{
+        'name': 'Benchmark %d' % i,
+        'type_': 'numeric',
+    } for i in range(attributes)])
+    attribute_set, = AttributeSet.create([{
+        'name': 'Benchmark',
+        'attributes': [('add', [a.id for a in attributes])],
+    }])
+    template, = Template.create([{
+        'name': 'Benchmark',
+        'default_uom': Uom.search([('symbol', '=', 'u')])[0].id,
+        'list_price': Decimal(0),
+        'cost_price': Decimal(0),
+        'attribute_set': attribute_set.id,
+    }])
+    products = Product.create([{
+        'template': template.id,
+    } for _ in range(products)])
+
+    cursor = Transaction().connection.cursor()
+    table = ProductAttribute.__table__()
+    batch = []
+    for i in xrange(rows):
+        batch.append([
+            products[i % len(products)].id,
+            attributes[i % len(attributes)].id,
+            Decimal(random.randint(0, 100000)) / 100,
+        ])
+        if len(batch) == 10000 or i == rows - 1:
+            cursor.execute(*table.insert(
+                columns=[table.product, table.attribute, table.value_numeric],
+                values=batch
+            ))
+            batch = []
+    return attributes
+
+
+def time_filter(attribute, repeat, indexed=True):
+    """
+    Returns the best time to count the values of the attribute in a range.
+
+    When indexed is False, the value column is wrapped in an expression so
+    the (attribute, value_numeric) index can not be used.
+    """
+    ProductAttribute = Pool().get('product.product.attribute')
+
+    cursor = Transaction().connection.cursor()
+    table = ProductAttribute.__table__()
+    value = table.value_numeric
+    if not indexed:
+        value += 0
+    query = table.select(
+        Count(Literal(1)),
+        where=(table.attribute == attribute.id)
+        & (value >= Decimal('100')) & (value <= Decimal('110'))
+    )
+
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        cursor.execute(*query)
+        cursor.fetchall()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main(args):
+    attributes = create_catalog(args.rows, args.products, args.attributes)
+    attribute = attributes[0]
+
+    result = {
+        'rows': args.rows,
+        'indexed': time_filter(attribute, args.repeat),
+        'not_indexed': time_filter(attribute, args.repeat, indexed=False),
+    }
+    print json.dumps(result, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--attributes', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    try:
+        DB_NAME = os.environ['DB_NAME']
+    except KeyError:
+        raise RuntimeError('DB_NAME not found in environment')
+
+    POOL = Pool(DB_NAME)
+    POOL.init()
+
+    with Transaction().start(DB_NAME, 1, context={}) as txn:
+        try:
+            main(args)
+        finally:
+            txn.rollback()
@@ -0,0 +1,248 @@
+#! /usr/bin/env python
+"""
+Compare the size and the scan speed of the attribute values stored in the
+wide table, with one column per type, and in compact per-type tables like
+the typed value_storage does.
+
+A synthetic catalog with a value of --attributes attributes of each type
+for --products variants is inserted in the wide table of the database
+given by the DB_NAME environment variable. The per-type tables are then
+filled from the wide table, which is how the values would be migrated,
+and get the same covering (attribute, value, product) index as the wide
+table, and an index on product. The sizes include the tables and all their
+indexes. The transaction is rolled back at the end, so the database is
+left untouched. The values must be stored in the wide table.
+
+Usage: DB_NAME=test python benchmark_value_storage.py [--products 20000]
+"""
+import os
+import json
+import random
+import time
+import argparse
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sql import Literal, Table
+from sql.aggregate import Count
+
+from trytond.config import config
+config.update_etc()
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.product_attribute_strict.product import ATTRIBUTE_TYPES
+
+VALUES = {
+    'boolean': lambda rnd: rnd.random() < 0.5,
+    'integer': lambda rnd: rnd.randint(0, 100000),
+    'char': lambda rnd: 'Value %d' % rnd.randint(0, 100000),
+    'float': lambda rnd: rnd.random() * 1000,
+    'numeric': lambda rnd: Decimal(rnd.randint(0, 100000)) / 100,
+    'date': lambda rnd: date(2000, 1, 1) + timedelta(rnd.randint(0, 10000)),
+    'datetime': lambda rnd: datetime(2000, 1, 1) + timedelta(
+        seconds=rnd.randint(0, 10 ** 9)
+    ),
+}
+
+
+def create_catalog(args, rnd):
+    """
+    Create the attributes and the products and insert the values in the
+    wide table with raw SQL inserts.
+    """
+    pool = Pool()
+    Attribute = pool.get('product.attribute')
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    ProductAttribute = pool.get('product.product.attribute')
+    Uom = pool.get('product.uom')
+
+    attributes = Attribute.create([{
+        'name': 'Benchmark %s %d' % (type_, i),
+        'type_': type_,
+        'selection': [('create', [{
+            'name': 'Option %d' % j,
+        } for j in range(10 if type_ == 'selection' else 0)])],
+    } for type_, _ in ATTRIBUTE_TYPES for i in range(args.attributes)])
+    template, = Template.create([{
+        'name': 'Benchmark',
+        'default_uom': Uom.search([('symbol', '=', 'u')])[0].id,
+        'list_price': Decimal(0),
+        'cost_price': Decimal(0),
+    }])
+    products = Product.create([{
+        'template': template.id,
+    } for _ in range(args.products)])
+
+    cursor = Transaction().connection.cursor()
+    table = ProductAttribute.__table__()
+    types = [t for t, _ in ATTRIBUTE_TYPES]
+    columns = [table.product, table.attribute] + [
+        getattr(table, 'value_' + t) for t in types
+    ]
+    batch = []
+    for product in products:
+        for attribute in attributes:
+            batch.append([product.id, attribute.id] + [
+                get_value(attribute, rnd) if t == attribute.type_ else None
+                for t in types
+            ])
+        if len(batch) >= 10000 or product == products[-1]:
+            cursor.execute(*table.insert(columns, batch))
+            batch = []
+    return attributes
+
+
+def get_value(attribute, rnd):
+    if attribute.type_ == 'selection':
+        return rnd.choice(attribute.selection).id
+    return VALUES[attribute.type_](rnd)
+
+
+def create_type_tables():
+    """
+    Create and fill a compact table per type from the wide table and
+    returns them by type
+    """
+    ProductAttribute = Pool().get('product.product.attribute')
+    cursor = Transaction().connection.cursor()
+    wide = ProductAttribute.__table__()
+
+    tables = {}
+    for type_, _ in ATTRIBUTE_TYPES:
+        name = '%s_%s' % (ProductAttribute._table, type_)
+        sql_type = ProductAttribute._fields['value_' + type_].sql_type()
+        cursor.execute(
+            'CREATE TABLE "%s" ("id" INTEGER PRIMARY KEY, '
+            '"product" INTEGER NOT NULL, "attribute" INTEGER NOT NULL, '
+            '"value" %s NOT NULL)' % (name, sql_type.base)
+        )
+        cursor.execute(
+            'CREATE INDEX "%s_covering_index" ON "%s" '
+            '("attribute", "value", "product")' % (name, name)
+        )
+        cursor.execute(
+            'CREATE INDEX "%s_product_index" ON "%s" ("product")' % (
+                name, name
+            )
+        )
+        table = tables[type_] = Table(name)
+        value = getattr(wide, 'value_' + type_)
+        cursor.execute(*table.insert(
+            [table.id, table.product, table.attribute, table.value],
+            wide.select(
+                wide.id, wide.product, wide.attribute, value,
+                where=value != None)  # noqa
+        ))
+    return tables
+
+
+def get_sizes(names):
+    """
+    Returns the size in bytes of the tables with their indexes
+    """
+    cursor = Transaction().connection.cursor()
+    if backend.name() == 'postgresql':
+        cursor.execute(
+            'SELECT SUM(pg_total_relation_size(c.oid)) FROM pg_class c '
+            'WHERE c.relname IN (%s)' % ','.join(['%s'] * len(names)),
+            names)
+    else:
+        cursor.execute(
+            'SELECT SUM("pgsize") FROM "dbstat" WHERE "name" IN ('
+            'SELECT "name" FROM "sqlite_master" WHERE "tbl_name" IN (%s))'
+            % ','.join(['?'] * len(names)),
+            names)
+    size, = cursor.fetchone()
+    return int(size or 0)
+
+
+def time_query(query, repeat):
+    """
+    Returns the best time to execute the query and fetch its rows
+    """
+    cursor = Transaction().connection.cursor()
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        cursor.execute(*query)
+        cursor.fetchall()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def get_scans(attribute, tables, repeat):
+    """
+    Returns the timings of a range filter returning the products and of a
+    count of the values of the type of the attribute on both layouts
+    """
+    ProductAttribute = Pool().get('product.product.attribute')
+
+    wide = ProductAttribute.__table__()
+    value = wide.value_numeric
+    compact = tables['numeric']
+    low, high = Decimal('100'), Decimal('110')
+    return {
+        'filter_wide': time_query(wide.select(
+            wide.product, where=(wide.attribute == attribute.id)
+            & (value >= low) & (value <= high)
+        ), repeat),
+        'filter_per_type': time_query(compact.select(
+            compact.product, where=(compact.attribute == attribute.id)
+            & (compact.value >= low) & (compact.value <= high)
+        ), repeat),
+        'count_wide': time_query(wide.select(
+            Count(Literal(1)), where=value != None  # noqa
+        ), repeat),
+        'count_per_type': time_query(compact.select(
+            Count(Literal(1))
+        ), repeat),
+    }
+
+
+def main(args):
+    ProductAttribute = Pool().get('product.product.attribute')
+    rnd = random.Random(args.seed)
+
+    if ProductAttribute._value_storage != 'wide':
+        raise RuntimeError('The values are not stored in the wide table')
+
+    attributes = create_catalog(args, rnd)
+    start = time.time()
+    tables = create_type_tables()
+    migration = time.time() - start
+    attribute = [a for a in attributes if a.type_ == 'numeric'][0]
+
+    return {
+        'backend': backend.name(),
+        'rows': args.products * len(attributes),
+        'size_wide': get_sizes([ProductAttribute._table]),
+        'size_per_type': get_sizes([t._name for t in tables.values()]),
+        'migration': migration,
+        'scans': get_scans(attribute, tables, args.repeat),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--products', type=int, default=20000)
+    parser.add_argument('--attributes', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        DB_NAME = os.environ['DB_NAME']
+    except KeyError:
+        raise RuntimeError('DB_NAME not found in environment')
+
+    POOL = Pool(DB_NAME)
+    POOL.init()
+
+    with Transaction().start(DB_NAME, 1, context={}) as txn:
+        try:
+            print json.dumps(main(args), indent=4, sort_keys=True)
+        finally:
+            txn.rollback()
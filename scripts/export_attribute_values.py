@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+"""
+Export the attribute values of every variant to a CSV or JSON-lines file.
+
+Each row gives the product id, the product code, the attribute name and
+the value. Rows are streamed from the database in chunks so the memory
+used does not depend on the size of the catalog.
+
+Usage: DB_NAME=test python export_attribute_values.py values.jsonl
+"""
+import os
+import csv
+import sys
+import json
+import argparse
+from decimal import Decimal
+
+from trytond.config import config
+config.update_etc()
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+COLUMNS = ['product', 'code', 'attribute', 'value']
+
+
+def to_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def write_csv(file_, rows):
+    writer = csv.writer(file_)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow(map(to_text, row))
+
+
+def to_json(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    return value.isoformat()
+
+
+def write_jsonl(file_, rows):
+    for row in rows:
+        file_.write(json.dumps(dict(zip(COLUMNS, row)), default=to_json))
+        file_.write('\n')
+
+
+WRITERS = {
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        'filename', nargs='?', help='Output file (default: stdout)'
+    )
+    parser.add_argument(
+        '--format', choices=sorted(WRITERS),
+        help='Format of the file, guessed from its extension by default'
+    )
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+    format_ = args.format or (
+        args.filename and os.path.splitext(args.filename)[1][1:]
+    ) or 'csv'
+    if format_ not in WRITERS:
+        parser.error('Unknown format "%s"' % format_)
+
+    try:
+        DB_NAME = os.environ['DB_NAME']
+    except KeyError:
+        raise RuntimeError('DB_NAME not found in environment')
+
+    POOL = Pool(DB_NAME)
+    POOL.init()
+
+    with Transaction().start(DB_NAME, 1, context={}, readonly=True):
+        Product = Pool().get('product.product')
+
+        rows = Product.export_attributes(chunk_size=args.chunk_size)
+        if args.filename:
+            with open(args.filename, 'wb') as file_:
+                WRITERS[format_](file_, rows)
+        else:
+            WRITERS[format_](sys.stdout, rows)
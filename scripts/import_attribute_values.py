@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+"""
+Import product attribute values from a CSV or JSON-lines file.
+
+Each row gives a product code, an attribute name and the raw value
+(the option name for selection attributes). CSV files have a header with
+the columns product, attribute and value; JSON-lines files have one
+object per line with the same keys.
+
+The file is read as a stream and inserted in batches. Rejected rows are
+written to the error report with their row number and the reason.
+
+Usage: DB_NAME=test python import_attribute_values.py values.csv
+"""
+import os
+import csv
+import sys
+import json
+import argparse
+
+from trytond.config import config
+config.update_etc()
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+def read_csv(file_):
+    for row in csv.DictReader(file_):
+        yield tuple(
+            row[key].decode('utf-8') if row[key] is not None else None
+            for key in ('product', 'attribute', 'value')
+        )
+
+
+def read_jsonl(file_):
+    for line in file_:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        yield row['product'], row['attribute'], row['value']
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def write_errors(file_, errors):
+    writer = csv.writer(file_)
+    writer.writerow(['row', 'error'])
+    for number, message in errors:
+        writer.writerow([number, message.encode('utf-8')])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('filename')
+    parser.add_argument(
+        '--format', choices=sorted(READERS),
+        help='Format of the file, guessed from its extension by default'
+    )
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument(
+        '--errors', help='Path of the CSV error report (default: stderr)'
+    )
+    args = parser.parse_args()
+    format_ = args.format or os.path.splitext(args.filename)[1][1:]
+    if format_ not in READERS:
+        parser.error('Unknown format "%s"' % format_)
+
+    try:
+        DB_NAME = os.environ['DB_NAME']
+    except KeyError:
+        raise RuntimeError('DB_NAME not found in environment')
+
+    POOL = Pool(DB_NAME)
+    POOL.init()
+
+    with Transaction().start(DB_NAME, 1, context={}) as txn:
+        AttrValue = Pool().get('product.product.attribute')
+
+        with open(args.filename, 'rb') as file_:
+            errors = AttrValue.import_values(
+                READERS[format_](file_), batch_size=args.batch_size
+            )
+
+        if args.errors:
+            with open(args.errors, 'wb') as report:
+                write_errors(report, errors)
+        elif errors:
+            write_errors(sys.stderr, errors)
+        print "Rejected %d rows" % len(errors)
+
+        txn.commit()
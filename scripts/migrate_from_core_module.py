@@ -1,13 +1,24 @@
 #! /usr/bin/env python
 import os
+import sys
 import json
-from collections import defaultdict
+import argparse
+import multiprocessing
+from itertools import imap
+from collections import defaultdict, Counter
+
+from sql import Table
+from sql.aggregate import Max, Min
+from sql.functions import CurrentTimestamp
 
 from trytond.config import config
 config.update_etc()
 
+from trytond import backend
 from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONDecoder
 from trytond.transaction import Transaction
+from trytond.modules.product_attribute_strict.product import ATTRIBUTE_TYPES
 
 
 def get_selection_json(db_selection):
@@ -20,20 +31,18 @@ def rename_string_to_display_name():
     """Core product attribute was using string field which have been changed
     to display_name now.
     """
-    cursor = Transaction().cursor
+    cursor = Transaction().connection.cursor()
     cursor.execute(
         "ALTER TABLE product_attribute RENAME string TO display_name"
     )
 
 
-def copy_selection_options():
+def get_attribute_selections():
     """
-    Copy the selection field options and create options
-    for the selection field.
+    Returns the selection options of the selection attributes as a list
+    of (attribute id, [[key, value], ...])
     """
-    Option = Pool().get('product.attribute.selection_option')
-
-    cursor = Transaction().cursor
+    cursor = Transaction().connection.cursor()
     cursor.execute(
         """
         SELECT id, selection
@@ -41,11 +50,23 @@ def copy_selection_options():
         WHERE type_='selection'
         """
     )
+    return [
+        (id, get_selection_json(selection or ''))
+        for id, selection in cursor.fetchall()
+    ]
+
+
+def copy_selection_options():
+    """
+    Copy the selection field options and create options
+    for the selection field.
+    """
+    Option = Pool().get('product.attribute.selection_option')
+
     # Key value map
     attribute_kv_map = defaultdict(dict)
-    for row in cursor.fetchall():
-        id, selection = row
-        for k, v in get_selection_json(selection):
+    for id, selection in get_attribute_selections():
+        for k, v in selection:
             option = Option(
                 name=v, attribute=id
             )
@@ -56,6 +77,38 @@ def copy_selection_options():
     return attribute_kv_map
 
 
+def load_selection_options():
+    """
+    Returns the key value map of the selection options copied by a
+    previous run of copy_selection_options or created to resolve
+    conflicts.
+    """
+    Option = Pool().get('product.attribute.selection_option')
+
+    cursor = Transaction().connection.cursor()
+    option = Option.__table__()
+    cursor.execute(*option.select(option.attribute, option.name, option.id))
+    attribute_kv_map = defaultdict(dict)
+    for attribute, name, option_id in cursor.fetchall():
+        attribute_kv_map[attribute][name] = option_id
+    for id, selection in get_attribute_selections():
+        for k, v in selection:
+            if v in attribute_kv_map[id]:
+                attribute_kv_map[id][k] = attribute_kv_map[id][v]
+    return attribute_kv_map
+
+
+def read_selection_options():
+    """
+    Returns the key value map of the selection options like
+    copy_selection_options but without creating the options.
+    """
+    attribute_kv_map = defaultdict(dict)
+    for id, selection in get_attribute_selections():
+        attribute_kv_map[id].update(selection)
+    return attribute_kv_map
+
+
 def validate_and_copy_attributes(product, attribute_kv_map):
     """
     Validate first and copy the attributes over.
@@ -69,7 +122,7 @@ def validate_and_copy_attributes(product, attribute_kv_map):
     # Step 1: Get the attributes of product from database.
     #         (Could have fetched from model, but better assume the worst
     #         where the core module could have been uninstalled)
-    cursor = Transaction().cursor
+    cursor = Transaction().connection.cursor()
     cursor.execute(
         """
         SELECT attributes
@@ -212,6 +265,281 @@ def validate_and_copy_attributes(product, attribute_kv_map):
     product.save()
 
 
+# Conflicts the interactive migration asks about and the policies which
+# can resolve them in the set-based migration. Without a policy, a
+# conflict stops the migration like the (q) answer.
+CONFLICT_POLICIES = {
+    'no_attribute_set': ['remove'],
+    'unknown_attribute': ['create', 'remove'],
+    'attribute_not_in_set': ['add-to-set', 'remove'],
+    'invalid_option': ['create', 'remove'],
+    'invalid_value': ['remove'],
+    'existing_value': ['keep'],
+}
+
+
+class ConflictError(Exception):
+    pass
+
+
+class SetBasedMigration(object):
+    """
+    Copy the attributes of all the products without asking questions.
+
+    Attributes, attribute sets and options are loaded once in memory, the
+    JSON attributes of the products are read in a single streaming pass
+    and the attribute values are inserted in batches. Conflicts are
+    resolved with the policies given for each of them.
+    """
+
+    def __init__(self, attribute_kv_map, policies, batch_size=1000):
+        pool = Pool()
+        Attribute = pool.get('product.attribute')
+        AttributeSet = pool.get('product.attribute-product.attribute-set')
+
+        self.attribute_kv_map = attribute_kv_map
+        self.policies = policies
+        self.batch_size = batch_size
+        self.conflicts = Counter()
+        self.rows = []
+        self.inserted = 0
+        self.products = 0
+
+        cursor = Transaction().connection.cursor()
+        attribute = Attribute.__table__()
+        cursor.execute(*attribute.select(
+            attribute.name, attribute.id, attribute.type_
+        ))
+        self.attributes = dict(
+            (name, (id_, type_)) for name, id_, type_ in cursor.fetchall()
+        )
+
+        relation = AttributeSet.__table__()
+        cursor.execute(*relation.select(
+            relation.attribute_set, relation.attribute
+        ))
+        self.set_attributes = defaultdict(set)
+        for attribute_set, attribute_id in cursor.fetchall():
+            self.set_attributes[attribute_set].add(attribute_id)
+
+    def run(self, where=None):
+        """
+        Migrate the attributes of the products matching the SQL condition
+        on the product table
+        """
+        cursor = self.get_product_cursor(where)
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for product_id, attribute_set, attributes in rows:
+                self.migrate_product(product_id, attribute_set, attributes)
+        self.flush()
+
+    def get_product_cursor(self, where=None):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        connection = Transaction().connection
+        if backend.name() == 'postgresql':
+            cursor = connection.cursor('migrate_product_attributes')
+        else:
+            cursor = connection.cursor()
+
+        product = Product.__table__()
+        template = Template.__table__()
+        condition = product.attributes != None  # noqa
+        if where is not None:
+            condition &= where(product)
+        cursor.execute(*product.join(
+            template, condition=template.id == product.template
+        ).select(
+            product.id, template.attribute_set, product.attributes,
+            where=condition, order_by=[product.id]
+        ))
+        return cursor
+
+    def migrate_product(self, product_id, attribute_set, attributes):
+        if attributes in (None, '{}'):
+            return
+        attributes = json.loads(attributes, object_hook=JSONDecoder())
+        if not attributes:
+            return
+        self.products += 1
+        if not attribute_set:
+            self.resolve(
+                'no_attribute_set',
+                "Product %s has no attribute set defined but has "
+                "attributes defined: %s" % (product_id, attributes),
+                product=product_id
+            )
+            return
+        for attr_name, attr_value in attributes.iteritems():
+            row = self.get_row(
+                product_id, attribute_set, attr_name, attr_value
+            )
+            if row:
+                self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def get_row(self, product_id, attribute_set, attr_name, attr_value):
+        """
+        Returns the product id, attribute id, type and SQL value of the
+        attribute value to insert or None if the attribute is removed
+        """
+        if attr_name not in self.attributes:
+            policy = self.resolve(
+                'unknown_attribute',
+                "Product %s has attribute named %s, but no such "
+                "attribute exists" % (product_id, attr_name),
+                product=product_id, attribute=attr_name, value=attr_value
+            )
+            if policy == 'remove':
+                return
+            self.create_attribute(attr_name, attribute_set)
+        attribute_id, type_ = self.attributes[attr_name]
+
+        if attribute_id not in self.set_attributes[attribute_set]:
+            policy = self.resolve(
+                'attribute_not_in_set',
+                "Attribute '%s' is not in attribute set %s used by "
+                "product %s" % (attr_name, attribute_set, product_id),
+                product=product_id, attribute=attr_name,
+                attribute_set=attribute_set
+            )
+            if policy == 'remove':
+                return
+            self.add_to_set(attribute_id, attribute_set)
+
+        if type_ == 'selection' and \
+                attr_value not in self.attribute_kv_map[attribute_id]:
+            policy = self.resolve(
+                'invalid_option',
+                "Attribute value '%s' of attribute '%s' is not a valid "
+                "selection" % (attr_value, attr_name),
+                product=product_id, attribute=attr_name, value=attr_value
+            )
+            if policy == 'remove':
+                return
+            self.create_option(attribute_id, attr_value)
+
+        if type_ == 'selection':
+            attr_value = self.attribute_kv_map[attribute_id][attr_value]
+        else:
+            try:
+                attr_value = self.parse_value(type_, attr_value)
+            except ValueError:
+                self.resolve(
+                    'invalid_value',
+                    "Attribute value '%s' of attribute '%s' is not a valid "
+                    "%s value" % (attr_value, attr_name, type_),
+                    product=product_id, attribute=attr_name, value=attr_value
+                )
+                return
+        return (product_id, attribute_id, type_, attr_value)
+
+    def parse_value(self, type_, attr_value):
+        """
+        Returns the SQL value of the core value for the type or raises a
+        ValueError if it is not valid
+        """
+        AttrValue = Pool().get('product.product.attribute')
+
+        return AttrValue._fields['value_%s' % type_].sql_format(
+            AttrValue.parse_value(type_, attr_value)
+        )
+
+    def resolve(self, conflict, message, **details):
+        """
+        Returns the policy to apply to the conflict or raises a
+        ConflictError if there is none
+        """
+        self.conflicts[conflict] += 1
+        policy = self.policies.get(conflict)
+        if policy is None:
+            raise ConflictError(message)
+        return policy
+
+    def create_attribute(self, attr_name, attribute_set):
+        Attribute = Pool().get('product.attribute')
+
+        attribute = Attribute(
+            name=attr_name,
+            type_='selection',
+            sets=[attribute_set],
+        )
+        attribute.save()
+        self.attributes[attr_name] = (attribute.id, attribute.type_)
+        self.set_attributes[attribute_set].add(attribute.id)
+
+    def add_to_set(self, attribute_id, attribute_set):
+        AttributeSet = Pool().get('product.attribute-product.attribute-set')
+
+        AttributeSet.create([{
+            'attribute': attribute_id,
+            'attribute_set': attribute_set,
+        }])
+        self.set_attributes[attribute_set].add(attribute_id)
+
+    def create_option(self, attribute_id, attr_value):
+        Option = Pool().get('product.attribute.selection_option')
+
+        option = Option(name=attr_value, attribute=attribute_id)
+        option.save()
+        self.attribute_kv_map[attribute_id][attr_value] = option.id
+
+    def get_new_rows(self):
+        """
+        Returns the pending rows of the attributes the products have no
+        value of yet, the others are existing_value conflicts
+        """
+        AttrValue = Pool().get('product.product.attribute')
+
+        existing = AttrValue._get_existing_values(
+            list(set(r[0] for r in self.rows)),
+            list(set(r[1] for r in self.rows))
+        )
+        names = dict((id_, name) for name, (id_, _) in self.attributes.items())
+        rows = []
+        for row in self.rows:
+            if (row[0], row[1]) in existing:
+                self.resolve(
+                    'existing_value',
+                    "Product %s already has a value of attribute '%s'" % (
+                        row[0], names[row[1]]
+                    ),
+                    product=row[0], attribute=names[row[1]]
+                )
+            else:
+                rows.append(row)
+        return rows
+
+    def flush(self):
+        """
+        Insert the pending attribute values with one query and update the
+        usage counters and the attribute signatures of their products
+        """
+        AttrValue = Pool().get('product.product.attribute')
+        Product = Pool().get('product.product')
+
+        self.rows = self.get_new_rows()
+        if not self.rows:
+            return
+        types = ['value_%s' % t for t, _ in ATTRIBUTE_TYPES]
+        values = []
+        for product_id, attribute_id, type_, attr_value in self.rows:
+            column = 'value_%s' % type_
+            values.append([product_id, attribute_id] + [
+                attr_value if t == column else None for t in types
+            ])
+        AttrValue._insert_values(values)
+        Product.update_attribute_signatures([r[0] for r in self.rows])
+        self.inserted += len(values)
+        self.rows = []
+
+
 def q_and_a(question, options, cast=str):
     """
     A Q & A helper
@@ -230,7 +558,7 @@ def q_and_a(question, options, cast=str):
 
 
 def ensure_core_module_is_installed():
-    IRModule = Pool().get('ir.module.module')
+    IRModule = Pool().get('ir.module')
 
     modules = IRModule.search([('name', '=', 'product_attribute')])
 
@@ -254,7 +582,291 @@ def ensure_core_module_is_installed():
         raise Exception('Cannot continue when core module is installed!')
 
 
+class ConflictReport(SetBasedMigration):
+    """
+    Read-only pass over all the products listing every conflict the
+    migration would stop on.
+
+    The checks are the ones of the set-based migration, each conflict is
+    recorded and the attribute skipped without writing anything.
+    """
+
+    def __init__(self, attribute_kv_map, batch_size=1000):
+        super(ConflictReport, self).__init__(
+            attribute_kv_map, {}, batch_size=batch_size
+        )
+        self.details = []
+
+    def resolve(self, conflict, message, **details):
+        self.conflicts[conflict] += 1
+        details.update(conflict=conflict, message=message)
+        self.details.append(details)
+        return 'remove'
+
+    def flush(self):
+        self.inserted += len(self.get_new_rows())
+        self.rows = []
+
+    def report(self):
+        return {
+            'products': self.products,
+            'attribute_values': self.inserted,
+            'conflicts': dict(self.conflicts),
+            'details': self.details,
+        }
+
+
+class MetadataMigration(SetBasedMigration):
+    """
+    Pass over all the products resolving the conflicts which create
+    attributes, set memberships or options, without copying values.
+
+    Once done, the chunks of the checkpointed migration only have to
+    apply stateless policies and can run in parallel.
+    """
+
+    def flush(self):
+        self.rows = []
+
+
+CHECKPOINT_TABLE = 'product_attribute_migration_checkpoint'
+
+
+def create_checkpoint_table():
+    cursor = Transaction().connection.cursor()
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS "%s" (name VARCHAR(100) PRIMARY KEY, '
+        'done TIMESTAMP)' % CHECKPOINT_TABLE
+    )
+
+
+def get_checkpoints():
+    cursor = Transaction().connection.cursor()
+    table = Table(CHECKPOINT_TABLE)
+    cursor.execute(*table.select(table.name))
+    return set(name for name, in cursor.fetchall())
+
+
+def add_checkpoint(name):
+    cursor = Transaction().connection.cursor()
+    table = Table(CHECKPOINT_TABLE)
+    cursor.execute(*table.insert(
+        [table.name, table.done], [[name, CurrentTimestamp()]]
+    ))
+
+
+def chunk_name(start, end):
+    return 'products:%d-%d' % (start, end)
+
+
+def get_done_ranges():
+    """
+    Returns the sorted (start, end) product id ranges already migrated
+    """
+    ranges = []
+    for name in get_checkpoints():
+        if name.startswith('products:'):
+            start, end = name.split(':', 1)[1].split('-')
+            ranges.append((int(start), int(end)))
+    return sorted(ranges)
+
+
+def setup_checkpointed_migration(policies, batch_size):
+    """
+    Prepare the attributes and options once and record it in the
+    checkpoint table
+    """
+    create_checkpoint_table()
+    if 'setup' in get_checkpoints():
+        return
+    rename_string_to_display_name()
+    ensure_core_module_is_uninstalled()
+    migration = MetadataMigration(
+        copy_selection_options(), policies, batch_size
+    )
+    migration.run()
+    print_conflicts(migration.conflicts, policies)
+    add_checkpoint('setup')
+
+
+def get_pending_chunks(chunk_size):
+    """
+    Returns the (start, end) product id ranges not yet migrated.
+
+    The ranges of chunk_size ids are cut in the gaps between the ranges
+    already migrated, so resuming with another chunk size never migrates
+    a product twice.
+    """
+    Product = Pool().get('product.product')
+
+    cursor = Transaction().connection.cursor()
+    product = Product.__table__()
+    cursor.execute(*product.select(
+        Min(product.id), Max(product.id),
+        where=product.attributes != None  # noqa
+    ))
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+    chunks = []
+    start = first
+    for done_start, done_end in get_done_ranges() + [(last + 1, last + 1)]:
+        while start < done_start:
+            end = min(start + chunk_size, done_start)
+            chunks.append((start, end))
+            start = end
+        start = max(start, done_end)
+    return chunks
+
+
+def migrate_range(policies, batch_size, start, end):
+    """
+    Migrate the products of an id range and record it in the checkpoint
+    table in the current transaction
+    """
+    migration = SetBasedMigration(
+        load_selection_options(), policies, batch_size
+    )
+    migration.run(
+        where=lambda product: (product.id >= start) & (product.id < end)
+    )
+    add_checkpoint(chunk_name(start, end))
+    return migration
+
+
+def migrate_chunk(args):
+    """
+    Migrate the products of an id range in its own transaction
+    """
+    db_name, policies, batch_size, (start, end) = args
+    # The usage counters are recomputed once all the chunks are migrated
+    context = {'_defer_usage_counts': True}
+    with Transaction().start(db_name, 1, context=context) as txn:
+        migration = migrate_range(policies, batch_size, start, end)
+        txn.commit()
+    return start, end, migration.inserted, migration.conflicts
+
+
+def run_checkpointed_migration(db_name, args):
+    """
+    Migrate the products by chunks of ids, resuming after the last
+    committed chunk, in a pool of worker processes if asked
+    """
+    if args.workers > 1 and backend.name() == 'sqlite':
+        raise RuntimeError('SQLite does not support concurrent writers')
+
+    policies = get_policies(args)
+    with Transaction().start(db_name, 1, context={}) as txn:
+        setup_checkpointed_migration(policies, args.batch_size)
+        txn.commit()
+        chunks = get_pending_chunks(args.chunk_size)
+    print "%d chunks to migrate" % len(chunks)
+
+    tasks = [(db_name, policies, args.batch_size, c) for c in chunks]
+    workers = None
+    if args.workers > 1:
+        # Worker processes must not share the connections of the parent
+        backend.get('Database')(db_name).close()
+        workers = multiprocessing.Pool(args.workers)
+        results = workers.imap_unordered(migrate_chunk, tasks)
+    else:
+        results = imap(migrate_chunk, tasks)
+
+    conflicts = Counter()
+    try:
+        for start, end, inserted, chunk_conflicts in results:
+            conflicts.update(chunk_conflicts)
+            print "Migrated products %d to %d: %d attribute values" % (
+                start, end - 1, inserted
+            )
+    finally:
+        if workers is not None:
+            workers.close()
+            workers.join()
+    print_conflicts(conflicts, policies)
+
+    with Transaction().start(db_name, 1, context={}) as txn:
+        Pool().get('product.attribute').recompute_usage_counts()
+        txn.commit()
+
+
+def print_conflicts(conflicts, policies):
+    for conflict, count in sorted(conflicts.items()):
+        print "Resolved %d %s conflicts with %s" % (
+            count, conflict, policies[conflict]
+        )
+
+
+def to_json(value):
+    return unicode(value)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Migrate the attributes of the core product_attribute "
+        "module"
+    )
+    parser.add_argument(
+        '--non-interactive', action='store_true',
+        help="Migrate all the products at once and resolve conflicts with "
+        "the policies below instead of asking"
+    )
+    for conflict, policies in sorted(CONFLICT_POLICIES.items()):
+        parser.add_argument(
+            '--%s' % conflict.replace('_', '-'), choices=policies,
+            help="Policy for the %s conflict (default: stop)" % conflict
+        )
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="Only report the conflicts of all the products as JSON, "
+        "without changing the database"
+    )
+    parser.add_argument(
+        '--report', help="File of the dry-run report (default: stdout)"
+    )
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument(
+        '--chunk-size', type=int,
+        help="With --non-interactive, migrate products by ranges of this "
+        "many ids, each committed with a checkpoint so an interrupted "
+        "migration resumes after the last committed range"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help="Number of processes migrating the ranges of --chunk-size in "
+        "parallel (PostgreSQL only)"
+    )
+    return parser.parse_args()
+
+
+def write_report(args, report):
+    if args.report:
+        with open(args.report, 'wb') as file_:
+            json.dump(report, file_, indent=2, default=to_json)
+    else:
+        print json.dumps(report, indent=2, default=to_json)
+
+
+def get_policies(args):
+    return dict(
+        (conflict, getattr(args, conflict))
+        for conflict in CONFLICT_POLICIES if getattr(args, conflict)
+    )
+
+
+def ensure_core_module_is_uninstalled():
+    IRModule = Pool().get('ir.module')
+
+    if IRModule.search([
+            ('name', '=', 'product_attribute'),
+            ('state', '!=', 'uninstalled'),
+            ]):
+        raise Exception('Cannot continue when core module is installed!')
+
+
 if __name__ == '__main__':
+    args = parse_args()
+
     try:
         DB_NAME = os.environ['DB_NAME']
     except KeyError:
@@ -263,15 +875,39 @@ if __name__ == '__main__':
     POOL = Pool(DB_NAME)
     POOL.init()
 
+    if args.dry_run:
+        with Transaction().start(DB_NAME, 1, context={}, readonly=True):
+            conflict_report = ConflictReport(
+                read_selection_options(), args.batch_size
+            )
+            conflict_report.run()
+            write_report(args, conflict_report.report())
+        sys.exit(0)
+
+    if args.non_interactive and args.chunk_size:
+        run_checkpointed_migration(DB_NAME, args)
+        sys.exit(0)
+
     with Transaction().start(DB_NAME, 1, context={}) as txn:
         Product = Pool().get('product.product')
 
         rename_string_to_display_name()
 
-        if ensure_core_module_is_installed() is True:
+        if args.non_interactive:
+            ensure_core_module_is_uninstalled()
+
+            attribute_kv_map = copy_selection_options()
+            migration = SetBasedMigration(
+                attribute_kv_map, get_policies(args), args.batch_size
+            )
+            migration.run()
+            print "Inserted %d attribute values" % migration.inserted
+            print_conflicts(migration.conflicts, migration.policies)
+
+        elif ensure_core_module_is_installed() is True:
 
             attribute_kv_map = copy_selection_options()
             for product in Product.search([]):
                 validate_and_copy_attributes(product, attribute_kv_map)
 
-        txn.cursor.commit()
+        txn.commit()
@@ -0,0 +1,48 @@
+#! /usr/bin/env python
+"""
+Recompute the usage counters of the attributes and of their options from
+the attribute values.
+
+The counters are kept up to date by the writes of the attribute values,
+this repairs them after writes bypassing the module, like raw SQL.
+
+Usage: DB_NAME=test python recompute_usage_counts.py [attribute name ...]
+"""
+import os
+import argparse
+
+from trytond.config import config
+config.update_etc()
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        'attributes', nargs='*',
+        help='Names of the attributes to recompute (default: all)'
+    )
+    args = parser.parse_args()
+
+    try:
+        DB_NAME = os.environ['DB_NAME']
+    except KeyError:
+        raise RuntimeError('DB_NAME not found in environment')
+
+    POOL = Pool(DB_NAME)
+    POOL.init()
+
+    with Transaction().start(DB_NAME, 1, context={}) as txn:
+        Attribute = Pool().get('product.attribute')
+
+        attributes = None
+        if args.attributes:
+            attributes = Attribute.search([('name', 'in', args.attributes)])
+        Attribute.recompute_usage_counts(attributes)
+        print "Recomputed the usage counters of %s attributes" % (
+            len(attributes) if attributes is not None else 'all the'
+        )
+
+        txn.commit()
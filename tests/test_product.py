@@ -2,14 +2,28 @@
 import unittest
 import sys
 import os
+import imp
+import json
+import logging
+from contextlib import contextmanager
 from decimal import Decimal
 from datetime import datetime
 from datetime import date
 from datetime import time
 
+from sql import Null
+
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, ModuleTestCase, with_transaction
+from trytond import backend
+from trytond.config import config
 from trytond.exceptions import UserError
+from trytond.protocols.jsonrpc import JSONEncoder
+from trytond.transaction import Transaction
+from trytond.modules.product_attribute_strict.instrumentation import (
+    CONTEXT_FLAG, QueryCounter, get_report, logger as instrumentation_logger
+)
+from trytond.modules.product_attribute_strict.product import ATTRIBUTE_TYPES
 
 DIR = os.path.abspath(os.path.normpath(os.path.join(
     __file__, '..', '..', '..', '..', '..', 'trytond'
@@ -17,6 +31,129 @@ DIR = os.path.abspath(os.path.normpath(os.path.join(
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
+SCRIPTS = os.path.join(os.path.dirname(__file__), '..', 'scripts')
+
+
+def load_script(name):
+    """
+    Import a script of the module by its name
+    """
+    return imp.load_source(name, os.path.join(SCRIPTS, name + '.py'))
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the queries executed in the current transaction
+    """
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = counter = QueryCounter(connection)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+@contextmanager
+def patch_classmethod(cls, name, function):
+    """
+    Replace a class method of a pool class while in the context
+    """
+    original = cls.__dict__.get(name)
+    setattr(cls, name, classmethod(function))
+    try:
+        yield
+    finally:
+        if original is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, original)
+
+
+class ScriptedConnection(object):
+    """
+    Connection whose cursor records the queries, returns the rows one by
+    one to fetchone and raises the error on the CREATE statements
+    """
+
+    def __init__(self, rows=(), error=None):
+        self.rows = list(rows)
+        self.error = error
+        self.queries = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        self.queries.append(query)
+        if self.error and query.startswith('CREATE'):
+            raise self.error
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+
+@contextmanager
+def scripted_connection(rows=(), error=None):
+    """
+    Replace the connection of the current transaction by a
+    ScriptedConnection while in the context
+    """
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = scripted = ScriptedConnection(rows, error)
+    try:
+        yield scripted
+    finally:
+        transaction.connection = connection
+
+
+@contextmanager
+def missing_column(name):
+    """
+    Report the column as missing to the first check of the table handlers
+    while in the context
+    """
+    TableHandler = backend.get('TableHandler')
+    column_exist = TableHandler.__dict__['column_exist']
+    checks = []
+
+    def patched(self, column_name):
+        if column_name == name and not checks:
+            checks.append(column_name)
+            return False
+        return column_exist(self, column_name)
+
+    TableHandler.column_exist = patched
+    try:
+        yield
+    finally:
+        TableHandler.column_exist = column_exist
+
+
+@contextmanager
+def value_storage(mode):
+    """
+    Store the attribute values in the storage mode while in the context
+    """
+    ProductAttribute = POOL.get('product.product.attribute')
+    section = 'product_attribute_strict'
+
+    def setup(mode):
+        config.set(section, 'value_storage', mode)
+        ProductAttribute.__setup__()
+        ProductAttribute.__post_setup__()
+
+    if not config.has_section(section):
+        config.add_section(section)
+    original = ProductAttribute._value_storage
+    setup(mode)
+    try:
+        yield
+    finally:
+        setup(original)
+
 
 class TestProduct(ModuleTestCase):
     '''
@@ -50,6 +187,76 @@ class TestProduct(ModuleTestCase):
             'attribute_set': attribute_set,
         }])[0]
 
+    def _create_core_products(self):
+        """
+        Create attributes and products with the attributes and selections
+        of the core product_attribute module stored like it does, and
+        return the products by code.
+
+        Must be called first in the transaction as adding the columns of
+        the core module commits it on SQLite.
+        """
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+
+        for Model, column in [
+                (self.Product, 'attributes'),
+                (self.Attribute, 'selection'),
+                ]:
+            if not TableHandler(Model).column_exist(column):
+                cursor.execute('ALTER TABLE "%s" ADD COLUMN "%s" TEXT' % (
+                    Model._table, column
+                ))
+
+        color, weight, released, material = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+        }, {
+            'name': 'weight',
+            'type_': 'numeric',
+        }, {
+            'name': 'released',
+            'type_': 'datetime',
+        }, {
+            'name': 'material',
+        }])
+        attribute = self.Attribute.__table__()
+        cursor.execute(*attribute.update(
+            [attribute.selection], ['red: Red\nblue: Blue\n'],
+            where=attribute.id == color.id
+        ))
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, weight.id, released.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        no_set_template = self._create_product_template()
+
+        products = {}
+        product = self.Product.__table__()
+        for code, template_id, attributes in [
+                ('P1', template.id, {'color': 'red', 'weight': '2.5'}),
+                ('P2', template.id, {'color': 'green'}),
+                ('P3', template.id, {
+                    'size': 'M', 'weight': 1, 'material': 'Cotton',
+                }),
+                ('P4', no_set_template.id, {'color': 'blue'}),
+                ('P5', template.id, {
+                    'released': datetime(2016, 5, 17, 10, 30, 15, 500000),
+                }),
+                ('P6', template.id, {}),
+                ]:
+            products[code], = self.Product.create([{
+                'template': template_id,
+                'code': code,
+            }])
+            cursor.execute(*product.update(
+                [product.attributes],
+                [json.dumps(attributes, cls=JSONEncoder)],
+                where=product.id == products[code].id
+            ))
+        return products
+
     @with_transaction()
     def test0010_add_product_attributes(self):
         """
@@ -216,6 +423,2008 @@ class TestProduct(ModuleTestCase):
             prod_attribute.product.template.attribute_set
         )
 
+    def _create_typed_attributes(self):
+        """
+        Create an attribute of each type in a single attribute set and a
+        product having a value for each of them
+        """
+        values = {
+            'boolean': True,
+            'integer': 42,
+            'char': u'Blue',
+            'float': 1.5,
+            'numeric': Decimal('10.25'),
+            'date': date(2016, 5, 17),
+            'datetime': datetime(2016, 5, 17, 10, 30, 15),
+        }
+        attributes = {}
+        for type_ in values.keys() + ['selection']:
+            attributes[type_], = self.Attribute.create([{
+                'name': 'Test %s' % type_,
+                'type_': type_,
+            }])
+        option, = self.SelectionOption.create([{
+            'name': 'Red',
+            'attribute': attributes['selection'].id,
+        }])
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [a.id for a in attributes.values()])],
+        }])
+        template = self._create_product_template(attribute_set)
+
+        attribute_values = [{
+            'attribute': attributes[type_].id,
+            'value_%s' % type_: value,
+        } for type_, value in values.iteritems()]
+        attribute_values.append({
+            'attribute': attributes['selection'].id,
+            'value_selection': option.id,
+        })
+        product, = self.Product.create([{
+            'template': template.id,
+            'attributes': [('create', attribute_values)],
+        }])
+        return product, attributes, option
+
+    @with_transaction()
+    def test0020_attribute_value_for_each_type(self):
+        """
+        Check the consolidated value of attributes of every type
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, _, _ = self._create_typed_attributes()
+
+        expected = {
+            'boolean': u'True',
+            'integer': u'42',
+            'char': u'Blue',
+            'float': u'1.5',
+            'numeric': u'10.25',
+            'date': u'2016-05-17',
+            'datetime': u'2016-05-17 10:30:15',
+            'selection': u'Red',
+        }
+        for attribute_value in ProductAttribute.browse(product.attributes):
+            self.assertEqual(
+                attribute_value.value,
+                expected[attribute_value.attribute_type]
+            )
+        self.assertEqual(ProductAttribute.format_value('char', None), None)
+
+    @with_transaction()
+    def test0030_attribute_info_query_count(self):
+        """
+        Check that reading attribute type and set does not issue more
+        queries for larger batches
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        attribute, = self.Attribute.create([{
+            'name': 'Test Char',
+        }])
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [attribute.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        products = self.Product.create([{
+            'template': template.id,
+            'attributes': [('create', [{
+                'attribute': attribute.id,
+                'value_char': 'Value %d' % i,
+            }])],
+        } for i in range(50)])
+        ids = [p.attributes[0].id for p in products]
+        fields_names = ['attribute_type', 'attribute_set']
+
+        # Warm up the caches
+        ProductAttribute.read(ids[:1], fields_names)
+
+        counts = []
+        for size in (5, 50):
+            with count_queries() as counter:
+                result = ProductAttribute.read(ids[:size], fields_names)
+            counts.append(counter.count)
+            self.assertEqual(len(result), size)
+            for row in result:
+                self.assertEqual(row['attribute_type'], 'char')
+                self.assertEqual(row['attribute_set'], attribute_set.id)
+        self.assertTrue(counts[0])
+        self.assertEqual(counts[0], counts[1])
+
+    @with_transaction()
+    def test0040_product_attribute_set(self):
+        """
+        Check the attribute set of products and its context fallback
+        """
+        attribute_set1, attribute_set2 = self.AttributeSet.create([{
+            'name': 'Test attribute set 1',
+        }, {
+            'name': 'Test attribute set 2',
+        }])
+        template1 = self._create_product_template(attribute_set1)
+        template2 = self._create_product_template()
+        product1, product2 = self.Product.create([{
+            'template': template1.id,
+        }, {
+            'template': template2.id,
+        }])
+
+        self.assertEqual(
+            self.Product.get_attribute_set(
+                [product1, product2], 'attribute_set'
+            ),
+            {product1.id: attribute_set1.id, product2.id: None}
+        )
+        with Transaction().set_context(attribute_set=attribute_set2.id):
+            self.assertEqual(
+                self.Product.get_attribute_set(
+                    [product1, product2], 'attribute_set'
+                ),
+                {product1.id: attribute_set1.id, product2.id: attribute_set2.id}
+            )
+
+        product = self.Product(template=template1)
+        self.assertEqual(
+            product.on_change_with_attribute_set(), attribute_set1.id
+        )
+        product = self.Product(template=template2)
+        self.assertEqual(product.on_change_with_attribute_set(), None)
+        product = self.Product(template=self.Template(
+            attribute_set=attribute_set2
+        ))
+        self.assertEqual(
+            product.on_change_with_attribute_set(), attribute_set2.id
+        )
+
+    @with_transaction()
+    def test0050_search_value(self):
+        """
+        Check searching attribute values on the consolidated value
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+
+        def search_types(clause):
+            return sorted(
+                a.attribute_type for a in ProductAttribute.search([clause])
+            )
+
+        self.assertEqual(search_types(('value', '=', 'Blue')), ['char'])
+        self.assertEqual(search_types(('value', '=', 'Red')), ['selection'])
+        self.assertEqual(search_types(('value', 'ilike', 're%')), ['selection'])
+        self.assertEqual(search_types(('value', '=', '42')), ['integer'])
+        # Char and selection values are compared as strings
+        self.assertEqual(
+            search_types(('value', '>', '10')),
+            ['char', 'integer', 'numeric', 'selection']
+        )
+        self.assertEqual(
+            search_types(('value', 'in', ['1.5', 'Blue'])),
+            ['char', 'float']
+        )
+        self.assertEqual(search_types(('value', '=', 'True')), ['boolean'])
+        self.assertEqual(search_types(('value', '=', '2016-05-17')), ['date'])
+        self.assertEqual(
+            search_types(('value', '=', '2016-05-17 10:30:15')), ['datetime']
+        )
+        self.assertEqual(search_types(('value', '=', 'Unknown')), [])
+        self.assertEqual(
+            search_types(('value', '!=', 'Blue')),
+            sorted(t for t in attributes if t != 'char')
+        )
+        # The like operators only match char values and option names
+        self.assertEqual(search_types(('value', 'like', '4%')), [])
+        self.assertEqual(
+            search_types(('value', 'not like', '%zzz%')), sorted(attributes)
+        )
+        self.assertEqual(
+            search_types(('value', 'not ilike', '%BLU%')),
+            sorted(t for t in attributes if t != 'char')
+        )
+
+    @with_transaction()
+    def test0060_facets(self):
+        """
+        Check the facets of products with their counts
+        """
+        color, size = self.Attribute.create([{
+            'name': 'color',
+            'display_name': 'Color',
+            'type_': 'selection',
+            'selection': [('create', [{
+                'name': 'Blue',
+            }, {
+                'name': 'Red',
+            }, {
+                'name': 'Green',
+            }])],
+        }, {
+            'name': 'size',
+            'type_': 'integer',
+        }])
+        blue, red, green = color.selection
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, size.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        self.Product.create([{
+            'template': template.id,
+            'code': code,
+            'attributes': [('create', [{
+                'attribute': color.id,
+                'value_selection': option.id,
+            }, {
+                'attribute': size.id,
+                'value_integer': value,
+            }])],
+        } for code, option, value in [
+            ('P1', blue, 10), ('P2', red, 10), ('P3', red, 12),
+        ]])
+
+        facets = self.Product.get_facets([])
+        self.assertEqual(
+            [(f['name'], f['display_name'], f['type']) for f in facets],
+            [('color', 'Color', 'selection'), ('size', 'size', 'integer')]
+        )
+        self.assertEqual(
+            [(v['name'], v['count']) for v in facets[0]['values']],
+            [('Blue', 1), ('Red', 2), ('Green', 0)]
+        )
+        self.assertEqual(
+            [(v['value'], v['name'], v['count']) for v in facets[1]['values']],
+            [(10, '10', 2), (12, '12', 1)]
+        )
+
+        facets = self.Product.get_facets([('code', 'in', ['P2', 'P3'])])
+        self.assertEqual(
+            [(v['name'], v['count']) for v in facets[0]['values']],
+            [('Blue', 0), ('Red', 2), ('Green', 0)]
+        )
+        self.assertEqual(
+            [(v['value'], v['count']) for v in facets[1]['values']],
+            [(10, 1), (12, 1)]
+        )
+        self.assertEqual(self.Product.get_facets([('code', '=', 'X')]), [])
+
+        # The storefront calls it without write access
+        self.assertTrue(self.Product.__rpc__['get_facets'].readonly)
+
+    @with_transaction()
+    def test0070_import_values(self):
+        """
+        Check the bulk import of attribute values
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        color, weight, other = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+            'selection': [('create', [{
+                'name': 'Red',
+            }])],
+        }, {
+            'name': 'weight',
+            'type_': 'numeric',
+        }, {
+            'name': 'other',
+        }])
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, weight.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        product, = self.Product.create([{
+            'template': template.id,
+            'code': 'P1',
+        }])
+
+        errors = ProductAttribute.import_values([
+            ('P1', 'color', 'Blue'),
+            ('P2', 'color', 'Red'),
+            ('P1', 'size', 'M'),
+            ('P1', 'other', 'Value'),
+            ('P1', 'color', 'Red'),
+            ('P1', 'weight', 'heavy'),
+            ('P1', 'weight', None),
+            ('P1', 'weight', '2.5'),
+        ], batch_size=3)
+
+        self.assertEqual(
+            [number for number, _ in errors], [1, 2, 3, 4, 6, 7]
+        )
+        self.assertIn('"Blue" is not an option', errors[0][1])
+        self.assertIn('not a valid numeric value', errors[5][1])
+        self.assertEqual(
+            sorted(
+                (a.attribute.name, a.value)
+                for a in ProductAttribute.search([('product', '=', product)])
+            ),
+            [('color', 'Red'), ('weight', '2.5')]
+        )
+
+    @with_transaction()
+    def test0080_export_attributes(self):
+        """
+        Check the streaming export of attribute values
+        """
+        product, attributes, option = self._create_typed_attributes()
+        other, = self.Product.create([{
+            'template': product.template.id,
+            'code': 'OTHER',
+            'attributes': [('create', [{
+                'attribute': attributes['char'].id,
+                'value_char': 'Other',
+            }])],
+        }])
+
+        rows = list(self.Product.export_attributes(chunk_size=3))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(
+            dict((r[2], r[3]) for r in rows if r[0] == product.id),
+            {
+                'Test boolean': True,
+                'Test integer': 42,
+                'Test char': 'Blue',
+                'Test float': 1.5,
+                'Test numeric': Decimal('10.25'),
+                'Test date': date(2016, 5, 17),
+                'Test datetime': datetime(2016, 5, 17, 10, 30, 15),
+                'Test selection': 'Red',
+            }
+        )
+        self.assertEqual(
+            list(self.Product.export_attributes([('code', '=', 'OTHER')])),
+            [(other.id, 'OTHER', 'Test char', 'Other')]
+        )
+
+        # Exports can be interleaved and their cursors are closed even when
+        # they are not exhausted
+        class ExportCursor(object):
+
+            def __init__(self, cursor):
+                self.cursor = cursor
+                self.closed = False
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+            def close(self):
+                self.closed = True
+                self.cursor.close()
+
+        cursors = []
+        get_export_cursor = self.Product._get_export_cursor
+
+        def record_cursor(cls):
+            cursors.append(ExportCursor(get_export_cursor()))
+            return cursors[-1]
+
+        with patch_classmethod(
+                self.Product, '_get_export_cursor', record_cursor):
+            first = self.Product.export_attributes(chunk_size=1)
+            second = self.Product.export_attributes(chunk_size=1)
+            self.assertEqual(next(first)[0], product.id)
+            self.assertEqual(len(list(second)), 9)
+            first.close()
+        self.assertEqual([c.closed for c in cursors], [True, True])
+
+    @with_transaction()
+    def test0090_attribute_metadata_cache(self):
+        """
+        Check that attribute metadata is cached and invalidated on writes
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        Option = POOL.get('product.attribute.selection_option')
+
+        product, attributes, option = self._create_typed_attributes()
+        attribute = attributes['selection']
+        ids = [a.id for a in product.attributes]
+
+        # Warm up the caches
+        ProductAttribute.read(ids, ['value', 'attribute_type'])
+        with count_queries() as counter:
+            self.Attribute.get_metadata([attribute.id])
+        self.assertEqual(counter.count, 0)
+        with count_queries() as counter:
+            ProductAttribute.get_typed_values(ids)
+        self.assertEqual(counter.count, 1)
+
+        self.Attribute.write([attribute], {'display_name': 'Colour'})
+        Option.write([option], {'name': 'Crimson'})
+        self.assertEqual(
+            self.Attribute.get_metadata([attribute.id])[attribute.id],
+            {
+                'name': 'Test selection',
+                'display_name': 'Colour',
+                'type_': 'selection',
+                'options': {option.id: 'Crimson'},
+            }
+        )
+        self.assertEqual(self.Attribute(attribute.id).rec_name, 'Colour')
+        self.assertIn(
+            ('selection', 'Crimson'),
+            ProductAttribute.get_typed_values(ids).values()
+        )
+
+        unused, = Option.create([{
+            'name': 'Unused',
+            'attribute': attribute.id,
+        }])
+        self.assertIn(
+            unused.id,
+            self.Attribute.get_metadata([attribute.id])[attribute.id][
+                'options'
+            ]
+        )
+        Option.delete([unused])
+        self.assertEqual(
+            self.Attribute.get_metadata([attribute.id])[attribute.id][
+                'options'
+            ],
+            {option.id: 'Crimson'}
+        )
+
+    @with_transaction()
+    def test0100_attribute_set_membership(self):
+        """
+        Check the cached attributes of sets and the batch validation of
+        attribute values against them
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        color, size = self.Attribute.create([{
+            'name': 'color',
+        }, {
+            'name': 'size',
+        }])
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        products = self.Product.create([{
+            'template': template.id,
+            'code': 'P%d' % i,
+        } for i in range(3)])
+
+        self.assertEqual(
+            self.AttributeSet.get_attribute_ids([attribute_set.id]),
+            {attribute_set.id: frozenset([color.id])}
+        )
+        with count_queries() as counter:
+            self.AttributeSet.get_attribute_ids([attribute_set.id])
+        self.assertEqual(counter.count, 0)
+
+        with self.assertRaises(UserError) as cm:
+            ProductAttribute.create([{
+                'product': product.id,
+                'attribute': attribute.id,
+                'value_char': 'Value',
+            } for product in products[:2] for attribute in (color, size)])
+        message = cm.exception.message
+        self.assertIn('P0', message)
+        self.assertIn('P1', message)
+        self.assertNotIn('color', message)
+
+        self.AttributeSet.write([attribute_set], {
+            'attributes': [('add', [size.id])],
+        })
+        self.assertEqual(
+            self.AttributeSet.get_attribute_ids([attribute_set.id]),
+            {attribute_set.id: frozenset([color.id, size.id])}
+        )
+        ProductAttribute.create([{
+            'product': products[2].id,
+            'attribute': size.id,
+            'value_char': 'XL',
+        }])
+
+        other_set, = self.AttributeSet.create([{
+            'name': 'Other attribute set',
+        }])
+        AttributeSetRelation = POOL.get(
+            'product.attribute-product.attribute-set'
+        )
+        relation, = AttributeSetRelation.search([
+            ('attribute', '=', color.id),
+        ])
+        AttributeSetRelation.write([relation], {
+            'attribute_set': other_set.id,
+        })
+        self.assertEqual(
+            self.AttributeSet.get_attribute_ids([attribute_set.id]),
+            {attribute_set.id: frozenset([size.id])}
+        )
+
+        # Like the domain of the attribute field, products without set only
+        # hold attributes which are in no set
+        material, = self.Attribute.create([{
+            'name': 'material',
+        }])
+        unset, = self.Product.create([{
+            'template': self._create_product_template().id,
+            'code': 'UNSET',
+            'attributes': [('create', [{
+                'attribute': material.id,
+                'value_char': 'Wood',
+            }])],
+        }])
+        self.Product.write([unset], {'code': 'UNSET1'})
+        # unless the set in context applies to them like in the domain of
+        # the attributes field
+        with Transaction().set_context(attribute_set=attribute_set.id):
+            with self.assertRaises(UserError):
+                self.Product.write([unset], {'code': 'UNSET2'})
+        with self.assertRaises(UserError):
+            ProductAttribute.create([{
+                'product': unset.id,
+                'attribute': size.id,
+                'value_char': 'XL',
+            }])
+
+    @with_transaction()
+    def test0110_selection_option_validation(self):
+        """
+        Check that options of another attribute are rejected in batch
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        color, size = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+            'selection': [('create', [{'name': 'Red'}])],
+        }, {
+            'name': 'size',
+            'type_': 'selection',
+            'selection': [('create', [{'name': 'XL'}])],
+        }])
+        red, = color.selection
+        xl, = size.selection
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, size.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        products = self.Product.create([{
+            'template': template.id,
+            'code': 'P%d' % i,
+        } for i in range(4)])
+
+        with self.assertRaises(UserError) as cm:
+            ProductAttribute.create([{
+                'product': product.id,
+                'attribute': color.id,
+                'value_selection': option.id,
+            } for product, option in zip(products, (xl, red, xl))])
+        message = cm.exception.message
+        self.assertIn('[P0] Test Template 1: color = XL', message)
+        self.assertIn('[P2] Test Template 1: color = XL', message)
+        self.assertNotIn('Red', message)
+
+        value, = ProductAttribute.create([{
+            'product': products[3].id,
+            'attribute': color.id,
+            'value_selection': red.id,
+        }])
+        with self.assertRaises(UserError):
+            ProductAttribute.write([value], {'value_selection': xl.id})
+
+    @with_transaction()
+    def test0120_set_attributes(self):
+        """
+        Check the bulk insert or update of attribute values
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+        blue, = self.SelectionOption.create([{
+            'name': 'Blue',
+            'attribute': attributes['selection'].id,
+        }])
+        other, = self.Product.create([{
+            'template': product.template.id,
+            'code': 'OTHER',
+        }])
+
+        # Warm up the caches
+        self.Attribute.get_metadata([a.id for a in attributes.values()])
+        self.AttributeSet.get_attribute_ids([
+            product.template.attribute_set.id
+        ])
+        # Without INSERT ... ON CONFLICT: one query for the product sets,
+        # one for the existing values, one update per attribute, one
+        # insert, two for the usage counters of the inserted values, one
+        # for the counters of the options replaced and two for the
+        # signatures
+        no_upsert = patch_classmethod(
+            ProductAttribute, '_upsert_supported', lambda cls: False)
+        with no_upsert, count_queries() as counter:
+            ProductAttribute.set_attributes([product, other], {
+                attributes['char']: 'Green',
+                attributes['integer'].id: '7',
+                attributes['selection']: blue,
+            })
+        self.assertEqual(counter.count, 11)
+        self.assertEqual([
+            o.usage_count for o in self.SelectionOption.browse([option, blue])
+        ], [0, 2])
+
+        for record in (product, other):
+            values = ProductAttribute.search([('product', '=', record.id)])
+            typed_values = dict(
+                ProductAttribute.get_typed_values(map(int, values)).values()
+            )
+            self.assertEqual(typed_values['char'], 'Green')
+            self.assertEqual(typed_values['integer'], 7)
+            self.assertEqual(typed_values['selection'], 'Blue')
+        self.assertEqual(
+            ProductAttribute.search_count([('product', '=', product.id)]), 8
+        )
+        self.assertEqual(
+            ProductAttribute.search_count([('product', '=', other.id)]), 3
+        )
+
+        with self.assertRaises(UserError):
+            ProductAttribute.set_attributes([other], {
+                attributes['selection']: self.SelectionOption.create([{
+                    'name': 'Other',
+                    'attribute': attributes['char'].id,
+                }])[0],
+            })
+        with self.assertRaises(UserError):
+            ProductAttribute.set_attributes([other], {
+                attributes['integer']: 'seven',
+            })
+        with self.assertRaises(UserError):
+            ProductAttribute.set_attributes([other], {
+                attributes['integer']: None,
+            })
+        # Missing products are reported before writing anything
+        with self.assertRaises(UserError) as cm:
+            ProductAttribute.set_attributes([other.id, 999999], {
+                attributes['selection']: option,
+            })
+        self.assertIn('999999', cm.exception.message)
+        with self.assertRaises(UserError):
+            ProductAttribute.replace_attributes({
+                888888: {'Test selection': 'Red'},
+            })
+        self.assertEqual(
+            ProductAttribute.search_count([
+                ('product', 'in', [999999, 888888]),
+            ]), 0
+        )
+        self.assertEqual([
+            o.usage_count for o in self.SelectionOption.browse([option, blue])
+        ], [0, 2])
+        size, = self.Attribute.create([{
+            'name': 'size',
+        }])
+        with self.assertRaises(UserError):
+            ProductAttribute.set_attributes([other], {size: 'XL'})
+
+    @with_transaction()
+    def test0130_attribute_filter(self):
+        """
+        Search products on several attribute conditions
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        color, size, weight = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+            'selection': [('create', [{'name': 'Red'}, {'name': 'Blue'}])],
+        }, {
+            'name': 'size',
+            'type_': 'char',
+        }, {
+            'name': 'weight',
+            'type_': 'float',
+        }])
+        red, blue = sorted(color.selection, key=lambda o: o.name, reverse=True)
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, size.id, weight.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        products = self.Product.create([{
+            'template': template.id,
+            'code': 'P%d' % i,
+        } for i in range(4)])
+        for product, values in zip(products, [
+                    {color: red, size: 'M', weight: 2.0},
+                    {color: red, size: 'S', weight: 1.0},
+                    {color: blue, size: 'M', weight: 1.0},
+                    {size: 'L', weight: 3.0},
+                ]):
+            ProductAttribute.set_attributes([product], values)
+
+        def search(operator, conditions):
+            return [p.code for p in self.Product.search(
+                [('attribute_filter', operator, conditions)],
+                order=[('code', 'ASC')]
+            )]
+
+        self.assertEqual(search('where', [
+            ('color', '=', 'Red'),
+            ('size', 'in', ['M', 'L']),
+            ('weight', '<', 2.5),
+        ]), ['P0'])
+        self.assertEqual(search('where', [
+            (weight.id, '<', '2.5'),
+            (weight.id, '>', 0.5),
+        ]), ['P0', 'P1', 'P2'])
+        self.assertEqual(search('where', [('size', 'like', '%')]), [
+            'P0', 'P1', 'P2', 'P3'
+        ])
+        self.assertEqual(search('where', [('color', '!=', 'Red')]), ['P2'])
+        self.assertEqual(search('not where', [('color', '=', 'Red')]), [
+            'P2', 'P3'
+        ])
+        self.assertEqual(search('where', [('weight', '=', 'heavy')]), [])
+        self.assertEqual(search('where', [('unknown', '=', 'Red')]), [])
+        self.assertEqual(len(search('where', [])), 4)
+        self.assertEqual(products[0].attribute_filter, None)
+
+    @with_transaction()
+    def test0140_attribute_signature(self):
+        """
+        Check the attribute signature of products and the duplicate lookups
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+        values = dict(
+            (attributes[type_], value) for type_, value in [
+                ('boolean', True),
+                ('integer', 42),
+                ('char', 'Blue'),
+                ('float', 1.5),
+                ('numeric', Decimal('10.250')),
+                ('date', date(2016, 5, 17)),
+                ('datetime', datetime(2016, 5, 17, 10, 30, 15)),
+                ('selection', option),
+            ]
+        )
+        self.assertTrue(product.attribute_signature)
+        self.assertEqual(
+            self.Product.get_attribute_signature(values),
+            product.attribute_signature
+        )
+
+        duplicate, other = self.Product.create([{
+            'template': product.template.id,
+        }, {
+            'template': product.template.id,
+        }])
+        self.assertEqual(other.attribute_signature, None)
+        ProductAttribute.set_attributes([duplicate, other], values)
+        ProductAttribute.set_attributes(
+            [other], {attributes['char']: 'Green'}
+        )
+        self.assertEqual(
+            self.Product(duplicate.id).attribute_signature,
+            product.attribute_signature
+        )
+        self.assertNotEqual(
+            self.Product(other.id).attribute_signature,
+            product.attribute_signature
+        )
+
+        self.assertEqual(
+            self.Product.find_by_attributes(product.template, values),
+            [product, duplicate]
+        )
+        self.assertEqual(
+            self.Product.find_duplicates(), [[product, duplicate]]
+        )
+        self.assertEqual(
+            self.Product.find_duplicates([('id', '!=', product.id)]), []
+        )
+
+        ProductAttribute.delete(ProductAttribute.search([
+            ('product', '=', duplicate.id),
+        ]))
+        self.assertEqual(self.Product(duplicate.id).attribute_signature, None)
+        self.assertEqual(self.Product.find_duplicates(), [])
+        self.assertEqual(self.Product.get_attribute_signature({}), None)
+
+    @with_transaction()
+    def test0150_generate_variants(self):
+        """
+        Check the generation of the missing variants of a template
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        color, size, material = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+        }, {
+            'name': 'size',
+            'type_': 'selection',
+        }, {
+            'name': 'material',
+            'type_': 'char',
+        }])
+        red, blue, small, medium, large = self.SelectionOption.create([{
+            'name': name,
+            'attribute': attribute.id,
+        } for attribute, name in [
+            (color, 'Red'), (color, 'Blue'),
+            (size, 'S'), (size, 'M'), (size, 'L'),
+        ]])
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, size.id, material.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        # A variant with a value of an attribute which is not generated
+        # still uses its combination, a variant without size uses none
+        self.Product.create([{
+            'template': template.id,
+            'attributes': [('create', [{
+                'attribute': color.id,
+                'value_selection': red.id,
+            }, {
+                'attribute': size.id,
+                'value_selection': small.id,
+            }, {
+                'attribute': material.id,
+                'value_char': 'Cotton',
+            }])],
+        }, {
+            'template': template.id,
+            'attributes': [('create', [{
+                'attribute': color.id,
+                'value_selection': blue.id,
+            }])],
+        }])
+
+        options = {
+            color: [red, blue],
+            str(size.id): [small.id, medium.id, large.id],
+        }
+        variants = self.Template.generate_variants(
+            template, options, batch_size=2
+        )
+        self.assertEqual(len(variants), 5)
+        combinations = set()
+        for variant in variants:
+            values = ProductAttribute.search([('product', '=', variant.id)])
+            combinations.add(frozenset(
+                (v.attribute.id, v.value_selection.id) for v in values
+            ))
+            self.assertEqual(
+                self.Product(variant.id).attribute_signature,
+                self.Product.get_attribute_signature(
+                    dict((v.attribute, v.value_selection) for v in values)
+                )
+            )
+        self.assertEqual(combinations, set(
+            frozenset([(color.id, c.id), (size.id, s.id)])
+            for c in (red, blue) for s in (small, medium, large)
+            if (c, s) != (red, small)
+        ))
+        self.assertEqual(self.Product.search([
+            ('template', '=', template.id),
+        ], count=True), 7)
+
+        self.assertEqual(
+            self.Template.generate_variants(template, options), []
+        )
+        self.assertEqual(self.Template.generate_variants(template, {}), [])
+        # The existing combinations are read once whatever the number of
+        # batches
+        counts = []
+        for batch_size in [1000, 1]:
+            with count_queries() as counter:
+                self.Template.generate_variants(
+                    template, options, batch_size=batch_size
+                )
+            counts.append(counter.count)
+        self.assertEqual(counts[0], counts[1])
+
+        with self.assertRaises(UserError):
+            self.Template.generate_variants(template, {material: []})
+        with self.assertRaises(UserError):
+            self.Template.generate_variants(template, {color: [small]})
+        other_template = self._create_product_template()
+        with self.assertRaises(UserError):
+            self.Template.generate_variants(other_template, {color: [red]})
+
+    @with_transaction()
+    def test0160_text_search(self):
+        """
+        Search text in the char values and option names
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+        blue, = ProductAttribute.search([
+            ('product', '=', product.id),
+            ('attribute', '=', attributes['char'].id),
+        ])
+        red, = ProductAttribute.search([
+            ('product', '=', product.id),
+            ('attribute', '=', attributes['selection'].id),
+        ])
+        other, = self.Product.create([{
+            'template': product.template.id,
+        }])
+        ProductAttribute.set_attributes(
+            [other], {attributes['char']: 'Navy blue'}
+        )
+        navy, = ProductAttribute.search([('product', '=', other.id)])
+
+        def search(pattern, operator='ilike'):
+            return (
+                ProductAttribute.search([('value_text', operator, pattern)]),
+                self.Product.search([('attribute_text', operator, pattern)]),
+            )
+
+        self.assertEqual(search('%BLUE%'), ([blue, navy], [product, other]))
+        self.assertEqual(search('%Re%'), ([red], [product]))
+        self.assertEqual(search('Navy%'), ([navy], [other]))
+        self.assertEqual(search('%green%'), ([], []))
+        values, products = search('%navy%', 'not ilike')
+        self.assertEqual(len(values), len(attributes))
+        self.assertNotIn(navy, values)
+        self.assertEqual(products, [product])
+
+        self.assertEqual(search('Navy blue', '='), ([navy], [other]))
+        # Without the text table of SQLite, like PostgreSQL without pg_trgm
+        no_text_table = patch_classmethod(
+            ProductAttribute, '_text_table_exists', lambda cls: False
+        )
+        with no_text_table:
+            self.assertEqual(
+                search('%BLUE%'), ([blue, navy], [product, other])
+            )
+            self.assertEqual(search('Navy%', 'like'), ([navy], [other]))
+
+        ProductAttribute.write([blue], {'value_char': 'Green'})
+        self.assertEqual(search('%green%'), ([blue], [product]))
+        self.assertEqual(search('%blue%'), ([navy], [other]))
+        ProductAttribute.delete([navy])
+        self.assertEqual(search('%blue%'), ([], []))
+
+    @with_transaction()
+    def test0170_instrumentation(self):
+        """
+        Check the instrumentation records of the attribute models
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+        ids = map(int, product.attributes)
+        get_report(reset=True)
+
+        ProductAttribute.read(ids, ['value'])
+        self.assertEqual(get_report(), [])
+
+        with Transaction().set_context({CONTEXT_FLAG: True}):
+            with count_queries() as counter:
+                ProductAttribute.read(ids, ['value'])
+            self.Product.search([('attribute_text', 'ilike', '%blue%')])
+        report = dict((r['name'], r) for r in get_report(reset=True))
+        get_value = report['product.product.attribute.get_value']
+        self.assertEqual(get_value['calls'], 1)
+        self.assertEqual(get_value['queries'], counter.count)
+        self.assertEqual(get_value['rows'], len(ids))
+        self.assertTrue(get_value['time'] > 0)
+        self.assertEqual(
+            report['product.product.search_attribute_text']['calls'], 1
+        )
+        self.assertEqual(
+            report['product.product.attribute.get_text_query']['calls'], 1
+        )
+        self.assertEqual(get_report(), [])
+        self.assertEqual(self.Attribute.instrumentation_report(), [])
+
+        # Generators are measured over their whole iteration
+        with Transaction().set_context({CONTEXT_FLAG: True}):
+            export = self.Product.export_attributes(chunk_size=3)
+            self.assertEqual(get_report(), [])
+            self.assertEqual(len(list(export)), len(ids))
+            export = self.Product.export_attributes()
+            next(export)
+            export.close()
+        report = dict(
+            (r['name'], r) for r in get_report(reset=True)
+        )['product.product.export_attributes']
+        self.assertEqual(report['calls'], 2)
+        self.assertTrue(report['queries'] >= 2)
+        self.assertTrue(report['rows'] >= 2 * len(ids))
+
+        # The getter of several Function fields is called with their names
+        # and the calls are recorded when the logger is enabled for DEBUG
+        level = instrumentation_logger.level
+        instrumentation_logger.setLevel(logging.DEBUG)
+        try:
+            values = ProductAttribute.read(
+                ids, ['attribute_type', 'attribute_set'])
+        finally:
+            instrumentation_logger.setLevel(level)
+        self.assertEqual(
+            set(v['attribute_type'] for v in values), set(attributes)
+        )
+        report, = [
+            r for r in get_report(reset=True)
+            if r['name'] == 'product.product.attribute.get_attribute_info'
+        ]
+        self.assertEqual(report['calls'], 1)
+
+    @with_transaction()
+    def test0180_attributes_dict(self):
+        """
+        Read the attribute values of products as dictionaries
+        """
+        product, attributes, option = self._create_typed_attributes()
+        other, = self.Product.create([{
+            'template': product.template.id,
+        }])
+        expected = {
+            'Test boolean': True,
+            'Test integer': 42,
+            'Test char': 'Blue',
+            'Test float': 1.5,
+            'Test numeric': Decimal('10.25'),
+            'Test date': date(2016, 5, 17),
+            'Test datetime': datetime(2016, 5, 17, 10, 30, 15),
+            'Test selection': 'Red',
+        }
+        self.assertEqual(product.attributes_dict, expected)
+        self.assertEqual(other.attributes_dict, {})
+
+        with count_queries() as counter:
+            self.assertEqual(
+                self.Product.get_attributes_dict(
+                    [product, other], 'attributes_dict'
+                ), {product.id: expected, other.id: {}}
+            )
+        self.assertEqual(counter.count, 1)
+
+    @with_transaction()
+    def test0190_replace_attributes(self):
+        """
+        Replace the attribute values of products by dictionaries
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+        other, = self.Product.create([{
+            'template': product.template.id,
+        }])
+        values = product.attributes_dict
+        rows = dict(
+            (v.attribute.name, v.id) for v in ProductAttribute.search([
+                ('product', '=', product.id),
+            ])
+        )
+        signature = product.attribute_signature
+
+        # Unchanged values are only read
+        with count_queries() as counter:
+            ProductAttribute.replace_attributes({product: values})
+        self.assertEqual(counter.count, 3)
+        self.assertEqual(
+            self.Product(product.id).attribute_signature, signature
+        )
+
+        new_values = values.copy()
+        new_values.update({
+            'Test char': 'Green',
+            'Test boolean': None,
+            'Test numeric': '10.250',
+        })
+        del new_values['Test integer']
+        ProductAttribute.replace_attributes({
+            product.id: new_values,
+            other.id: {'Test selection': 'Red', 'Test integer': '7'},
+        })
+        del new_values['Test boolean']
+        new_values['Test numeric'] = Decimal('10.25')
+        self.assertEqual(
+            self.Product(product.id).attributes_dict, new_values
+        )
+        self.assertEqual(self.Product(other.id).attributes_dict, {
+            'Test selection': 'Red',
+            'Test integer': 7,
+        })
+        self.assertEqual(
+            dict(
+                (v.attribute.name, v.id) for v in ProductAttribute.search([
+                    ('product', '=', product.id),
+                ])
+            ),
+            dict((n, i) for n, i in rows.iteritems() if n in new_values)
+        )
+        self.assertEqual(
+            self.Product(other.id).attribute_signature,
+            self.Product.get_attribute_signature({
+                attributes['selection']: option,
+                attributes['integer']: 7,
+            })
+        )
+
+        self.Product.write([other], {'attributes_dict': {'Test char': 'A'}})
+        self.assertEqual(
+            self.Product(other.id).attributes_dict, {'Test char': 'A'}
+        )
+
+        # The names are in the context language for reading and writing
+        Lang = POOL.get('ir.lang')
+        french, = Lang.search([('code', '=', 'fr_FR')])
+        Lang.write([french], {'translatable': True})
+        with Transaction().set_context(language='fr_FR'):
+            self.Attribute.write([attributes['selection']], {
+                'name': u'Sélection',
+            })
+            self.SelectionOption.write([option], {'name': 'Rouge'})
+            values = self.Product(product.id).attributes_dict
+            self.assertEqual(values[u'Sélection'], 'Rouge')
+            self.Product.write([product], {'attributes_dict': values})
+            self.assertEqual(
+                self.Product(product.id).attributes_dict, values
+            )
+            ProductAttribute.replace_attributes({
+                other: {u'Sélection': 'Rouge'},
+            })
+        self.assertEqual(
+            self.Product(other.id).attributes_dict, {'Test selection': 'Red'}
+        )
+
+        with self.assertRaises(UserError):
+            ProductAttribute.replace_attributes({other: {'Unknown': 'A'}})
+        with self.assertRaises(UserError):
+            ProductAttribute.replace_attributes({
+                other: {'Test selection': 'Blue'},
+            })
+        with self.assertRaises(UserError):
+            ProductAttribute.replace_attributes({
+                other: {'Test integer': 'many'},
+            })
+        unset = self.Product.create([{
+            'template': self._create_product_template().id,
+        }])
+        with self.assertRaises(UserError):
+            ProductAttribute.replace_attributes(
+                dict((p, {'Test char': 'A'}) for p in unset)
+            )
+
+    @with_transaction()
+    def test0200_usage_counts(self):
+        """
+        Count the attribute values using the attributes and the options
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, red = self._create_typed_attributes()
+        green, = self.SelectionOption.create([{
+            'name': 'Green',
+            'attribute': attributes['selection'].id,
+        }])
+        other, = self.Product.create([{
+            'template': product.template.id,
+        }])
+
+        def usage_counts():
+            return tuple(r['usage_count'] for r in self.Attribute.read(
+                [attributes['char'].id, attributes['selection'].id],
+                ['usage_count']
+            ) + self.SelectionOption.read(
+                [red.id, green.id], ['usage_count']
+            ))
+
+        self.assertEqual(usage_counts(), (1, 1, 1, 0))
+
+        value, = ProductAttribute.search([
+            ('product', '=', product.id),
+            ('attribute', '=', attributes['selection'].id),
+        ])
+        ProductAttribute.write([value], {'value_selection': green.id})
+        self.assertEqual(usage_counts(), (1, 1, 0, 1))
+
+        self.Product.write([other], {'code': 'OTHER'})
+        self.assertEqual(ProductAttribute.import_values([
+            ('OTHER', 'Test char', 'Blue'),
+            ('OTHER', 'Test selection', 'Red'),
+        ]), [])
+        self.assertEqual(usage_counts(), (2, 2, 1, 1))
+
+        ProductAttribute.set_attributes([other], {
+            attributes['selection']: green,
+        })
+        self.assertEqual(usage_counts(), (2, 2, 0, 2))
+
+        ProductAttribute.replace_attributes({other: {'Test char': 'Red'}})
+        self.assertEqual(usage_counts(), (2, 1, 0, 1))
+
+        with self.assertRaises(UserError):
+            self.SelectionOption.delete([green])
+        with self.assertRaises(UserError):
+            self.Attribute.delete([attributes['char']])
+
+        # Repair the counters changed without the models
+        cursor = Transaction().connection.cursor()
+        table = self.Attribute.__table__()
+        cursor.execute(*table.update([table.usage_count], [0]))
+        self.Attribute.recompute_usage_counts([attributes['char']])
+        self.assertEqual(usage_counts(), (2, 0, 0, 1))
+        self.Attribute.recompute_usage_counts()
+        self.assertEqual(usage_counts(), (2, 1, 0, 1))
+
+        self.Product.delete([product, other])
+        self.assertEqual(usage_counts(), (0, 0, 0, 0))
+        self.SelectionOption.delete([red, green])
+        self.Attribute.delete(attributes.values())
+
+    @with_transaction()
+    def test0210_set_based_migration(self):
+        """
+        Migrate the attributes of the core module without questions
+        """
+        migration = load_script('migrate_from_core_module')
+
+        products = self._create_core_products()
+        policies = {
+            'no_attribute_set': 'remove',
+            'unknown_attribute': 'remove',
+            'attribute_not_in_set': 'add-to-set',
+            'invalid_option': 'create',
+            'invalid_value': 'remove',
+        }
+
+        with self.assertRaises(migration.ConflictError):
+            migration.SetBasedMigration(
+                migration.copy_selection_options(), {}
+            ).run()
+
+        set_based = migration.SetBasedMigration(
+            migration.load_selection_options(), policies, batch_size=2
+        )
+        set_based.run()
+        self.assertEqual(set_based.products, 5)
+        self.assertEqual(set_based.inserted, 5)
+        self.assertEqual(set_based.conflicts, dict.fromkeys(policies, 1))
+        self.assertEqual(
+            self.Product.get_attributes_dict(
+                self.Product.browse(products.values()), 'attributes_dict'
+            ), {
+                products['P1'].id: {'color': 'Red', 'weight': Decimal('2.5')},
+                products['P2'].id: {'color': 'green'},
+                products['P3'].id: {
+                    'weight': Decimal('1'), 'material': 'Cotton',
+                },
+                products['P4'].id: {},
+                products['P5'].id: {},
+                products['P6'].id: {},
+            }
+        )
+        self.assertTrue(self.Product(products['P1'].id).attribute_signature)
+        material, = self.Attribute.search([('name', '=', 'material')])
+        self.assertIn(
+            material, self.Product(products['P3'].id).attribute_set.attributes
+        )
+
+    @with_transaction()
+    def test0220_migration_conflict_report(self):
+        """
+        Report the conflicts of the migration without writing anything
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        migration = load_script('migrate_from_core_module')
+
+        self._create_core_products()
+
+        conflict_report = migration.ConflictReport(
+            migration.read_selection_options(), batch_size=2
+        )
+        conflict_report.run()
+        report = conflict_report.report()
+        self.assertEqual(report['products'], 5)
+        self.assertEqual(report['attribute_values'], 3)
+        self.assertEqual(report['conflicts'], dict.fromkeys([
+            'no_attribute_set', 'unknown_attribute', 'attribute_not_in_set',
+            'invalid_option', 'invalid_value',
+        ], 1))
+        details = dict((d['conflict'], d) for d in report['details'])
+        self.assertEqual(details['invalid_option']['value'], 'green')
+        self.assertEqual(details['unknown_attribute']['attribute'], 'size')
+        self.assertEqual(details['invalid_value']['attribute'], 'released')
+        json.dumps(report, default=migration.to_json)
+
+        self.assertEqual(ProductAttribute.search([]), [])
+        self.assertEqual(self.SelectionOption.search([]), [])
+        material, = self.Attribute.search([('name', '=', 'material')])
+        self.assertEqual(material.sets, ())
+
+    @with_transaction()
+    def test0230_checkpointed_migration(self):
+        """
+        Migrate the products by checkpointed ranges and resume with
+        another range size
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        migration = load_script('migrate_from_core_module')
+
+        # Created first as it commits the transaction on SQLite
+        migration.create_checkpoint_table()
+        products = self._create_core_products()
+        ids = sorted(p.id for p in products.values())
+        policies = {
+            'no_attribute_set': 'remove',
+            'unknown_attribute': 'remove',
+            'attribute_not_in_set': 'add-to-set',
+            'invalid_option': 'create',
+            'invalid_value': 'remove',
+        }
+
+        migration.MetadataMigration(
+            migration.copy_selection_options(), policies
+        ).run()
+        self.assertEqual(ProductAttribute.search([]), [])
+
+        chunks = migration.get_pending_chunks(2)
+        self.assertEqual(chunks, [
+            (ids[0], ids[0] + 2), (ids[0] + 2, ids[0] + 4),
+            (ids[0] + 4, ids[0] + 6),
+        ])
+        with Transaction().set_context(_defer_usage_counts=True):
+            migration.migrate_range(policies, 1000, *chunks[0])
+
+            # Resume with another chunk size after the first range
+            chunks = migration.get_pending_chunks(3)
+            self.assertEqual(chunks, [
+                (ids[0] + 2, ids[0] + 5), (ids[0] + 5, ids[0] + 6),
+            ])
+            inserted = sum(
+                migration.migrate_range(policies, 1000, *c).inserted
+                for c in chunks
+            )
+        self.assertEqual(inserted, 2)
+        self.assertEqual(migration.get_pending_chunks(1), [])
+
+        self.assertEqual(ProductAttribute.search_count([]), 5)
+        self.assertEqual(
+            self.Product.get_attributes_dict(
+                self.Product.browse(products.values()), 'attributes_dict'
+            )[products['P3'].id],
+            {'weight': Decimal('1'), 'material': 'Cotton'}
+        )
+
+        # The usage counters are recomputed at the end
+        color, = self.Attribute.search([('name', '=', 'color')])
+        self.assertEqual(color.usage_count, 0)
+        self.Attribute.recompute_usage_counts()
+        self.assertEqual(self.Attribute(color.id).usage_count, 2)
+
+    @with_transaction()
+    def test0240_attribute_metadata_translations(self):
+        """
+        Check that the cached metadata follows the translations of the
+        attribute and option names
+        """
+        Lang = POOL.get('ir.lang')
+        Translation = POOL.get('ir.translation')
+
+        french, = Lang.search([('code', '=', 'fr_FR')])
+        Lang.write([french], {'translatable': True})
+        attribute, = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+            'selection': [('create', [{'name': 'Red'}])],
+        }])
+        red, = attribute.selection
+
+        def get_names():
+            with Transaction().set_context(language='fr_FR'):
+                metadata = self.Attribute.get_metadata([attribute.id])
+            return metadata[attribute.id]['name'], \
+                metadata[attribute.id]['options'][red.id]
+
+        with Transaction().set_context(language='fr_FR'):
+            self.Attribute.write([attribute], {'name': 'Couleur'})
+            self.SelectionOption.write([red], {'name': 'Rouge'})
+        self.assertEqual(get_names(), ('Couleur', 'Rouge'))
+
+        translations = dict(
+            (t.name, t) for t in Translation.search([
+                ('lang', '=', 'fr_FR'),
+                ('res_id', 'in', [attribute.id, red.id]),
+                ('name', 'in', [
+                    'product.attribute,name',
+                    'product.attribute.selection_option,name',
+                ]),
+            ])
+        )
+        Translation.write(
+            [translations['product.attribute,name']], {'value': 'Teinte'}
+        )
+        self.assertEqual(get_names(), ('Teinte', 'Rouge'))
+        Translation.write(
+            [translations['product.attribute.selection_option,name']],
+            {'value': 'Vermillon'}
+        )
+        self.assertEqual(get_names(), ('Teinte', 'Vermillon'))
+
+        Translation.delete(translations.values())
+        self.assertEqual(get_names(), ('color', 'Red'))
+
+    @with_transaction()
+    def test0250_import_duplicate_values(self):
+        """
+        Check that the import rejects the values of attributes the product
+        already has
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        color, weight = self.Attribute.create([{
+            'name': 'color',
+            'type_': 'selection',
+            'selection': [('create', [{'name': 'Red'}, {'name': 'Blue'}])],
+        }, {
+            'name': 'weight',
+            'type_': 'numeric',
+        }])
+        attribute_set, = self.AttributeSet.create([{
+            'name': 'Test attribute set',
+            'attributes': [('add', [color.id, weight.id])],
+        }])
+        template = self._create_product_template(attribute_set)
+        product, = self.Product.create([{
+            'template': template.id,
+            'code': 'P1',
+        }])
+        ProductAttribute.create([{
+            'product': product.id,
+            'attribute': weight.id,
+            'value_numeric': Decimal('1'),
+        }])
+
+        errors = ProductAttribute.import_values([
+            ('P1', 'weight', '3'),
+            ('P1', 'color', 'Red'),
+            ('P1', 'color', 'Blue'),
+            ('P1', 'color', 'Red'),
+            ('P9', 'color', 'Red'),
+            ('P9', 'weight', '2'),
+        ], batch_size=2)
+
+        self.assertEqual([number for number, _ in errors], [1, 3, 4, 5, 6])
+        self.assertIn('already has a value of attribute "weight"', errors[0][1])
+        self.assertIn('already has a value of attribute "color"', errors[1][1])
+        self.assertEqual(
+            sorted(
+                (a.attribute.name, a.value)
+                for a in ProductAttribute.search([('product', '=', product)])
+            ),
+            [('color', 'Red'), ('weight', '1')]
+        )
+        self.assertEqual(self.SelectionOption(color.selection[0]).name, 'Red')
+        self.assertEqual(
+            [o.usage_count for o in self.Attribute(color.id).selection],
+            [1, 0]
+        )
+
+    @with_transaction()
+    def test0260_migration_existing_values(self):
+        """
+        Check that running the migration again keeps the values already
+        migrated
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        migration = load_script('migrate_from_core_module')
+
+        self._create_core_products()
+        policies = {
+            'no_attribute_set': 'remove',
+            'unknown_attribute': 'remove',
+            'attribute_not_in_set': 'add-to-set',
+            'invalid_option': 'create',
+            'invalid_value': 'remove',
+        }
+        migration.SetBasedMigration(
+            migration.load_selection_options(), policies
+        ).run()
+        self.assertEqual(ProductAttribute.search_count([]), 5)
+
+        with self.assertRaises(migration.ConflictError):
+            migration.SetBasedMigration(
+                migration.load_selection_options(), policies
+            ).run()
+
+        policies['existing_value'] = 'keep'
+        set_based = migration.SetBasedMigration(
+            migration.load_selection_options(), policies
+        )
+        set_based.run()
+        self.assertEqual(set_based.inserted, 0)
+        self.assertEqual(set_based.conflicts['existing_value'], 5)
+        self.assertEqual(ProductAttribute.search_count([]), 5)
+
+        conflict_report = migration.ConflictReport(
+            migration.read_selection_options()
+        )
+        conflict_report.run()
+        report = conflict_report.report()
+        self.assertEqual(report['attribute_values'], 0)
+        self.assertEqual(report['conflicts']['existing_value'], 4)
+
+    @with_transaction()
+    def test0270_unique_value_per_attribute(self):
+        """
+        Check the unique index of product and attribute and the bulk
+        upsert of attribute values relying on it
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        product, attributes, option = self._create_typed_attributes()
+        blue, = self.SelectionOption.create([{
+            'name': 'Blue',
+            'attribute': attributes['selection'].id,
+        }])
+        other, = self.Product.create([{
+            'template': product.template.id,
+            'code': 'OTHER',
+        }])
+        self.assertTrue(ProductAttribute._upsert_supported())
+
+        # Fill the cache of the value overwritten
+        char_value, = ProductAttribute.search([
+            ('product', '=', product.id),
+            ('attribute', '=', attributes['char'].id),
+        ])
+        old_value = char_value.value_char
+
+        self.Attribute.get_metadata([a.id for a in attributes.values()])
+        self.AttributeSet.get_attribute_ids([
+            product.template.attribute_set.id
+        ])
+        # Two queries to check the support of the upsert, one for the
+        # product sets, one for the existing values, one upsert, one for
+        # the counters of the attributes, one for the counters of the
+        # options and two for the signatures
+        with count_queries() as counter:
+            ProductAttribute.set_attributes([product, other], {
+                attributes['char']: 'Green',
+                attributes['selection']: blue,
+            })
+        self.assertEqual(counter.count, 9)
+        self.assertNotEqual(old_value, 'Green')
+        self.assertEqual(
+            ProductAttribute(char_value.id).value_char, 'Green'
+        )
+        self.assertEqual([
+            o.usage_count for o in self.SelectionOption.browse([option, blue])
+        ], [0, 2])
+        self.assertEqual(
+            ProductAttribute.search_count([('product', '=', product.id)]), 8
+        )
+        self.assertEqual(
+            ProductAttribute.search_count([('product', '=', other.id)]), 2
+        )
+
+        table = ProductAttribute.__table__()
+        cursor = Transaction().connection.cursor()
+        with self.assertRaises(DatabaseIntegrityError):
+            cursor.execute(*table.insert(
+                [table.product, table.attribute, table.value_char],
+                [[other.id, attributes['char'].id, 'Duplicate']]
+            ))
+        # Last as the integrity error rolls back the transaction
+        with self.assertRaises(UserError):
+            ProductAttribute.create([{
+                'product': product.id,
+                'attribute': attributes['char'].id,
+                'value_char': 'Duplicate',
+            }])
+
+    @with_transaction()
+    def test0280_query_counter(self):
+        """
+        Check the counts of the connection and cursor proxies
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+
+        product, attributes, option = self._create_typed_attributes()
+        table = ProductAttribute.__table__()
+        connection = Transaction().connection
+
+        with count_queries() as counter:
+            self.assertEqual(counter.rollback, connection.rollback)
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(table.id))
+            self.assertEqual(len(cursor.description), 1)
+            self.assertEqual(len(list(cursor)), len(attributes))
+            cursor.execute(*table.select(table.id))
+            self.assertEqual(len(cursor.fetchmany(3)), 3)
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(counter.rows, len(attributes) + 3)
+
+    @with_transaction()
+    def test0290_value_storage_register(self):
+        """
+        Check the tables created and dropped by the registration of the
+        attribute values in each storage mode
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        TableHandler = backend.get('TableHandler')
+        module = 'product_attribute_strict'
+
+        def tables():
+            return [
+                TableHandler.table_exist(ProductAttribute._table + suffix)
+                for suffix in ['_text', '_char', '_char_text', '_selection']
+            ]
+
+        with_text = ProductAttribute._text_table_exists()
+        with value_storage('typed'):
+            ProductAttribute.__register__(module)
+            self.assertEqual(tables(), [False, True, with_text, True])
+            # Registering it again keeps the tables
+            ProductAttribute.__register__(module)
+            self.assertEqual(tables(), [False, True, with_text, True])
+        with value_storage('wide'):
+            ProductAttribute.__register__(module)
+            self.assertEqual(tables(), [with_text, False, False, False])
+
+    @with_transaction()
+    def test0300_typed_value_storage(self):
+        """
+        Check the attribute values stored in a table per type behind the
+        value fields
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+
+        with value_storage('typed'):
+            # Before any data as the DDL commits on SQLite
+            ProductAttribute._create_value_tables()
+            ProductAttribute._create_text_table()
+
+            product, attributes, red = self._create_typed_attributes()
+            blue, = self.SelectionOption.create([{
+                'name': 'Blue',
+                'attribute': attributes['selection'].id,
+            }])
+            other, = self.Product.create([{
+                'template': product.template.id,
+                'code': 'OTHER',
+            }])
+            expected = {
+                'Test boolean': True,
+                'Test integer': 42,
+                'Test char': 'Blue',
+                'Test float': 1.5,
+                'Test numeric': Decimal('10.25'),
+                'Test date': date(2016, 5, 17),
+                'Test datetime': datetime(2016, 5, 17, 10, 30, 15),
+                'Test selection': 'Red',
+            }
+            self.assertEqual(product.attributes_dict, expected)
+            values = dict(
+                (v.attribute_type, v) for v in ProductAttribute.search([
+                    ('product', '=', product.id),
+                ])
+            )
+            self.assertIs(values['boolean'].value_boolean, True)
+            self.assertEqual(values['selection'].value_selection, red)
+            self.assertEqual(values['char'].value_integer, None)
+            self.assertEqual(
+                dict(
+                    (r[2], r[3]) for r in self.Product.export_attributes()
+                ), expected
+            )
+            table = ProductAttribute._get_value_table('char')
+            cursor.execute(*table.select(table.product, table.value_char))
+            self.assertEqual(cursor.fetchall(), [(product.id, 'Blue')])
+
+            # Searches
+            self.assertEqual(ProductAttribute.search([
+                ('value_selection.name', '=', 'Red'),
+            ]), [values['selection']])
+            self.assertEqual(ProductAttribute.search([
+                ('value_integer', '>', 40),
+            ]), [values['integer']])
+            self.assertEqual(ProductAttribute.search_count([
+                ('value_integer', '=', None),
+            ]), len(attributes) - 1)
+            self.assertEqual(ProductAttribute.search([
+                ('value_text', 'ilike', '%blu%'),
+            ]), [values['char']])
+            self.assertEqual(self.Product.search([
+                ('attribute_filter', 'where', [
+                    ('Test integer', '=', '42'),
+                    ('Test selection', '=', 'Red'),
+                ]),
+            ]), [product])
+
+            # Writes through the fields, the copy and the bulk methods
+            ProductAttribute.write([values['char']], {'value_char': 'Navy'})
+            char_value, = ProductAttribute.copy(
+                [values['char']], {'product': other.id}
+            )
+            self.assertEqual(char_value.value_char, 'Navy')
+            third, = self.Product.create([{
+                'template': product.template.id,
+            }])
+            ProductAttribute.write([char_value], {'product': third.id})
+            ProductAttribute.delete([values['char']])
+            cursor.execute(*table.select(
+                table.id, table.product, table.value_char
+            ))
+            self.assertEqual(
+                cursor.fetchall(), [(char_value.id, third.id, 'Navy')]
+            )
+            ProductAttribute.set_attributes([product, other], {
+                attributes['integer']: 7,
+                attributes['selection']: blue,
+            })
+            ProductAttribute.replace_attributes({
+                other: {'Test char': 'Green', 'Test selection': 'Red'},
+            })
+            self.assertEqual(
+                ProductAttribute.import_values([
+                    ('OTHER', 'Test boolean', 'false'),
+                ]), []
+            )
+            self.assertEqual(self.Product(other.id).attributes_dict, {
+                'Test boolean': False,
+                'Test char': 'Green',
+                'Test selection': 'Red',
+            })
+            self.assertEqual(
+                self.Product(product.id).attributes_dict['Test integer'], 7
+            )
+            self.assertEqual(
+                self.Product(other.id).attribute_signature,
+                self.Product.get_attribute_signature({
+                    attributes['boolean']: False,
+                    attributes['char']: 'Green',
+                    attributes['selection']: red,
+                })
+            )
+            self.assertEqual(
+                [o.usage_count for o in self.SelectionOption.browse(
+                    [red, blue]
+                )], [1, 1]
+            )
+            self.Attribute.recompute_usage_counts()
+            self.assertEqual(
+                [o.usage_count for o in self.SelectionOption.browse(
+                    [red, blue]
+                )], [1, 1]
+            )
+            facets = self.Product.get_facets([])
+            self.assertEqual(
+                [(v['name'], v['count']) for v in facets[-1]['values']],
+                [('Red', 1), ('Blue', 1)]
+            )
+
+            variants = self.Template.generate_variants(
+                product.template, {attributes['selection']: [red, blue]}
+            )
+            self.assertEqual(variants, [])
+
+            # An option of another attribute is rejected
+            with self.assertRaises(UserError):
+                ProductAttribute.write([char_value], {
+                    'attribute': attributes['selection'].id,
+                    'value_char': None,
+                    'value_selection': self.SelectionOption.create([{
+                        'name': 'Other',
+                        'attribute': attributes['integer'].id,
+                    }])[0].id,
+                })
+
+            # The values of create and write are written once per type
+            # whatever the number of records, so they cost the same number
+            # of queries per record as with the wide storage
+            def count_writes(count):
+                products = self.Product.create([{
+                    'template': product.template.id,
+                } for _ in range(count)])
+                with count_queries() as create_counter:
+                    created = ProductAttribute.create([{
+                        'product': p.id,
+                        'attribute': attributes['integer'].id,
+                        'value_integer': i,
+                    } for i, p in enumerate(products)])
+                with count_queries() as write_counter:
+                    ProductAttribute.write(*sum([
+                        [[v], {'value_integer': -i}]
+                        for i, v in enumerate(created)
+                    ], []))
+                self.assertEqual(
+                    [v.value_integer for v in ProductAttribute.browse(
+                        created
+                    )], [-i for i in range(count)]
+                )
+                return create_counter.count, write_counter.count
+
+            # The first writes fill the caches
+            typed = [count_writes(n) for n in (1, 2, 10)][1:]
+        wide = [count_writes(n) for n in (1, 2, 10)][1:]
+        self.assertEqual(
+            [t - s for t, s in zip(typed[1], typed[0])],
+            [t - s for t, s in zip(wide[1], wide[0])]
+        )
+
+    @with_transaction()
+    def test0310_value_storage_migration(self):
+        """
+        Check the migration of the attribute values between the storage
+        modes
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().connection.cursor()
+
+        with value_storage('typed'):
+            # Before any data as the DDL commits on SQLite
+            ProductAttribute._create_value_tables()
+        with value_storage('wide'):
+            product, attributes, option = self._create_typed_attributes()
+            expected = product.attributes_dict
+        table = ProductAttribute.__table__()
+
+        with value_storage('typed'):
+            ProductAttribute._migrate_to_value_tables(
+                TableHandler(ProductAttribute, 'product_attribute_strict')
+            )
+            self.assertEqual(
+                self.Product(product.id).attributes_dict, expected
+            )
+            cursor.execute(*table.select(
+                table.id, where=(table.value_char != Null)
+                | (table.value_selection != Null)
+            ))
+            self.assertEqual(cursor.fetchall(), [])
+
+        with value_storage('wide'):
+            ProductAttribute._migrate_from_value_tables()
+            self.assertEqual(
+                self.Product(product.id).attributes_dict, expected
+            )
+            other, = self.Product.create([{
+                'template': product.template.id,
+            }])
+            ProductAttribute.copy(
+                product.attributes, {'product': other.id}
+            )
+            self.assertEqual(
+                self.Product(other.id).attributes_dict, expected
+            )
+
+    @with_transaction()
+    def test0320_value_index_fallback(self):
+        """
+        Check that backends without partial indexes get the composite
+        indexes of the same names
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        TableHandler = backend.get('TableHandler')
+
+        old_sqlite = patch_classmethod(
+            ProductAttribute, '_get_sqlite_version', lambda cls: (3, 7)
+        )
+        with old_sqlite:
+            self.assertFalse(ProductAttribute._partial_index_supported())
+        table = TableHandler(ProductAttribute, 'product_attribute_strict')
+        no_partial = patch_classmethod(
+            ProductAttribute, '_partial_index_supported', lambda cls: False
+        )
+        with no_partial:
+            ProductAttribute._create_value_indexes(table)
+        for type_, _ in ATTRIBUTE_TYPES:
+            self.assertIn(
+                '%s_attribute_value_%s_product_index' % (
+                    ProductAttribute._table, type_
+                ), table._indexes
+            )
+
+    @with_transaction()
+    def test0330_unique_index_duplicates(self):
+        """
+        Check that the unique index is not created while the table has
+        duplicate values
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        with scripted_connection(
+                error=DatabaseIntegrityError('UNIQUE constraint failed')
+                ) as connection:
+            ProductAttribute._create_unique_index()
+        self.assertEqual(len(connection.queries), 1)
+
+    @with_transaction()
+    def test0340_text_indexes(self):
+        """
+        Check the creation of the text indexes depending on the features of
+        the backend
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        # The trigram index needs the pg_trgm extension and is created once
+        for rows, count in [([None], 1), ([(1,), (1,)], 2), ([(1,), None], 3)]:
+            with scripted_connection(rows) as connection:
+                ProductAttribute._create_trigram_index()
+            self.assertEqual(len(connection.queries), count)
+        self.assertIn('gin_trgm_ops', connection.queries[-1])
+
+        # No text table is created without FTS5
+        with scripted_connection(
+                [None], DatabaseOperationalError('no such module: fts5')
+                ) as connection:
+            ProductAttribute._create_text_table()
+        self.assertEqual(len(connection.queries), 2)
+
+    @with_transaction()
+    def test0350_deferred_usage_counts(self):
+        """
+        Leave the usage counters to the recompute when they are deferred by
+        the configuration and recompute them before deleting
+        """
+        section = 'product_attribute_strict'
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, 'usage_counts', 'deferred')
+        try:
+            product, attributes, red = self._create_typed_attributes()
+            selection = attributes['selection']
+            self.assertEqual(self.Attribute(selection.id).usage_count, 0)
+            self.assertEqual(self.SelectionOption(red.id).usage_count, 0)
+
+            with self.assertRaises(UserError):
+                self.SelectionOption.delete([red])
+            with self.assertRaises(UserError):
+                self.Attribute.delete([selection])
+            self.assertEqual(self.Attribute(selection.id).usage_count, 1)
+            self.assertEqual(self.SelectionOption(red.id).usage_count, 1)
+
+            self.Product.delete([product])
+            self.assertEqual(self.Attribute(selection.id).usage_count, 1)
+            self.SelectionOption.delete([red])
+            self.Attribute.delete([selection])
+        finally:
+            config.remove_option(section, 'usage_counts')
+
+    @with_transaction()
+    def test0360_usage_count_migration(self):
+        """
+        Check that the usage counters are computed when their columns are
+        added
+        """
+        ProductAttribute = POOL.get('product.product.attribute')
+        cursor = Transaction().connection.cursor()
+        module = 'product_attribute_strict'
+
+        product, attributes, option = self._create_typed_attributes()
+        for Model in [self.Attribute, self.SelectionOption]:
+            table = Model.__table__()
+            cursor.execute(*table.update([table.usage_count], [0]))
+            with missing_column('usage_count'):
+                Model.__register__(module)
+        self.assertEqual(
+            set(a.usage_count for a in self.Attribute.browse(
+                attributes.values()
+            )), set([1])
+        )
+        self.assertEqual(self.SelectionOption(option.id).usage_count, 1)
+        self.assertEqual(
+            ProductAttribute.search_count([('product', '=', product.id)]),
+            len(attributes)
+        )
+
 
 def suite():
     """